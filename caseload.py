@@ -0,0 +1,169 @@
+# Community health worker caseload
+#
+# One row per patient conversation, upserted whenever the conversation changes, with
+# exactly the fields the CHW dashboard filters on. Each worklist is a partial index
+# (pending recommendations, unscheduled abnormal results, follow-ups, open
+# conversations), so a CHW's page reads only the matching patients of their region
+# instead of scanning every session. Rows live in SQLite, shared by all workers.
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_DB = os.environ.get(
+    "NAVIGATOR_CASELOAD_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "caseload.sqlite3"),
+)
+
+# Conversations with no reply for this long are stalled
+STALLED_AFTER_SECONDS = 3 * 24 * 3600
+WORKLIST_LIMIT = 50
+
+# Result severity
+NO_FINDINGS = 0
+MINOR = 1      # cervical ASCUS / CIN-1: monitoring visit in about 6 months
+SERIOUS = 2    # cervical CIN-2 / CIN-3 or an abnormal mammogram: prompt follow-up
+
+Patient = namedtuple("Patient", ["session", "name", "stage", "updated", "recommendations", "severity",
+                                 "result_at", "follow_up"])
+
+WORKLISTS = {
+    "pending_recommendations": "Recommendations not yet acted on",
+    "unscheduled_results": "Abnormal results with no follow-up booked",
+    "overdue_follow_ups": "Follow-up date passed with no word since",
+    "stalled": "Conversations that went quiet",
+}
+
+_COLUMNS = "session, name, stage, updated, recommendations, severity, result_at, follow_up"
+
+
+def result_severity(test_results):
+    """How urgently a set of screening results needs follow-up"""
+    if test_results.get("cervical") == "abnormal_serious" or test_results.get("breast") == "abnormal":
+        return SERIOUS
+    if test_results.get("cervical") == "abnormal_minor":
+        return MINOR
+    return NO_FINDINGS
+
+
+class Caseload:
+    """Per-patient rows and worklist queries for the CHW dashboard"""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS patients (
+                session TEXT PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                name TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                updated REAL NOT NULL,
+                recommendations INTEGER NOT NULL,
+                severity INTEGER NOT NULL,
+                result_at REAL,
+                scheduled INTEGER NOT NULL,
+                follow_up REAL
+            );
+            CREATE INDEX IF NOT EXISTS pending_recommendations ON patients (tenant, updated)
+                WHERE recommendations > 0 AND scheduled = 0;
+            CREATE INDEX IF NOT EXISTS unscheduled_results ON patients (tenant, severity DESC, result_at)
+                WHERE severity > 0 AND scheduled = 0;
+            CREATE INDEX IF NOT EXISTS follow_ups ON patients (tenant, follow_up)
+                WHERE follow_up IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS open_conversations ON patients (tenant, updated)
+                WHERE stage != 'end';
+        """)
+        self.lock = threading.Lock()
+
+    def update(self, tenant_id, session, name, stage, recommendations, severity, follow_up=None, now=None):
+        """Record a patient's current position; called whenever their conversation changes"""
+        now = time.time() if now is None else now
+        with self.lock:
+            # result_at keeps the time the result first arrived, for aging
+            self.db.execute("""
+                INSERT INTO patients (session, tenant, name, stage, updated, recommendations, severity, result_at, scheduled, follow_up)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (session) DO UPDATE SET
+                    tenant = excluded.tenant, name = excluded.name, stage = excluded.stage,
+                    updated = excluded.updated, recommendations = excluded.recommendations,
+                    severity = excluded.severity, scheduled = excluded.scheduled, follow_up = excluded.follow_up,
+                    result_at = CASE WHEN excluded.severity = 0 THEN NULL
+                                     ELSE COALESCE(patients.result_at, excluded.result_at) END
+            """, (session, tenant_id, name, stage, now, recommendations, severity,
+                  now if severity else None, int(follow_up is not None), follow_up))
+
+    def remove(self, session):
+        with self.lock:
+            self.db.execute("DELETE FROM patients WHERE session = ?", (session,))
+
+    def _rows(self, sql, params):
+        # The connection is shared across threads; fetch every row before letting go
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [Patient(*row) for row in rows]
+
+    def worklist(self, tenant_id, name, limit=WORKLIST_LIMIT, now=None):
+        """Patients on one worklist, most pressing first"""
+        now = time.time() if now is None else now
+        if name == "pending_recommendations":
+            return self._rows(f"""
+                SELECT {_COLUMNS} FROM patients INDEXED BY pending_recommendations
+                WHERE tenant = ? AND recommendations > 0 AND scheduled = 0
+                ORDER BY updated LIMIT ?""", (tenant_id, limit))
+        if name == "unscheduled_results":
+            return self._rows(f"""
+                SELECT {_COLUMNS} FROM patients INDEXED BY unscheduled_results
+                WHERE tenant = ? AND severity > 0 AND scheduled = 0
+                ORDER BY severity DESC, result_at LIMIT ?""", (tenant_id, limit))
+        if name == "overdue_follow_ups":
+            return self._rows(f"""
+                SELECT {_COLUMNS} FROM patients INDEXED BY follow_ups
+                WHERE tenant = ? AND follow_up IS NOT NULL AND follow_up < ? AND updated < follow_up
+                ORDER BY follow_up LIMIT ?""", (tenant_id, now, limit))
+        if name == "stalled":
+            return self._rows(f"""
+                SELECT {_COLUMNS} FROM patients INDEXED BY open_conversations
+                WHERE tenant = ? AND stage != 'end' AND updated < ?
+                ORDER BY updated LIMIT ?""", (tenant_id, now - STALLED_AFTER_SECONDS, limit))
+        raise KeyError(f"Unknown worklist '{name}'")
+
+    def counts(self, tenant_id, now=None):
+        """Number of patients on each worklist"""
+        now = time.time() if now is None else now
+        queries = {
+            "pending_recommendations": ("SELECT COUNT(*) FROM patients INDEXED BY pending_recommendations "
+                                        "WHERE tenant = ? AND recommendations > 0 AND scheduled = 0", (tenant_id,)),
+            "unscheduled_results": ("SELECT COUNT(*) FROM patients INDEXED BY unscheduled_results "
+                                    "WHERE tenant = ? AND severity > 0 AND scheduled = 0", (tenant_id,)),
+            "overdue_follow_ups": ("SELECT COUNT(*) FROM patients INDEXED BY follow_ups WHERE tenant = ? "
+                                   "AND follow_up IS NOT NULL AND follow_up < ? AND updated < follow_up", (tenant_id, now)),
+            "stalled": ("SELECT COUNT(*) FROM patients INDEXED BY open_conversations "
+                        "WHERE tenant = ? AND stage != 'end' AND updated < ?", (tenant_id, now - STALLED_AFTER_SECONDS)),
+        }
+        with self.lock:
+            return {name: self.db.execute(sql, params).fetchone()[0] for name, (sql, params) in queries.items()}
+
+    def dashboard(self, tenant_id, limit=WORKLIST_LIMIT, now=None):
+        """Counts and the top patients of every worklist for one region's CHW"""
+        now = time.time() if now is None else now
+        return {
+            "counts": self.counts(tenant_id, now),
+            "worklists": {name: self.worklist(tenant_id, name, limit, now) for name in WORKLISTS},
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    from tenants import DEFAULT_TENANT
+    tenant_id = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TENANT
+    started = time.perf_counter()
+    board = Caseload().dashboard(tenant_id, limit=10)
+    print(f"Caseload for {tenant_id} ({(time.perf_counter() - started) * 1000:.1f} ms)")
+    for name, title in WORKLISTS.items():
+        print(f"\n{title}: {board['counts'][name]}")
+        for patient in board["worklists"][name]:
+            print(f"  {patient.name or patient.session[:8]:<20} {patient.stage:<40} updated {time.ctime(patient.updated)}")
@@ -0,0 +1,391 @@
+# Clinic directory loaded from external CSV or JSON files
+#
+# Directories are parsed as a stream and compiled into a compact binary index
+# (data/clinics.idx) that is memory-mapped, so even a national directory stays
+# mostly off the Python heap. When the source file changes, the index is rebuilt
+# into a temporary file and swapped in atomically; every worker notices the new
+# index on its next refresh and remaps it without a restart. Each mapping is served
+# as an immutable, versioned snapshot: a conversation turn reads one snapshot
+# throughout, and reloads build the next one in the background. Nearby searches go
+# through a per-service grid of lat/lon cells built once per snapshot, so a search
+# only touches clinics in the cells around the user.
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from ranking import ClinicRanker
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DEFAULT_SOURCE = os.environ.get("NAVIGATOR_CLINICS", os.path.join(DATA_DIR, "clinics.csv"))
+REFRESH_INTERVAL_SECONDS = 5.0
+
+INDEX_MAGIC = b"CLNX"
+INDEX_VERSION = 1
+# magic, version, record count, city count, city table offset, record table offset
+HEADER = struct.Struct("<4sIIIQQ")
+CITY_ENTRY = struct.Struct("<III")    # name offset in city names blob, first record, record count
+RECORD_ENTRY = struct.Struct("<QI")   # record offset, record length
+
+COST_PREFIX = "cost_"
+
+GRID_DEGREES = 0.25              # grid cell edge, about 28 km of latitude
+KM_PER_DEGREE = 111.195
+
+
+def _parse_number(value):
+    value = value.strip()
+    if not value:
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def _clinic_from_row(row):
+    """Turn a flat CSV row into a clinic record"""
+    clinic = {
+        "city": row.get("city", "").strip(),
+        "name": row.get("name", "").strip(),
+        "address": row.get("address", "").strip(),
+        "services": [s.strip() for s in row.get("services", "").split(";") if s.strip()],
+        "phone": row.get("phone", "").strip(),
+        "cost": {},
+        "notes": row.get("notes", "").strip(),
+    }
+    for column, value in row.items():
+        if column and column.startswith(COST_PREFIX) and value is not None:
+            cost = _parse_number(value)
+            if cost is not None:
+                clinic["cost"][column[len(COST_PREFIX):]] = cost
+    # Any other columns (e.g. latitude, longitude) are kept as-is
+    for column, value in row.items():
+        if column and column not in clinic and not column.startswith(COST_PREFIX):
+            clinic[column] = value
+    return clinic
+
+
+def iter_clinics(source_path):
+    """Stream clinic records from a .csv, .jsonl or .json directory file"""
+    if source_path.endswith(".csv"):
+        with open(source_path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                yield _clinic_from_row(row)
+    elif source_path.endswith(".jsonl"):
+        with open(source_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif source_path.endswith(".json"):
+        # Plain JSON is not streamable; it is accepted for small {city: [clinics]} or [clinics] files
+        with open(source_path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            for city, clinics in data.items():
+                for clinic in clinics:
+                    yield {"city": city, **clinic}
+        else:
+            yield from data
+    else:
+        raise ValueError(f"Unsupported clinic directory format: {source_path}")
+
+
+def build_index(source_path, index_path):
+    """Compile a clinic directory into a memory-mappable index file"""
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    entries = []  # (city, record offset, record length) kept in memory, records go straight to disk
+    with open(tmp_path, "wb") as out:
+        out.write(b"\0" * HEADER.size)
+        for clinic in iter_clinics(source_path):
+            record = json.dumps(clinic, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            entries.append((clinic.get("city", ""), out.tell(), len(record)))
+            out.write(record)
+
+        # Records are grouped by city through the record table, so the blob itself is never rewritten
+        entries.sort(key=lambda entry: entry[0])
+        record_table_offset = out.tell()
+        cities = []
+        for index, (city, offset, length) in enumerate(entries):
+            if not cities or cities[-1][0] != city:
+                cities.append([city, index, 0])
+            cities[-1][2] += 1
+            out.write(RECORD_ENTRY.pack(offset, length))
+
+        city_table_offset = out.tell()
+        names = b""
+        for city, first, count in cities:
+            out.write(CITY_ENTRY.pack(len(names), first, count))
+            names += city.encode("utf-8") + b"\0"
+        out.write(names)
+
+        out.seek(0)
+        out.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries), len(cities), city_table_offset, record_table_offset))
+    os.replace(tmp_path, index_path)
+
+
+class ClinicIndex:
+    """Read-only view over a memory-mapped clinic index"""
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.record_count, city_count, city_table_offset, self.record_table_offset = HEADER.unpack_from(self.buffer, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{index_path} is not a clinic index")
+
+        # Only the city table lives on the heap; records are decoded on demand
+        names_offset = city_table_offset + city_count * CITY_ENTRY.size
+        self.cities = {}
+        for i in range(city_count):
+            name_start, first, count = CITY_ENTRY.unpack_from(self.buffer, city_table_offset + i * CITY_ENTRY.size)
+            name_end = self.buffer.find(b"\0", names_offset + name_start)
+            self.cities[self.buffer[names_offset + name_start:name_end].decode("utf-8")] = (first, count)
+
+    def record(self, position):
+        offset, length = RECORD_ENTRY.unpack_from(self.buffer, self.record_table_offset + position * RECORD_ENTRY.size)
+        return json.loads(self.buffer[offset:offset + length])
+
+    def clinics_for(self, city):
+        first, count = self.cities.get(city, (0, 0))
+        return [self.record(position) for position in range(first, first + count)]
+
+    def __iter__(self):
+        for position in range(self.record_count):
+            yield self.record(position)
+
+
+class ClinicGrid:
+    """Clinics bucketed by service into lat/lon grid cells"""
+
+    def __init__(self, ranker):
+        self.cells = {}  # service -> {(row, column): [(latitude, longitude, clinic)]}
+        for clinic, latitude, longitude in zip(ranker.clinics, ranker.latitude, ranker.longitude):
+            cell = (math.floor(latitude / GRID_DEGREES), math.floor(longitude / GRID_DEGREES))
+            for service in set(clinic.get("services", [])):
+                self.cells.setdefault(service, {}).setdefault(cell, []).append((latitude, longitude, clinic))
+
+    def near(self, service, latitude, longitude, max_km):
+        """Clinics offering a service in the cells covering max_km around a point
+
+        Cells are square in degrees, so callers still check the exact distance
+        """
+        cells = self.cells.get(service)
+        if not cells:
+            return []
+        lat_span = max_km / KM_PER_DEGREE
+        lon_span = lat_span / max(math.cos(math.radians(latitude)), 0.01)
+        rows = range(math.floor((latitude - lat_span) / GRID_DEGREES), math.floor((latitude + lat_span) / GRID_DEGREES) + 1)
+        columns = range(math.floor((longitude - lon_span) / GRID_DEGREES), math.floor((longitude + lon_span) / GRID_DEGREES) + 1)
+        if len(rows) * len(columns) >= len(cells) or lon_span >= 180:
+            # A search wider than the occupied cells: hand back everything
+            return [entry for entries in cells.values() for entry in entries]
+        found = []
+        wrap = round(360 / GRID_DEGREES)
+        for row in rows:
+            for column in columns:
+                # Longitudes past the antimeridian land in the cell on the other side
+                entries = cells.get((row, (column + wrap // 2) % wrap - wrap // 2))
+                if entries:
+                    found.extend(entries)
+        return found
+
+
+class ClinicSnapshot:
+    """One immutable version of the clinic directory
+
+    Everything derived from the index (decoded cities, centres, the ranking view) is
+    cached on the snapshot it came from, so a turn that holds a snapshot sees one
+    consistent directory however many reloads happen meanwhile.
+    """
+
+    def __init__(self, index, version):
+        self.index = index
+        self.version = version
+        self._clinics = {}
+        self._centres = {}
+        self._ranker = None
+        self._grid = None
+
+    def snapshot(self):
+        return self
+
+    def clinics_for(self, city):
+        """All clinics listed for a city, in file order"""
+        clinics = self._clinics.get(city)
+        if clinics is None:
+            # Two threads may decode the same city at once; either copy is fine to keep
+            clinics = self._clinics[city] = tuple(self.index.clinics_for(city))
+        return list(clinics)
+
+    def cities(self):
+        return list(self.index.cities)
+
+    def city_centre(self, city):
+        """Mean position of a city's clinics, used when we don't know where the user is"""
+        if city in self._centres:
+            return self._centres[city]
+        positions = []
+        for clinic in self.clinics_for(city):
+            try:
+                positions.append((float(clinic["latitude"]), float(clinic["longitude"])))
+            except (KeyError, TypeError, ValueError):
+                continue
+        centre = None
+        if positions:
+            centre = (sum(p[0] for p in positions) / len(positions), sum(p[1] for p in positions) / len(positions))
+        self._centres[city] = centre
+        return centre
+
+    def ranker(self):
+        """Columnar ranking view of this snapshot"""
+        if self._ranker is None:
+            self._ranker = ClinicRanker(self.index)
+        return self._ranker
+
+    def grid(self):
+        """Service grid of this snapshot, sharing the ranker's decoded clinics"""
+        if self._grid is None:
+            self._grid = ClinicGrid(self.ranker())
+        return self._grid
+
+
+class ClinicDirectory:
+    """Clinic lookups that follow changes to the source file without a restart
+
+    Readers take the current snapshot with a plain attribute read and never lock. A
+    reload builds the next snapshot on a background thread and swaps it in with a
+    single assignment; snapshots already handed out stay valid until dropped.
+    """
+
+    def __init__(self, source_path=DEFAULT_SOURCE, index_path=None, refresh_interval=REFRESH_INTERVAL_SECONDS):
+        self.source_path = source_path
+        self.index_path = index_path or os.path.splitext(source_path)[0] + ".idx"
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.next_check = 0.0
+        self.current = ClinicSnapshot(self._open(), 1)
+
+    def _open(self):
+        if not os.path.exists(self.index_path) or os.path.getmtime(self.index_path) < os.path.getmtime(self.source_path):
+            build_index(self.source_path, self.index_path)
+        return ClinicIndex(self.index_path)
+
+    @property
+    def index(self):
+        return self.current.index
+
+    def snapshot(self):
+        """The current version of the directory; hold it for the rest of a turn"""
+        return self.current
+
+    def _changed(self):
+        stat = os.stat(self.index_path) if os.path.exists(self.index_path) else None
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size) if stat else None
+        return identity != self.current.index.identity or os.path.getmtime(self.source_path) > stat.st_mtime
+
+    def _reload(self):
+        try:
+            # Readers holding the old snapshot keep a valid mapping until they drop it
+            snapshot = ClinicSnapshot(self._open(), self.current.version + 1)
+            # Build the search grid here rather than on the first booking after the swap
+            snapshot.grid()
+            self.current = snapshot
+        finally:
+            self.lock.release()
+
+    def refresh(self, wait=False):
+        """Start a reload if the source or index changed; cheap enough to call every turn
+
+        The reload runs in the background and the current snapshot keeps serving until it
+        lands; with wait, it runs on the calling thread instead
+        """
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        # Only one reload at a time; everyone else keeps reading the current snapshot
+        if not self.lock.acquire(blocking=False):
+            return
+        self.next_check = now + self.refresh_interval
+        try:
+            changed = self._changed()
+        except Exception:
+            self.lock.release()
+            raise
+        if not changed:
+            self.lock.release()
+        elif wait:
+            self._reload()
+        else:
+            threading.Thread(target=self._reload, name="clinic-reload", daemon=True).start()
+
+    def clinics_for(self, city):
+        """All clinics listed for a city, in file order"""
+        return self.current.clinics_for(city)
+
+    def cities(self):
+        return self.current.cities()
+
+    def city_centre(self, city):
+        return self.current.city_centre(city)
+
+    def ranker(self):
+        return self.current.ranker()
+
+    def grid(self):
+        return self.current.grid()
+
+
+if __name__ == "__main__":
+    # Lookup throughput from reader threads while the directory keeps reloading
+    import argparse
+    import shutil
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs="?", default=DEFAULT_SOURCE)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    scratch = tempfile.mkdtemp()
+    source = os.path.join(scratch, os.path.basename(args.source))
+    shutil.copy(args.source, source)
+    directory = ClinicDirectory(source, refresh_interval=0.05)
+    print(f"Indexed {directory.index.record_count} clinics in {len(directory.index.cities)} cities "
+          f"in {time.perf_counter() - started:.2f}s")
+
+    stop = threading.Event()
+    lookups = [0] * args.threads
+    errors = []
+
+    def reader(slot):
+        while not stop.is_set():
+            snapshot = directory.snapshot()
+            for city in snapshot.cities():
+                clinics = snapshot.clinics_for(city)
+                snapshot.city_centre(city)
+                # Within a snapshot a city's clinics never change
+                if snapshot.clinics_for(city) != clinics:
+                    errors.append(city)
+                lookups[slot] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + args.seconds
+    while time.monotonic() < deadline:
+        # Touch the source so every refresh finds a change and reloads
+        os.utime(source)
+        directory.refresh()
+        time.sleep(0.1)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    print(f"{sum(lookups) / args.seconds:,.0f} city lookups/s on {args.threads} threads across "
+          f"{directory.current.version} versions, {len(errors)} inconsistent reads")
@@ -0,0 +1,1482 @@
+# Conversation stage logic
+#
+# Everything that decides what the navigator says next, independent of Streamlit, so the
+# app and offline tools such as the flow-path explorer run the same code.
+# A conversation is a session state object (st.session_state in the app, SessionState
+# elsewhere) plus a Context with the per-process resources it runs against.
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from caseload import result_severity
+from events import STAGE, ANSWER, RECOMMENDATION, SCHEDULED
+from i18n import DEFAULT_LOCALE, translate
+from intent import IntentClassifier
+from ranking import POSSIBLE_TREATMENT_WEIGHT
+from screening import get_screening_rules
+
+# Shared resources for a conversation: tenant config, pinned flow version, intent classifier,
+# clinic directory, slot engine, event log and (optionally) the tenant's guideline index, the
+# CHW caseload, the inbound message deduplicator and the screening due-date index
+Context = namedtuple("Context", ["tenant", "flow", "classifier", "clinics", "slots", "events", "guidelines", "caseload",
+                                 "inbound", "due_dates"], defaults=(None, None, None, None))
+
+
+class SessionState(dict):
+    """Stand-in for st.session_state outside the app: a dict with attribute access"""
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+
+def new_profile(tenant, name="", locale=None):
+    """An empty user profile for a tenant"""
+    return {
+        "name": name,
+        "age": 0,
+        "location": tenant["default_city"],
+        "marital_status": "",
+        "education_level": "",
+        "annual_checkup": None,
+        "cervical_screening": None,
+        "breast_screening": None,
+        "current_location": tenant["default_city"],
+        "menstrual_regularity": None,
+        "pregnancies": 0,
+        "contraceptive_method": None,
+        "presenting_complaints": [],
+        "family_history_cancer": None,
+        "chronic_conditions": [],
+        "tobacco_use": None,
+        "alcohol_use": None,
+        "physical_activity": None,
+        "locale": locale or tenant["default_locale"]
+    }
+
+
+def init_session(state, tenant):
+    """Fill in any session state a new conversation needs"""
+    defaults = {
+        "messages": [],
+        "conv_stage": "intro",
+        "quick_replies": [],
+        "show_clinic_info": False,
+        "alternate_location": "",
+        "waiting_for_input": True,
+        "assessment_path": [],
+        "recommendations": [],
+        "test_results": {
+            "cervical": None,  # Options: "normal", "abnormal_minor", "abnormal_serious"
+            "breast": None     # Options: "normal", "abnormal"
+        },
+        "visit_complete": False,
+        "follow_up_scheduled": False,
+        "next_appointment_date": None,
+        "appointments": {},  # service -> Booking
+        "last_logged_stage": None,
+    }
+    if "user_profile" not in state:
+        state.user_profile = new_profile(tenant)
+    if "session_id" not in state:
+        state.session_id = uuid.uuid4().hex
+    for key, value in defaults.items():
+        if key not in state:
+            state[key] = value
+
+
+def build_intent_classifier(flow):
+    """Intent classifier trained on the quick replies of each stage in a flow"""
+    stage_options = {
+        stage_info["next_stage"]: list(stage_info["quick_replies"])
+        for stage_info in flow.stages.values()
+        if "quick_replies" in stage_info
+    }
+    return IntentClassifier(stage_options)
+
+
+def llm_reply(question, fallback):
+    """A reply for the language model to write, with scripted text used if it can't"""
+    return {"content": fallback, "llm": {"question": question}}
+
+
+def guideline_reply(ctx, question, fallback=None):
+    """A language model reply grounded in the tenant's guidelines; the best passage is the scripted fallback"""
+    passages = ctx.guidelines.search(question) if ctx.guidelines is not None else []
+    if fallback is None:
+        if not passages:
+            fallback = f"That's a good question for your doctor or your community health worker {ctx.tenant['chw_name']}. Is there anything else I can help you with?"
+        else:
+            fallback = f"{passages[0]['text']} (From: {passages[0]['title']})"
+    reply = llm_reply(question, fallback)
+    reply["llm"]["passages"] = [{"title": p["title"], "heading": p["heading"], "text": p["text"]} for p in passages]
+    return reply
+
+
+def turn_context(ctx):
+    """The context for one turn, pinned to the current clinic directory snapshot"""
+    return ctx._replace(clinics=ctx.clinics.snapshot())
+
+
+# Questions that take several answers, finished with "Continue"
+MULTI_SELECT_STAGES = ("waiting_complaints", "waiting_chronic_conditions")
+
+def offer_continue(state):
+    """Add "Continue" to a multi-select question's replies once something is selected"""
+    if state.conv_stage not in MULTI_SELECT_STAGES or not state.quick_replies or "Continue" in state.quick_replies:
+        return
+    if state.user_profile.get("presenting_complaints") or state.user_profile.get("chronic_conditions"):
+        state.quick_replies.append("Continue")
+
+
+def start_conversation(state, ctx):
+    """Send the opening message for the current stage"""
+    ctx = turn_context(ctx)
+    update_conversation(state, ctx)
+    offer_continue(state)
+    log_stage(state, ctx, state.conv_stage)
+    track_patient(state, ctx)
+
+
+def respond(state, ctx, reply):
+    """Run one user turn: record the reply, then answer it or move to the next stage"""
+    ctx = turn_context(ctx)
+    # "Continue" finishes a multi-select question; it isn't shown as a message
+    if reply != "Continue":
+        state.messages.append({"role": "user", "content": reply})
+    stage = state.conv_stage
+    
+    response_message = process_user_response(state, ctx, reply)
+    ctx.flow.check_transition(stage, state.conv_stage)
+    if response_message:
+        if isinstance(response_message, dict):
+            state.messages.append({"role": "assistant", **response_message})
+        else:
+            state.messages.append({"role": "assistant", "content": response_message})
+        # Keep the options while the same question is still open (e.g. multi-select)
+        if state.conv_stage != stage:
+            state.quick_replies = []
+    else:
+        state.quick_replies = []
+        update_conversation(state, ctx)
+    offer_continue(state)
+    log_stage(state, ctx, state.conv_stage)
+    track_patient(state, ctx)
+
+
+def receive(state, ctx, provider, message_id, text):
+    """Run a turn for a provider message once; redelivered webhooks are dropped before the stage logic"""
+    if ctx.inbound is not None and ctx.inbound.seen(provider, message_id):
+        return False
+    try:
+        respond(state, ctx, text)
+    except Exception:
+        # The turn didn't happen, so a redelivery of this message must not be dropped
+        if ctx.inbound is not None:
+            ctx.inbound.forget(provider, message_id)
+        raise
+    return True
+
+
+# Helper functions for result messages
+def get_cervical_result_message(name, result, include_greeting=True, locale=DEFAULT_LOCALE, rules=None):
+    """Generate message for cervical screening results"""
+    rules = rules or get_screening_rules()
+    greeting = translate(locale, "Hello {name}, I'm contacting you about your cervical cancer screening results. ", name=name) if include_greeting else ""
+    
+    if result == "normal":
+        return greeting + translate(locale, "Your results are normal, which is great news! No abnormal cells were found. You should have your next screening in {interval}, depending on your age and risk factors.", interval=rules.interval("cervical"))
+    elif result == "abnormal_minor":
+        return greeting + translate(locale, "Your results show some minor abnormal cells (sometimes called ASCUS or CIN-1). This is quite common and often clears up on its own, but we recommend a follow-up appointment for monitoring in {follow_up}.", follow_up=rules.follow_up("cervical"))
+    elif result == "abnormal_serious":
+        return greeting + translate(locale, "Your results show some abnormal cells that require further evaluation (classified as CIN-2 or CIN-3). This is not cancer, but needs prompt follow-up. We need to schedule you for a colposcopy procedure for further examination.")
+    return ""
+
+def get_breast_result_message(name, result, include_greeting=True, locale=DEFAULT_LOCALE, rules=None):
+    """Generate message for breast screening results"""
+    rules = rules or get_screening_rules()
+    greeting = translate(locale, "Hello {name}, I'm contacting you about your breast cancer screening results. ", name=name) if include_greeting else ""
+    
+    if result == "normal":
+        return greeting + translate(locale, "Your mammogram results are normal. No suspicious areas were found. Based on your age and risk factors, your next mammogram should be in {interval}.", interval=rules.interval("breast"))
+    elif result == "abnormal":
+        return greeting + translate(locale, "Your mammogram shows an area that requires additional imaging. This is quite common and usually turns out to be normal tissue, but we need you to come back for some additional specialized mammogram images or possibly an ultrasound.")
+    return ""
+
+def get_cervical_result_replies(result):
+    """Generate quick reply options based on cervical results"""
+    if result == "normal":
+        return ["When is my next screening?", "Can I do anything to prevent cervical cancer?", "I understand, thank you"]
+    elif result == "abnormal_minor":
+        return ["Schedule follow-up", "What does this mean?", "What should I do differently?"]
+    elif result == "abnormal_serious":
+        return ["Schedule colposcopy", "Is this cancer?", "How urgent is this?"]
+    return []
+
+def get_breast_result_replies(result):
+    """Generate quick reply options based on breast results"""
+    if result == "normal":
+        return ["When is my next screening?", "Can I do anything to prevent breast cancer?", "I understand, thank you"]
+    elif result == "abnormal":
+        return ["Schedule follow-up imaging", "What does this mean?", "How urgent is this?"]
+    return []
+
+def get_comprehensive_result_replies(cervical_result, breast_result):
+    """Generate quick reply options for comprehensive screening results"""
+    replies = []
+    
+    # Add most important action items first
+    if cervical_result == "abnormal_serious":
+        replies.append("Schedule colposcopy")
+    elif breast_result == "abnormal":
+        replies.append("Schedule follow-up imaging")
+    elif cervical_result == "abnormal_minor":
+        replies.append("Schedule cervical follow-up")
+        
+    # Add understanding questions if there are abnormal results
+    if cervical_result != "normal" or breast_result != "normal":
+        replies.append("What do these results mean?")
+        replies.append("How urgent is this?")
+    else:
+        replies.append("When are my next screenings?")
+        replies.append("How can I stay healthy?")
+        
+    # Always include a confirmation option
+    replies.append("I understand, thank you")
+    
+    return replies
+
+def build_result_message(state, builder, name, locale=DEFAULT_LOCALE, rules=None):
+    """Build a results notification message from the session's test results"""
+    cervical_result = state.test_results.get("cervical", "normal")
+    breast_result = state.test_results.get("breast", "normal")
+    if builder == "cervical_results":
+        return get_cervical_result_message(name, cervical_result, locale=locale, rules=rules)
+    if builder == "breast_results":
+        return get_breast_result_message(name, breast_result, locale=locale, rules=rules)
+    return translate(locale, "Hello {name}, I'm reaching out regarding your recent screening results.", name=name) + f"\n\n{get_cervical_result_message(name, cervical_result, include_greeting=False, locale=locale, rules=rules)}\n\n{get_breast_result_message(name, breast_result, include_greeting=False, locale=locale, rules=rules)}"
+
+def build_result_replies(state, builder):
+    """Build quick replies for a results notification from the session's test results"""
+    cervical_result = state.test_results.get("cervical", "normal")
+    breast_result = state.test_results.get("breast", "normal")
+    if builder == "cervical_results":
+        return get_cervical_result_replies(cervical_result)
+    if builder == "breast_results":
+        return get_breast_result_replies(breast_result)
+    return get_comprehensive_result_replies(cervical_result, breast_result)
+
+def outbound_message(flow, tenant, stage, name="", test_results=None, locale=None):
+    """Text and quick replies of a stage that opens a conversation, for sending it outside the app"""
+    state = SessionState(test_results=dict(test_results or {}))
+    locale = locale or tenant["default_locale"]
+    stage_info = flow.stages[stage]
+    if "message_builder" in stage_info:
+        text = build_result_message(state, stage_info["message_builder"], name or "there", locale=locale,
+                                    rules=screening_rules_for(tenant))
+    else:
+        text = translate(locale, stage_info["message"], name=name or "there", chw_name=tenant["chw_name"], recommendations="")
+    if "quick_replies_builder" in stage_info:
+        return text, build_result_replies(state, stage_info["quick_replies_builder"])
+    return text, list(stage_info.get("quick_replies", ()))
+
+def log_event(state, ctx, kind, subject, detail=""):
+    """Append an event for the current session to the event log"""
+    ctx.events.record(state.session_id, kind, subject, detail)
+
+def no_slots_message(ctx):
+    """Reply when no clinic near the user has an open appointment"""
+    return f"I couldn't find an open appointment near you in the next few months. Please call the clinic directly, or your community health worker {ctx.tenant['chw_name']} can help you arrange it."
+
+CLINIC_LIST_SIZE = 5
+CLINIC_SEARCH_RADIUS_KM = 50
+
+def recommended_services(recommendations):
+    """Clinic services needed for a list of recommendations"""
+    services = []
+    for rec in recommendations:
+        if "annual wellness" in rec and "annual_checkup" not in services:
+            services.append("annual_checkup")
+        if "cervical" in rec and "cervical_cancer_screening" not in services:
+            services.append("cervical_cancer_screening")
+        if "breast" in rec and "breast_cancer_screening" not in services:
+            services.append("breast_cancer_screening")
+    return services
+
+def listed_price(clinic, service, currency):
+    """A clinic's price for a service, or a note that it isn't listed"""
+    price = clinic["cost"].get(service)
+    return f"{currency}{price}" if price is not None else "price not listed"
+
+def treatment_offer(clinic, currency):
+    """A clinic's name and treatment price (when listed) for a results message"""
+    price = clinic["cost"].get("treatment")
+    offer = f"<span class='clinic-link'>{clinic['name']}</span>"
+    return f"{offer}, and the price is {currency}{price}" if price is not None else offer
+
+def wait_days_for(ctx, clinic, services, centre):
+    """Days until a clinic can see the user for every needed service (None if it can't)"""
+    wait = 0
+    for service in services:
+        slot = ctx.slots.earliest_slot(service, *centre, clinics=[(0, clinic)])
+        if slot is None:
+            return None
+        wait = max(wait, (slot.start.date() - datetime.now().date()).days)
+    return wait
+
+def book_follow_up(state, ctx, service, after=None):
+    """Book the earliest open slot near the user for a service, reusing an existing booking"""
+    if service in state.appointments:
+        return state.appointments[service]
+    location = state.user_profile.get("current_location", ctx.tenant["default_city"])
+    booking = ctx.slots.book_earliest(state.session_id, service, location, after=after)
+    if booking is None:
+        return None
+    state.appointments[service] = booking
+    state.follow_up_scheduled = True
+    start = booking.slot.start
+    state.next_appointment_date = f"{start:%B} {start.day}, {start.year}, {start.hour % 12 or 12}:{start:%M} {start:%p}"
+    return booking
+
+def log_stage(state, ctx, stage):
+    """Record a stage change, skipping repeats of the last logged stage"""
+    if stage != state.last_logged_stage:
+        log_event(state, ctx, STAGE, stage, state.last_logged_stage or "")
+        state.last_logged_stage = stage
+
+def track_patient(state, ctx):
+    """Update the patient's row in the CHW caseload and their screening due dates"""
+    if ctx.caseload is not None:
+        starts = [booking.slot.start for booking in state.appointments.values()]
+        ctx.caseload.update(
+            ctx.tenant["id"], state.session_id, state.user_profile.get("name", ""), state.conv_stage,
+            len(state.recommendations), result_severity(state.test_results),
+            min(starts).timestamp() if starts else None,
+        )
+    if ctx.due_dates is not None:
+        booked = {service: booking.slot.start.timestamp() for service, booking in state.appointments.items()}
+        due = screening_rules_for(ctx.tenant).next_due(state.user_profile, state.test_results, booked, time.time())
+        ctx.due_dates.update(ctx.tenant["id"], state.session_id, due)
+
+# Function to determine the assessment path based on age and risk factors
+def determine_assessment_path(age, initial_response=None):
+    """
+    Determines which questions to ask based on age and initial responses
+    """
+    # Basic path for all women
+    basic_path = ["ask_age", "ask_marital_status", "ask_education", "ask_annual_checkup"]
+    
+    # Add reproductive health questions for women of reproductive age (under 50)
+    if age < 50:
+        basic_path.extend(["ask_menstrual_regularity", "ask_pregnancies", "ask_contraceptive"])
+    
+    # Always ask about complaints
+    basic_path.append("ask_complaints")
+    
+    # Add screening questions based on age
+    if age >= 30:
+        basic_path.append("ask_cervical_screening")
+    
+    if age >= 40:
+        basic_path.append("ask_breast_screening")
+    
+    # Add family history and risk factors for all
+    basic_path.extend(["ask_family_history", "ask_chronic_conditions"])
+    
+    # Add lifestyle questions
+    basic_path.extend(["ask_lifestyle", "ask_alcohol", "ask_physical_activity"])
+    
+    # End with recommendation
+    basic_path.append("provide_recommendation")
+    
+    return basic_path
+
+def screening_rules_for(tenant):
+    """The compiled screening rule pack for a tenant's guidelines"""
+    return get_screening_rules(tenant["guideline_rules"])
+
+# Function to determine health recommendations based on user profile
+def recommendations_for(user_profile, rules=None):
+    """
+    Analyzes user profile to provide appropriate health recommendations
+    under a screening rule pack (the default one if not given)
+    """
+    return (rules or get_screening_rules()).recommendations(user_profile)
+
+def determine_recommendations(state, ctx):
+    """Work out the user's recommendations, saving and logging them"""
+    recommendations = recommendations_for(state.user_profile, screening_rules_for(ctx.tenant))
+    
+    # Save recommendations for later use
+    state.recommendations = recommendations
+    ctx.events.record_many(state.session_id, [(RECOMMENDATION, rec, "") for rec in recommendations])
+    
+    return recommendations
+
+# Function to format recommendations as text
+def format_recommendations(recommendations):
+    if not recommendations:
+        return "continuing with your current health routine"
+    
+    if len(recommendations) == 1:
+        return recommendations[0]
+    elif len(recommendations) == 2:
+        return f"{recommendations[0]} and {recommendations[1]}"
+    else:
+        return f"{', '.join(recommendations[:-1])}, and {recommendations[-1]}"
+
+def stage_after_education(state):
+    """Reproductive health questions when they are on the assessment path, otherwise health concerns"""
+    if "ask_menstrual_regularity" in state.assessment_path:
+        return "ask_menstrual_regularity"
+    return "ask_complaints"
+
+# Function to update conversation stage and send the next message
+def update_conversation(state, ctx):
+    """Run the current stage, following the flow's fallbacks, and check every move against the flow"""
+    while True:
+        stage = state.conv_stage
+        fell_back = update_stage(state, ctx)
+        ctx.flow.check_transition(stage, state.conv_stage)
+        if not fell_back:
+            return
+
+def update_stage(state, ctx):
+    """One step of update_conversation; True when it fell back to another stage to run next"""
+    current_stage = state.conv_stage
+    log_stage(state, ctx, current_stage)
+    
+    # If no name is set, use a default
+    name = state.user_profile["name"]
+    if not name:
+        name = "there"
+    locale = state.user_profile.get("locale", DEFAULT_LOCALE)
+    
+    # Check if we're in the assessment flow
+    if current_stage in ctx.flow.stages:
+        stage_info = ctx.flow.stages[current_stage]
+        
+        if "message_builder" in stage_info:
+            message = build_result_message(state, stage_info["message_builder"], name, locale=locale,
+                                           rules=screening_rules_for(ctx.tenant))
+        else:
+            # Recommendations are only worked out for messages that show them
+            formatted_recs = ""
+            if "{recommendations}" in stage_info["message"]:
+                recommendations = determine_recommendations(state, ctx)
+                formatted_recs = format_recommendations(recommendations)
+            message = translate(locale, stage_info["message"], name=name, chw_name=ctx.tenant["chw_name"], recommendations=formatted_recs)
+            
+        state.messages.append({"role": "assistant", "content": message})
+        state.conv_stage = stage_info["next_stage"]
+        
+        if "quick_replies_builder" in stage_info:
+            state.quick_replies = build_result_replies(state, stage_info["quick_replies_builder"])
+        elif "quick_replies" in stage_info:
+            state.quick_replies = list(stage_info["quick_replies"])
+        
+        return
+    
+    # Handle showing clinic information
+    elif current_stage == "waiting_clinic_info" and state.show_clinic_info:
+        location = state.user_profile["current_location"]
+        currency = ctx.tenant["currency_symbol"]
+        
+        # Rank nearby clinics by total cost, distance and appointment wait for the recommended services
+        needed_services = recommended_services(state.recommendations)
+        centre = ctx.clinics.city_centre(location)
+        ranked = []
+        if centre:
+            ranked = ctx.clinics.ranker().rank(
+                {**{service: 1 for service in needed_services}, "treatment": POSSIBLE_TREATMENT_WEIGHT},
+                *centre,
+                k=CLINIC_LIST_SIZE,
+                max_km=CLINIC_SEARCH_RADIUS_KM,
+                weights=ctx.tenant.get("ranking_weights"),
+                wait_days=lambda clinic: wait_days_for(ctx, clinic, needed_services, centre)
+            )
+        
+        if ranked:
+            message = f"Here are the best clinics near {location} for the services you need, ranked by cost, distance and waiting time:\n\n"
+            
+            for i, entry in enumerate(ranked, 1):
+                clinic = entry["clinic"]
+                services = []
+                costs = []
+                
+                for rec in state.recommendations:
+                    if "annual wellness" in rec:
+                        services.append("annual wellness exam")
+                        costs.append(listed_price(clinic, 'annual_checkup', currency))
+                    if "cervical" in rec:
+                        services.append("cervical cancer screening")
+                        costs.append(listed_price(clinic, 'cervical_cancer_screening', currency))
+                    if "breast" in rec:
+                        services.append("breast cancer screening")
+                        costs.append(listed_price(clinic, 'breast_cancer_screening', currency))
+                
+                message += f"<span class='clinic-link'>{i}. {clinic['name']}</span>\n"
+                message += f"   Address: {clinic['address']}\n"
+                message += f"   Phone: {clinic['phone']}\n"
+                
+                if services:
+                    message += f"   Services: {', '.join(services)}\n"
+                if costs:
+                    message += f"   Costs: {', '.join(costs)}\n"
+                message += f"   Distance: about {entry['distance_km']} km\n"
+                if entry["wait_days"] is not None:
+                    message += f"   Next opening: in {entry['wait_days']} day(s)\n"
+                
+                if clinic['notes']:
+                    message += f"   Note: {clinic['notes']}\n"
+                
+                message += "\n"
+            
+            message += "Would you like me to explain more about why these screenings are important and what to expect?"
+            
+            state.messages.append({"role": "assistant", "content": message})
+            state.conv_stage = "waiting_screening_info"
+            state.quick_replies = ["Yes, tell me more", "No, thank you", "I have questions"]
+            return
+        else:
+            message = f"{name}, I don't have clinic information for your area. Please contact your local community health worker for assistance."
+            state.messages.append({"role": "assistant", "content": message})
+            state.conv_stage = "end"
+            return
+    
+    # Provide screening information
+    elif current_stage == "waiting_screening_info" and state.messages[-1]["role"] == "user" and "yes" in state.messages[-1]["content"].lower():
+        message = "Here's what to expect for each screening:\n\n"
+        
+        for rec in state.recommendations:
+            if "annual wellness" in rec:
+                message += "<span class='emphasis'>Annual Wellness Exam:</span> This is a check-up where the doctor will measure your blood pressure, weight, and ask about your overall health. They might do a basic physical examination. It typically takes 30-45 minutes.\n\n"
+            
+            if "cervical" in rec:
+                message += "<span class='emphasis'>Cervical Cancer Screening:</span> This involves either a Pap smear or HPV test where the doctor collects a small sample of cells from your cervix. It only takes a few minutes and may cause mild discomfort but not pain. You'll lie on an exam table with your feet in stirrups, and the doctor will use a speculum to examine your cervix.\n\n"
+            
+            if "breast" in rec:
+                message += "<span class='emphasis'>Breast Cancer Screening:</span> This usually means a mammogram, which is an X-ray of your breast tissue. You'll stand in front of the mammogram machine, and each breast will be compressed between two plates for a few seconds to take the image. Some women find it uncomfortable but it's quick.\n\n"
+        
+        message += "These screenings are important because they can detect health issues before you have symptoms, when they're easier to treat. Early detection saves lives, especially with cancers.\n\n"
+        message += "Do you have any specific questions about these procedures?"
+        
+        state.messages.append({"role": "assistant", "content": message})
+        state.conv_stage = "answer_screening_questions"
+        state.quick_replies = ["How long will it take?", "Will it hurt?", "What should I wear?", "No, I'm ready to schedule"]
+        return
+    
+    # End of conversation
+    elif current_stage == "end":
+        message = f"Thank you for using the Women's Health Navigator, {name}. Remember that preventative health care is important. Your community health worker {ctx.tenant['chw_name']} is always available if you need further assistance. Stay healthy!"
+        state.messages.append({"role": "assistant", "content": message})
+        state.quick_replies = ["Start over", "Goodbye"]
+        return
+    
+    # Test results follow-up demo
+    elif current_stage == "test_results_followup":
+        # Name a clinic from this region's directory; some regions list none
+        clinics = ctx.clinics.clinics_for(ctx.tenant["default_city"])[:1]
+        sender = f"{clinics[0]['name']} notified me" if clinics else "your clinic let me know"
+        message = f"{name}, {sender} that your cervical cancer results came back and require follow-up, that may include treatment. The doctor requested you come back for another appointment. Do you need help scheduling? What questions do you have?"
+        state.messages.append({"role": "assistant", "content": message})
+        state.conv_stage = "waiting_results_response"
+        state.quick_replies = ["I need help scheduling", "What does this mean?", "How much will it cost?"]
+        return
+    
+    # Handle results questions
+    elif current_stage == "answer_results_questions":
+        # Up to two clinics; a region may list fewer
+        clinics = ctx.clinics.clinics_for(ctx.tenant["default_city"])[:2]
+        currency = ctx.tenant["currency_symbol"]
+        if clinics:
+            options = ", or you can go to ".join(treatment_offer(clinic, currency) for clinic in clinics)
+            where = f"You can go to {options} if you do need treatment."
+        else:
+            where = f"Your community health worker {ctx.tenant['chw_name']} can tell you which clinic near you offers treatment."
+        
+        message = f"First, you need to go back to clinic to discuss your results. Your doctor may give you some simple antibiotic pills if it's an infection, or do some more tests or treatment for cervical cancer. {where} Do you want to learn more about what to expect from your results meeting and what treatment could mean?"
+        
+        state.messages.append({"role": "assistant", "content": message})
+        state.conv_stage = "waiting_treatment_questions"
+        state.quick_replies = ["Yes, tell me more", f"I'm not in {ctx.tenant['default_city']} anymore", "I can't afford this"]
+        return
+    
+    # Handle location change
+    elif current_stage == "handle_location_change":
+        location = state.user_profile["current_location"]
+        alternate_clinics = ctx.clinics.clinics_for(location)
+        if alternate_clinics:
+            alternate_clinic = alternate_clinics[0]
+            price = alternate_clinic["cost"].get("treatment")
+            their_price = f", their price is {ctx.tenant['currency_symbol']}{price}" if price is not None else ""
+            message = f"Got it. In that case, I suggest you go to <span class='clinic-link'>{alternate_clinic['name']}</span>{their_price}. Note there are fewer clinics in this area so it's more expensive, and the time to get an appointment can be longer."
+        else:
+            message = f"Got it. I don't have a clinic listed in {location} yet. Your community health worker {ctx.tenant['chw_name']} can help you find one nearby that offers treatment."
+        
+        state.messages.append({"role": "assistant", "content": message})
+        state.conv_stage = "post_location_change"
+        state.quick_replies = ["Thanks, I'll call them", "Can I get financial assistance?", "How urgent is this?"]
+        return
+    
+    # Nothing above handled this turn: follow the flow's fallback rather than leave the user waiting
+    fallback = ctx.flow.fallback(current_stage)
+    if fallback:
+        state.conv_stage = fallback
+        return True
+
+# Process user response
+def process_user_response(state, ctx, response):
+    current_stage = state.conv_stage
+    # Log the answer, keeping free text out of the event log
+    log_event(state, ctx, ANSWER, current_stage, response if response in state.quick_replies else "free_text")
+    
+    # Process interest response
+    if current_stage == "ask_interest":
+        if response.lower() == "yes":
+            state.conv_stage = "ask_age"
+            state.assessment_path = determine_assessment_path(0)  # Will update after getting age
+        else:
+            state.conv_stage = "end"
+            return f"I understand. If you change your mind, your community health worker {ctx.tenant['chw_name']} can help you reconnect with me. Stay healthy!"
+    
+    # Process age response
+    elif current_stage == "waiting_age":
+        try:
+            # First check if it's one of our quick reply options
+            if response in ["25-30", "31-40", "41-50", "51+"]:
+                # Parse age range and use the lower bound
+                age = int(response.split("-")[0])
+                state.user_profile["age"] = age
+                # Determine assessment path based on age
+                state.assessment_path = determine_assessment_path(age)
+                state.conv_stage = "ask_marital_status"
+                return None
+            
+            # Otherwise try to extract numbers from the response
+            digits = ''.join(filter(str.isdigit, response))
+            if digits:
+                age = int(digits)
+                if 18 <= age <= 120:  # Reasonable age range
+                    state.user_profile["age"] = age
+                    # Determine assessment path based on age
+                    state.assessment_path = determine_assessment_path(age)
+                    state.conv_stage = "ask_marital_status"
+                    return None
+            
+            # If we got here, we couldn't parse the age but will still move on
+            state.user_profile["age"] = 35  # Default to middle age
+            state.assessment_path = determine_assessment_path(35)
+            state.conv_stage = "ask_marital_status"
+            return "I'm not sure I got your age correctly, but let's continue. I'll use an estimate for now. What is your marital status?"
+        except Exception as e:
+            # Shown in the app's sidebar
+            state.last_error = f"Error processing age: {str(e)}"
+            state.user_profile["age"] = 35  # Default to middle age
+            state.assessment_path = determine_assessment_path(35)
+            state.conv_stage = "ask_marital_status"
+            return "Let's move on to the next question. What is your marital status?"
+    
+    # Process marital status
+    elif current_stage == "waiting_marital_status":
+        # Direct matches for button clicks
+        if response in ["Single", "Married", "Widowed", "Divorced", "Skip"]:
+            if response == "Skip":
+                state.user_profile["marital_status"] = "Not specified"
+            else:
+                state.user_profile["marital_status"] = response
+            state.conv_stage = "ask_education"
+            return None
+            
+        # Allow for flexible matching of marital status
+        status_mapping = {
+            "single": "Single",
+            "never married": "Single",
+            "unmarried": "Single",
+            "married": "Married",
+            "widow": "Widowed", 
+            "widowed": "Widowed",
+            "divorce": "Divorced",
+            "divorced": "Divorced",
+            "separated": "Divorced"
+        }
+        
+        # Try to match their response to a known status
+        matched = False
+        for key, value in status_mapping.items():
+            if key in response.lower():
+                state.user_profile["marital_status"] = value
+                matched = True
+                break
+        
+        # If we couldn't match, or they want to skip, still move forward
+        if not matched:
+            if "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+                state.user_profile["marital_status"] = "Not specified"
+            else:
+                # Try keyword/fuzzy matching and the intent classifier, otherwise use their response directly
+                state.user_profile["marital_status"] = ctx.classifier.match("waiting_marital_status", response) or response
+        
+        # Always move forward
+        state.conv_stage = "ask_education"
+        return None
+    
+    # Process education level - more flexible
+    elif current_stage == "waiting_education":
+        # Direct matches for button clicks
+        if response in ["No formal education", "Primary", "Secondary", "Higher", "Skip"]:
+            if response == "Skip":
+                state.user_profile["education_level"] = "Not specified"
+            else:
+                state.user_profile["education_level"] = response
+            state.conv_stage = stage_after_education(state)
+            return None
+            
+        education_mapping = {
+            "no": "No formal education",
+            "none": "No formal education",
+            "primary": "Primary",
+            "elementary": "Primary",
+            "secondary": "Secondary",
+            "high school": "Secondary",
+            "higher": "Higher",
+            "college": "Higher",
+            "university": "Higher",
+            "graduate": "Higher"
+        }
+        
+        # Try to match their response to a known education level
+        matched = False
+        for key, value in education_mapping.items():
+            if key in response.lower():
+                state.user_profile["education_level"] = value
+                matched = True
+                break
+        
+        # If we couldn't match, still move forward
+        if not matched:
+            if "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+                state.user_profile["education_level"] = "Not specified"
+            else:
+                # Try keyword/fuzzy matching and the intent classifier, otherwise use their response directly
+                state.user_profile["education_level"] = ctx.classifier.match("waiting_education", response) or response
+        
+        # Always move forward
+        state.conv_stage = stage_after_education(state)
+        return None
+    
+    # Process menstrual regularity
+    elif current_stage == "waiting_menstrual_regularity":
+        # Direct matches for button clicks
+        if response in ["Regular", "Irregular", "Menopause", "Not applicable", "Skip"]:
+            if response == "Skip":
+                state.user_profile["menstrual_regularity"] = "Not specified"
+            else:
+                state.user_profile["menstrual_regularity"] = response
+            state.conv_stage = "ask_pregnancies"
+            return None
+            
+        regularity_mapping = {
+            "regular": "Regular",
+            "irregular": "Irregular",
+            "not regular": "Irregular",
+            "menopause": "Menopause",
+            "stopped": "Menopause",
+            "no period": "Menopause",
+            "not applicable": "Not applicable",
+            "n/a": "Not applicable",
+            "na": "Not applicable"
+        }
+        
+        # Try to match their response
+        matched = False
+        for key, value in regularity_mapping.items():
+            if key in response.lower():
+                state.user_profile["menstrual_regularity"] = value
+                matched = True
+                break
+        
+        # If we couldn't match, still move forward
+        if not matched:
+            if "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+                state.user_profile["menstrual_regularity"] = "Not specified"
+            else:
+                # Try keyword/fuzzy matching and the intent classifier, otherwise use their response
+                state.user_profile["menstrual_regularity"] = ctx.classifier.match("waiting_menstrual_regularity", response) or response
+        
+        # Always move forward
+        state.conv_stage = "ask_pregnancies"
+        return None
+    
+    # Process pregnancies
+    elif current_stage == "waiting_pregnancies":
+        # Direct matches for button clicks
+        if response in ["0", "1", "2", "3+", "Skip"]:
+            if response == "Skip":
+                state.user_profile["pregnancies"] = "Not specified"
+            else:
+                state.user_profile["pregnancies"] = response
+            state.conv_stage = "ask_contraceptive"
+            return None
+            
+        # Try to extract a number
+        digits = ''.join(filter(str.isdigit, response))
+        if digits:
+            state.user_profile["pregnancies"] = digits
+        elif "none" in response.lower() or "zero" in response.lower() or "0" in response:
+            state.user_profile["pregnancies"] = "0"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["pregnancies"] = "Not specified"
+        else:
+            # Default to some value to continue
+            state.user_profile["pregnancies"] = response
+        
+        # Always move forward
+        state.conv_stage = "ask_contraceptive"
+        return None
+    
+    # Process contraceptive method
+    elif current_stage == "waiting_contraceptive":
+        # Direct matches for button clicks
+        if response in ["None", "Oral Pills", "IUD", "Condoms", "Sterilization", "Other", "Skip"]:
+            if response == "Skip":
+                state.user_profile["contraceptive_method"] = "Not specified"
+            else:
+                state.user_profile["contraceptive_method"] = response
+            state.conv_stage = "ask_complaints"
+            return None
+            
+        contraceptive_mapping = {
+            "none": "None",
+            "no": "None",
+            "don't use": "None",
+            "do not use": "None",
+            "pill": "Oral Pills",
+            "oral": "Oral Pills",
+            "iud": "IUD",
+            "intrauterine": "IUD",
+            "condom": "Condoms",
+            "barrier": "Condoms",
+            "sterilization": "Sterilization",
+            "tubes tied": "Sterilization",
+            "tubal": "Sterilization",
+            "other": "Other"
+        }
+        
+        # Try to match their response
+        matched = False
+        for key, value in contraceptive_mapping.items():
+            if key in response.lower():
+                state.user_profile["contraceptive_method"] = value
+                matched = True
+                break
+        
+        # If we couldn't match, still move forward
+        if not matched:
+            if "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+                state.user_profile["contraceptive_method"] = "Not specified"
+            else:
+                # Try keyword/fuzzy matching and the intent classifier, otherwise use their response directly
+                state.user_profile["contraceptive_method"] = ctx.classifier.match("waiting_contraceptive", response) or response
+        
+        # Always move forward
+        state.conv_stage = "ask_complaints"
+        return None
+    
+    # Process complaints (can be multiple)
+    elif current_stage == "waiting_complaints":
+        # Handle continue command
+        if response.lower() == "continue":
+            # If they click continue, move to next question
+            if "ask_annual_checkup" in state.assessment_path:
+                state.conv_stage = "ask_annual_checkup"
+            elif "ask_cervical_screening" in state.assessment_path:
+                state.conv_stage = "ask_cervical_screening"
+            else:
+                state.conv_stage = "ask_family_history"
+            return None
+        
+        # Direct match for None button
+        if response == "None":
+            state.user_profile["presenting_complaints"] = []
+            if "ask_annual_checkup" in state.assessment_path:
+                state.conv_stage = "ask_annual_checkup"
+            elif "ask_cervical_screening" in state.assessment_path:
+                state.conv_stage = "ask_cervical_screening"
+            else:
+                state.conv_stage = "ask_family_history"
+            return None
+            
+        # Direct matches for other buttons
+        if response in ["Pelvic pain", "Vaginal discharge", "Irregular bleeding", "Pain during intercourse", "Urinary issues", "Other"]:
+            if response not in state.user_profile["presenting_complaints"]:
+                state.user_profile["presenting_complaints"].append(response)
+                concerns = ", ".join(state.user_profile["presenting_complaints"])
+                return f"I've noted your health concerns: {concerns}. Do you have any other concerns? Select another or say 'Continue' to proceed."
+            else:
+                return "You've already selected this concern. Do you have any others? Select another or say 'Continue' to proceed."
+                
+        complaint_mapping = {
+            "none": "None",
+            "no": "None",
+            "nothing": "None",
+            "pain": "Pelvic pain",
+            "pelvic pain": "Pelvic pain",
+            "cramps": "Pelvic pain",
+            "discharge": "Vaginal discharge",
+            "vaginal discharge": "Vaginal discharge",
+            "bleed": "Irregular bleeding",
+            "irregular bleeding": "Irregular bleeding",
+            "spotting": "Irregular bleeding",
+            "intercourse pain": "Pain during intercourse",
+            "sex pain": "Pain during intercourse",
+            "painful sex": "Pain during intercourse",
+            "urinary": "Urinary issues",
+            "urine": "Urinary issues",
+            "bladder": "Urinary issues",
+            "other": "Other"
+        }
+        
+        # Check for "None" first
+        if any(key in response.lower() for key in ["none", "no", "nothing", "healthy"]):
+            # If None is selected, clear any existing complaints
+            state.user_profile["presenting_complaints"] = []
+            # Move to next question
+            if "ask_annual_checkup" in state.assessment_path:
+                state.conv_stage = "ask_annual_checkup"
+            elif "ask_cervical_screening" in state.assessment_path:
+                state.conv_stage = "ask_cervical_screening"
+            else:
+                state.conv_stage = "ask_family_history"
+            return None
+            
+        # Try to match their response to a known complaint
+        matched = False
+        for key, value in complaint_mapping.items():
+            if key in response.lower() and value != "None":
+                if value not in state.user_profile["presenting_complaints"]:
+                    state.user_profile["presenting_complaints"].append(value)
+                    matched = True
+        
+        # Fall back to fuzzy matching and the intent classifier (e.g. "bleding", "sugar aur bp")
+        if not matched:
+            for value in ctx.classifier.match_all("waiting_complaints", response):
+                if value not in state.user_profile["presenting_complaints"]:
+                    state.user_profile["presenting_complaints"].append(value)
+                    matched = True
+        
+        if matched:
+            concerns = ", ".join(state.user_profile["presenting_complaints"])
+            return f"I've noted your health concerns: {concerns}. Do you have any other concerns? Select another or say 'Continue' to proceed."
+        else:
+            # If they mentioned something we don't recognize, just add it as "Other"
+            if "Other" not in state.user_profile["presenting_complaints"] and response.lower() not in ["skip", "prefer not", "next"]:
+                state.user_profile["presenting_complaints"].append("Other: " + response)
+                
+            # Provide option to continue
+            concerns = ", ".join(state.user_profile["presenting_complaints"])
+            if concerns:
+                return f"I've noted your health concerns: {concerns}. Do you have any other concerns? Select another or say 'Continue' to proceed."
+            else:
+                # If we couldn't match anything and they have no concerns yet, just move forward
+                if "ask_annual_checkup" in state.assessment_path:
+                    state.conv_stage = "ask_annual_checkup"
+                elif "ask_cervical_screening" in state.assessment_path:
+                    state.conv_stage = "ask_cervical_screening"
+                else:
+                    state.conv_stage = "ask_family_history"
+                return None
+    
+    # Process annual checkup response
+    elif current_stage == "waiting_annual_checkup":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "Not sure"]:
+            state.user_profile["annual_checkup"] = response
+            if "ask_cervical_screening" in state.assessment_path:
+                state.conv_stage = "ask_cervical_screening"
+            elif "ask_breast_screening" in state.assessment_path:
+                state.conv_stage = "ask_breast_screening" 
+            else:
+                state.conv_stage = "ask_family_history"
+            return None
+            
+        if response.lower() == "yes" or "had" in response.lower() or "done" in response.lower():
+            state.user_profile["annual_checkup"] = "Yes"
+        elif response.lower() == "no" or "haven't" in response.lower() or "have not" in response.lower():
+            state.user_profile["annual_checkup"] = "No"
+        elif "not sure" in response.lower() or "maybe" in response.lower() or "don't know" in response.lower():
+            state.user_profile["annual_checkup"] = "Not sure"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["annual_checkup"] = "Not specified"
+        else:
+            # Try keyword/fuzzy matching and the intent classifier, then default to Not sure if we can't categorize
+            state.user_profile["annual_checkup"] = ctx.classifier.match("waiting_annual_checkup", response) or "Not sure"
+        
+        # Always move to next question
+        if "ask_cervical_screening" in state.assessment_path:
+            state.conv_stage = "ask_cervical_screening"
+        elif "ask_breast_screening" in state.assessment_path:
+            state.conv_stage = "ask_breast_screening" 
+        else:
+            state.conv_stage = "ask_family_history"
+        return None
+    
+    # Process cervical screening response
+    elif current_stage == "waiting_cervical_screening":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "I don't know"]:
+            state.user_profile["cervical_screening"] = response
+            if "ask_breast_screening" in state.assessment_path:
+                state.conv_stage = "ask_breast_screening"
+            else:
+                state.conv_stage = "ask_family_history"
+            return None
+            
+        if response.lower() == "yes" or "had" in response.lower() or "done" in response.lower():
+            state.user_profile["cervical_screening"] = "Yes"
+        elif response.lower() == "no" or "haven't" in response.lower() or "have not" in response.lower():
+            state.user_profile["cervical_screening"] = "No"
+        elif "don't know" in response.lower() or "not sure" in response.lower() or "maybe" in response.lower():
+            state.user_profile["cervical_screening"] = "I don't know"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["cervical_screening"] = "Not specified"
+        else:
+            # Try keyword/fuzzy matching and the intent classifier, then default to I don't know if we can't categorize
+            state.user_profile["cervical_screening"] = ctx.classifier.match("waiting_cervical_screening", response) or "I don't know"
+        
+        # Always move to next question
+        if "ask_breast_screening" in state.assessment_path:
+            state.conv_stage = "ask_breast_screening"
+        else:
+            state.conv_stage = "ask_family_history"
+        return None
+    
+    # Process breast screening response
+    elif current_stage == "waiting_breast_screening":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "I don't know"]:
+            state.user_profile["breast_screening"] = response
+            state.conv_stage = "ask_family_history"
+            return None
+            
+        if response.lower() == "yes" or "had" in response.lower() or "done" in response.lower():
+            state.user_profile["breast_screening"] = "Yes"
+        elif response.lower() == "no" or "haven't" in response.lower() or "have not" in response.lower():
+            state.user_profile["breast_screening"] = "No"
+        elif "don't know" in response.lower() or "not sure" in response.lower() or "maybe" in response.lower():
+            state.user_profile["breast_screening"] = "I don't know"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["breast_screening"] = "Not specified"
+        else:
+            # Try keyword/fuzzy matching and the intent classifier, then default to I don't know if we can't categorize
+            state.user_profile["breast_screening"] = ctx.classifier.match("waiting_breast_screening", response) or "I don't know"
+        
+        # Always move to next question
+        state.conv_stage = "ask_family_history"
+        return None
+    
+    # Process family history
+    elif current_stage == "waiting_family_history":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "I don't know", "Skip"]:
+            if response == "Skip":
+                state.user_profile["family_history_cancer"] = "Not specified"
+            else:
+                state.user_profile["family_history_cancer"] = response
+            state.conv_stage = "ask_chronic_conditions"
+            return None
+            
+        if response.lower() == "yes" or "family" in response.lower() and "history" in response.lower() and not "no" in response.lower():
+            state.user_profile["family_history_cancer"] = "Yes"
+        elif response.lower() == "no" or "don't" in response.lower() and "have" in response.lower():
+            state.user_profile["family_history_cancer"] = "No"
+        elif "don't know" in response.lower() or "not sure" in response.lower() or "maybe" in response.lower() or "uncertain" in response.lower():
+            state.user_profile["family_history_cancer"] = "I don't know"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["family_history_cancer"] = "Not specified"
+        else:
+            # Fuzzy or classifier match (e.g. "haan", "nahi", "pata nahi"); if we can't categorize,
+            # assume they're trying to tell us something about family history
+            state.user_profile["family_history_cancer"] = (ctx.classifier.match("waiting_family_history", response)
+                                                           or "Yes - details: " + response)
+        
+        # Always move to next question
+        state.conv_stage = "ask_chronic_conditions"
+        return None
+    
+    # Process chronic conditions (can be multiple)
+    elif current_stage == "waiting_chronic_conditions":
+        # Handle continue command
+        if response.lower() == "continue":
+            state.conv_stage = "ask_lifestyle"
+            return None
+        
+        # Direct match for None button
+        if response == "None":
+            state.user_profile["chronic_conditions"] = []
+            state.conv_stage = "ask_lifestyle"
+            return None
+            
+        # Direct matches for other buttons
+        if response in ["Hypertension", "Diabetes", "Anemia", "Thyroid disorder", "STI/RTI", "Other"]:
+            if response not in state.user_profile["chronic_conditions"]:
+                state.user_profile["chronic_conditions"].append(response)
+                conditions = ", ".join(state.user_profile["chronic_conditions"])
+                return f"I've noted your conditions: {conditions}. Do you have any other conditions? Select another or say 'Continue' to proceed."
+            else:
+                return "You've already selected this condition. Do you have any others? Select another or say 'Continue' to proceed."
+            
+        condition_mapping = {
+            "none": "None",
+            "no": "None",
+            "nothing": "None",
+            "high blood pressure": "Hypertension",
+            "hypertension": "Hypertension",
+            "blood pressure": "Hypertension",
+            "sugar": "Diabetes",
+            "diabetes": "Diabetes",
+            "anemia": "Anemia",
+            "blood": "Anemia",
+            "iron": "Anemia",
+            "thyroid": "Thyroid disorder",
+            "sti": "STI/RTI",
+            "std": "STI/RTI",
+            "infection": "STI/RTI",
+            "reproductive": "STI/RTI",
+            "other": "Other"
+        }
+        
+        # Check for "None" first
+        if any(key in response.lower() for key in ["none", "no", "nothing", "healthy"]):
+            # If None is selected, clear any existing conditions
+            state.user_profile["chronic_conditions"] = []
+            state.conv_stage = "ask_lifestyle"
+            return None
+        
+        # Try to match their response to a known condition
+        matched = False
+        for key, value in condition_mapping.items():
+            if key in response.lower() and value != "None":
+                if value not in state.user_profile["chronic_conditions"]:
+                    state.user_profile["chronic_conditions"].append(value)
+                    matched = True
+        
+        # Fall back to fuzzy matching and the intent classifier (e.g. "bleding", "sugar aur bp")
+        if not matched:
+            for value in ctx.classifier.match_all("waiting_chronic_conditions", response):
+                if value not in state.user_profile["chronic_conditions"]:
+                    state.user_profile["chronic_conditions"].append(value)
+                    matched = True
+        
+        if matched:
+            conditions = ", ".join(state.user_profile["chronic_conditions"])
+            return f"I've noted your conditions: {conditions}. Do you have any other conditions? Select another or say 'Continue' to proceed."
+        else:
+            # If they mentioned something we don't recognize, just add it as "Other"
+            if "Other" not in state.user_profile["chronic_conditions"] and response.lower() not in ["skip", "prefer not", "next"]:
+                state.user_profile["chronic_conditions"].append("Other: " + response)
+                
+            # Provide option to continue
+            conditions = ", ".join(state.user_profile["chronic_conditions"])
+            if conditions:
+                return f"I've noted your conditions: {conditions}. Do you have any other conditions? Select another or say 'Continue' to proceed."
+            else:
+                # If we couldn't match anything and they have no conditions yet, just move forward
+                state.conv_stage = "ask_lifestyle"
+                return None
+    
+    # Process tobacco use
+    elif current_stage == "waiting_tobacco":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "Skip"]:
+            if response == "Skip":
+                state.user_profile["tobacco_use"] = "Not specified"
+            else:
+                state.user_profile["tobacco_use"] = response
+            state.conv_stage = "ask_alcohol"
+            return None
+            
+        if response.lower() == "yes" or "smoke" in response.lower() or "use tobacco" in response.lower():
+            state.user_profile["tobacco_use"] = "Yes"
+        elif response.lower() == "no" or "don't" in response.lower() or "do not" in response.lower():
+            state.user_profile["tobacco_use"] = "No"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["tobacco_use"] = "Not specified"
+        else:
+            # Try keyword/fuzzy matching and the intent classifier, then default to No if unclear
+            state.user_profile["tobacco_use"] = ctx.classifier.match("waiting_tobacco", response) or "No"
+        
+        # Always move to next question
+        state.conv_stage = "ask_alcohol"
+        return None
+    
+    # Process alcohol use
+    elif current_stage == "waiting_alcohol":
+        # Direct matches for buttons
+        if response in ["Yes", "No", "Skip"]:
+            if response == "Skip":
+                state.user_profile["alcohol_use"] = "Not specified"
+            else:
+                state.user_profile["alcohol_use"] = response
+            state.conv_stage = "ask_physical_activity"
+            return None
+            
+        if response.lower() == "yes" or "drink" in response.lower() or "alcohol" in response.lower() and not "don't" in response.lower():
+            state.user_profile["alcohol_use"] = "Yes"
+        elif response.lower() == "no" or "don't" in response.lower() or "do not" in response.lower():
+            state.user_profile["alcohol_use"] = "No"
+        elif "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+            state.user_profile["alcohol_use"] = "Not specified"
+        else:
+            # Try keyword/fuzzy matching and the intent classifier, then default to No if unclear
+            state.user_profile["alcohol_use"] = ctx.classifier.match("waiting_alcohol", response) or "No"
+        
+        # Always move to next question
+        state.conv_stage = "ask_physical_activity"
+        return None
+    
+    # Process physical activity
+    elif current_stage == "waiting_physical_activity":
+        # Direct matches for buttons
+        if response in ["Very active", "Moderately active", "Lightly active", "Sedentary", "Skip"]:
+            if response == "Skip":
+                state.user_profile["physical_activity"] = "Not specified"
+            else:
+                state.user_profile["physical_activity"] = response
+            state.conv_stage = "provide_recommendation"
+            return None
+            
+        activity_mapping = {
+            "very active": "Very active",
+            "very": "Very active",
+            "lot": "Very active",
+            "athlete": "Very active",
+            "moderate": "Moderately active",
+            "moderately": "Moderately active",
+            "some": "Moderately active",
+            "light": "Lightly active",
+            "lightly": "Lightly active",
+            "little": "Lightly active",
+            "not much": "Lightly active",
+            "sedentary": "Sedentary",
+            "none": "Sedentary",
+            "no": "Sedentary",
+            "don't": "Sedentary",
+            "sit": "Sedentary"
+        }
+        
+        # Try to match their response
+        matched = False
+        for key, value in activity_mapping.items():
+            if key in response.lower():
+                state.user_profile["physical_activity"] = value
+                matched = True
+                break
+        
+        # If we couldn't match, still move forward
+        if not matched:
+            if "skip" in response.lower() or "prefer not" in response.lower() or "next" in response.lower():
+                state.user_profile["physical_activity"] = "Not specified"
+            else:
+                # Try keyword/fuzzy matching and the intent classifier, default to moderately active if unclear
+                state.user_profile["physical_activity"] = ctx.classifier.match("waiting_physical_activity", response) or "Moderately active"
+        
+        # Always move to recommendation
+        state.conv_stage = "provide_recommendation"
+        return None
+    
+    # Process clinic info response
+    elif current_stage == "waiting_clinic_info":
+        if "yes" in response.lower() or "show" in response.lower():
+            state.show_clinic_info = True
+        else:
+            message = "No problem. If you'd like clinic information in the future, just ask. Is there anything else I can help you with today?"
+            state.conv_stage = "end"
+            return message
+    
+    # Process post-visit annual wellness feedback
+    elif current_stage == "waiting_annual_feedback":
+        if "question" in response.lower():
+            return "What questions do you have about your visit? I'm happy to explain any part of the examination or advice you received."
+        elif "when" in response.lower() or "come back" in response.lower():
+            rules = screening_rules_for(ctx.tenant)
+            return f"Based on your current health status, we recommend you have your next annual wellness exam in {rules.interval('annual')}. I'll send you a reminder when it's time. {rules.advice['cervical']} {rules.advice['breast']} Is there anything else you'd like to know?"
+        else:
+            state.conv_stage = "end"
+            return "I'm glad everything is clear! Remember that your annual wellness exam is an important part of maintaining your health. I'll be in touch in about a year to remind you about your next checkup. Feel free to reach out if you have any health questions before then!"
+    
+    # Process post-visit cervical screening feedback
+    elif current_stage == "waiting_cervical_feedback":
+        if "how" in response.lower() and "result" in response.lower():
+            return "Your clinic will contact you when the results are ready, usually in 3-4 weeks. If they haven't contacted you after 4 weeks, you can call them directly. I'll also follow up with you once I receive information about your results. Would you like me to remind you in 3 weeks if you haven't heard anything?"
+        elif "what" in response.lower() and "result" in response.lower():
+            return "Your results will typically fall into one of three categories: normal (no abnormal cells found), minor abnormalities (often referred to as ASCUS or CIN-1, which may resolve on their own), or more significant abnormalities that require follow-up (CIN-2 or CIN-3). The majority of results are normal. Even with abnormal results, it rarely means cancer - it often just means some cells need monitoring or treatment to prevent potential future problems. Do you have any other questions?"
+        else:
+            # Set up for the results notification in 3-4 weeks
+            state.conv_stage = "cervical_results_notification"
+            return "Great! I'll follow up with you in about 3-4 weeks with your results. In the meantime, if you have any concerns or questions, feel free to reach out to me or your healthcare provider."
+    
+    # Process post-visit comprehensive screening feedback
+    elif current_stage == "waiting_comprehensive_feedback":
+        if "how" in response.lower() and "result" in response.lower():
+            return "Your clinic will contact you when the results are ready, usually in 3-4 weeks. For both the cervical cancer screening and mammogram results. If they haven't contacted you after 4 weeks, you can call them directly. I'll also follow up with you once I receive information about your results. Would you like me to remind you in 3 weeks if you haven't heard anything?"
+        elif "what" in response.lower() and "result" in response.lower():
+            return "For your cervical screening, results will typically be normal, minor abnormalities that may resolve on their own, or more significant abnormalities requiring follow-up. For your mammogram, results will either be normal or require additional imaging. The majority of results are normal for both tests. Even with abnormal results, it rarely means cancer - it often just means additional evaluation is needed. Do you have any other questions?"
+        else:
+            # Set up for the results notification in 3-4 weeks
+            state.conv_stage = "comprehensive_results_notification"
+            return "Great! I'll follow up with you in about 3-4 weeks with your results for both screenings. In the meantime, if you have any concerns or questions, feel free to reach out to me or your healthcare provider."
+    
+    # Process cervical results response
+    elif current_stage == "waiting_cervical_results_response":
+        cervical_result = state.test_results.get("cervical", "normal")
+        
+        if "schedule" in response.lower():
+            if cervical_result == "abnormal_minor":
+                # Monitoring visit at the guideline's follow-up interval
+                after = datetime.now() + timedelta(days=screening_rules_for(ctx.tenant).follow_up_days("cervical"))
+                booking = book_follow_up(state, ctx, "cervical_cancer_screening", after=after)
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your follow-up appointment for {state.next_appointment_date} at {booking.slot.clinic_name}. This will be a simple check-up to see if the minor abnormal cells have resolved on their own, which they often do. Would you like a reminder a few days before the appointment?"
+            elif cervical_result == "abnormal_serious":
+                booking = book_follow_up(state, ctx, "cervical_cancer_screening")
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your colposcopy for {state.next_appointment_date} at {booking.slot.clinic_name}. This procedure allows the doctor to examine your cervix more closely. It's similar to your screening but with a special magnifying device. The doctor may take a small tissue sample (biopsy) if needed. Would you like me to explain more about what to expect during this procedure?"
+        # Prevention questions mention cancer too, so they are matched first
+        elif "prevent" in response.lower() or "healthy" in response.lower():
+            return guideline_reply(ctx, response)
+        elif "cancer" in response.lower() or "mean" in response.lower():
+            if cervical_result == "abnormal_minor":
+                return "Having minor abnormal cells (ASCUS or CIN-1) is quite common and doesn't mean you have cancer. These cellular changes are often caused by temporary HPV infections that your body clears naturally over time. The follow-up is to monitor and make sure they resolve, which they do in most cases. This is why we do screenings - to catch any changes early when they're easy to monitor or treat."
+            elif cervical_result == "abnormal_serious":
+                return "Having abnormal cells classified as CIN-2 or CIN-3 doesn't mean you have cancer, but it does indicate more significant cellular changes that require closer examination and possibly treatment. These cells have a higher chance of developing into cancer over time if left untreated, which is why prompt follow-up is important. The good news is that when caught at this stage, treatment is usually very effective at preventing cancer from developing."
+            else:
+                return "Your normal results mean no abnormal cells were detected in your cervical screening sample. This is good news and means your risk of cervical cancer is very low at this time. Regular screenings are still important to maintain this low risk by catching any future changes early."
+        elif "urgent" in response.lower():
+            if cervical_result == "abnormal_minor":
+                return "This is not urgent. Minor cell changes often resolve on their own within 6-12 months. The follow-up is precautionary to ensure the changes don't progress. There's no need to worry, but it is important to keep your follow-up appointment."
+            elif cervical_result == "abnormal_serious":
+                return "While this isn't an emergency, it is important to have the colposcopy within the next few weeks. These cell changes can potentially develop into cancer over time (usually years), but prompt evaluation and treatment is very effective at preventing this progression. The appointment I've scheduled for you is within the recommended timeframe."
+        else:
+            state.conv_stage = "end"
+            if cervical_result == "normal":
+                return f"I'm glad I could share this good news with you! Continue with your regular health practices, and I'll be in touch when it's time for your next screening in {screening_rules_for(ctx.tenant).interval('cervical')}. Feel free to contact me if you have any health questions in the meantime."
+            else:
+                return "I understand. Remember that these screenings are effective at finding changes early when they're most treatable. I'll send you a reminder before your upcoming appointment. If you have any other questions or concerns before then, please don't hesitate to reach out."
+    
+    # Process breast results response
+    elif current_stage == "waiting_breast_results_response":
+        breast_result = state.test_results.get("breast", "normal")
+        
+        if "schedule" in response.lower():
+            if breast_result == "abnormal":
+                booking = book_follow_up(state, ctx, "breast_cancer_screening")
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your follow-up imaging for {state.next_appointment_date} at {booking.slot.clinic_name}. This will include additional mammogram views and possibly an ultrasound to get a better look at the area in question. These additional images help the radiologist determine if what they're seeing is normal breast tissue or something that needs further evaluation. Would you like more information about what to expect?"
+        elif "mean" in response.lower():
+            if breast_result == "abnormal":
+                return "An abnormal mammogram simply means the radiologist saw an area that needs a closer look. This is quite common and happens in about 10% of mammograms. In most cases (over 80%), the follow-up imaging shows normal breast tissue. The initial screening mammogram takes general images, while the follow-up can focus specifically on areas of interest with specialized techniques. This is a normal part of the screening process for many women."
+            else:
+                return "Your normal results mean the radiologist did not see any areas of concern in your breast tissue. This is good news and means your risk of breast cancer is low at this time. Regular screenings are still important as they help catch any future changes early."
+        elif "urgent" in response.lower():
+            if breast_result == "abnormal":
+                return "This is not urgent, but it is important to complete the follow-up imaging within the next few weeks. The vast majority of follow-up imaging shows normal results, but it's an important step to ensure nothing is missed. The appointment I've scheduled for you is within the recommended timeframe."
+        elif "prevent" in response.lower() or "healthy" in response.lower():
+            return guideline_reply(ctx, response)
+        else:
+            state.conv_stage = "end"
+            if breast_result == "normal":
+                return f"I'm glad I could share this good news with you! Continue with your regular health practices, and I'll be in touch when it's time for your next mammogram in {screening_rules_for(ctx.tenant).interval('breast')}. Feel free to contact me if you have any health questions in the meantime."
+            else:
+                return "I understand. Remember that these follow-up images are a normal part of the screening process for many women and usually show normal results. I'll send you a reminder before your upcoming appointment. If you have any other questions or concerns before then, please don't hesitate to reach out."
+    
+    # Process comprehensive results response
+    elif current_stage == "waiting_comprehensive_results_response":
+        cervical_result = state.test_results.get("cervical", "normal")
+        breast_result = state.test_results.get("breast", "normal")
+        
+        if "schedule" in response.lower():
+            # Prioritize the more serious follow-up
+            if "colposcopy" in response.lower() or cervical_result == "abnormal_serious":
+                booking = book_follow_up(state, ctx, "cervical_cancer_screening")
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your colposcopy for {state.next_appointment_date} at {booking.slot.clinic_name}. This procedure allows the doctor to examine your cervix more closely. " + (f"We'll also schedule your breast imaging follow-up separately." if breast_result == "abnormal" else "") + " Would you like me to explain more about what to expect during the colposcopy?"
+            elif "imaging" in response.lower() or breast_result == "abnormal":
+                booking = book_follow_up(state, ctx, "breast_cancer_screening")
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your follow-up breast imaging for {state.next_appointment_date} at {booking.slot.clinic_name}. This will include additional mammogram views and possibly an ultrasound. " + (f"We'll also schedule your cervical follow-up separately." if cervical_result == "abnormal_minor" else "") + " Would you like more information about what to expect?"
+            elif cervical_result == "abnormal_minor":
+                # Monitoring visit at the guideline's follow-up interval
+                after = datetime.now() + timedelta(days=screening_rules_for(ctx.tenant).follow_up_days("cervical"))
+                booking = book_follow_up(state, ctx, "cervical_cancer_screening", after=after)
+                if booking is None:
+                    return no_slots_message(ctx)
+                log_event(state, ctx, SCHEDULED, current_stage)
+                return f"I've scheduled your cervical follow-up appointment for {state.next_appointment_date} at {booking.slot.clinic_name}. This will be a simple check-up to see if the minor abnormal cells have resolved on their own, which they often do. Would you like a reminder a few days before the appointment?"
+        elif "mean" in response.lower():
+            response_text = ""
+            if cervical_result != "normal":
+                if cervical_result == "abnormal_minor":
+                    response_text += "For your cervical screening, having minor abnormal cells (ASCUS or CIN-1) is quite common and doesn't mean you have cancer. These cellular changes are often caused by temporary HPV infections that your body clears naturally over time. The follow-up is to monitor and make sure they resolve, which they do in most cases.\n\n"
+                else:  # abnormal_serious
+                    response_text += "For your cervical screening, having abnormal cells classified as CIN-2 or CIN-3 doesn't mean you have cancer, but it does indicate more significant cellular changes that require closer examination and possibly treatment. These cells have a higher chance of developing into cancer over time if left untreated, which is why prompt follow-up is important.\n\n"
+            
+            if breast_result != "normal":
+                response_text += "For your mammogram, an abnormal result simply means the radiologist saw an area that needs a closer look. This is quite common and happens in about 10% of mammograms. In most cases (over 80%), the follow-up imaging shows normal breast tissue.\n\n"
+            
+            if response_text:
+                response_text += "These screenings are designed to catch changes early when they're easiest to address. Having follow-ups is a normal part of the screening process for many women."
+                return response_text
+            else:
+                return "Your results were normal for both screenings, which is excellent news! This means no abnormal cells were detected in your cervical screening and no areas of concern were found in your breast tissue. This indicates your risk for both cervical and breast cancer is low at this time."
+        elif "urgent" in response.lower():
+            if cervical_result == "abnormal_serious":
+                return "For your cervical screening results, while this isn't an emergency, it is important to have the colposcopy within the next few weeks. These cell changes can potentially develop into cancer over time (usually years), but prompt evaluation and treatment is very effective at preventing this progression."
+            elif breast_result == "abnormal":
+                return "For your mammogram, this is not urgent, but it is important to complete the follow-up imaging within the next few weeks. The vast majority of follow-up imaging shows normal results, but it's an important step to ensure nothing is missed."
+            elif cervical_result == "abnormal_minor":
+                return "For your cervical screening, this is not urgent. Minor cell changes often resolve on their own within 6-12 months. The follow-up is precautionary to ensure the changes don't progress. There's no need to worry, but it is important to keep your follow-up appointment."
+            else:
+                return "Since your results were normal, there's no urgency for follow-up testing. Just continue with your regular health practices."
+        elif "prevent" in response.lower() or "healthy" in response.lower():
+            return guideline_reply(ctx, response)
+        else:
+            state.conv_stage = "end"
+            if cervical_result == "normal" and breast_result == "normal":
+                rules = screening_rules_for(ctx.tenant)
+                return f"I'm glad I could share this good news with you! Continue with your regular health practices. I'll be in touch when it's time for your next screenings - cervical cancer screening in {rules.interval('cervical')} and breast cancer screening in {rules.interval('breast')}. Feel free to contact me if you have any health questions in the meantime."
+            else:
+                return "I understand. Remember that these screenings are effective at finding changes early when they're most treatable. I'll send you a reminder before your upcoming appointment(s). If you have any other questions or concerns before then, please don't hesitate to reach out."
+                
+    # Process results response
+    elif current_stage == "waiting_results_response":
+        state.conv_stage = "answer_results_questions"
+    
+    # Process treatment questions
+    elif current_stage == "waiting_treatment_questions":
+        if f"not in {ctx.tenant['default_city'].lower()}" in response.lower() or "location" in response.lower():
+            state.conv_stage = "handle_location_change"
+            # Demo: the region's configured alternate city (Pipili for Pune)
+            state.user_profile["current_location"] = ctx.tenant.get("alternate_city", ctx.tenant["default_city"])
+        else:
+            # Other questions are answered from the guidelines by the language model when one is configured
+            return guideline_reply(ctx, response, "I understand your concerns. The most important step is to go back to the clinic to understand your specific situation. The doctor will explain all options and costs based on your results. Would you like me to help schedule an appointment?")
+    
+    # No specific handling needed for other stages
+    return None
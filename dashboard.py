@@ -0,0 +1,82 @@
+# CHW dashboard: who needs follow-up in a region
+#
+# Run with "streamlit run dashboard.py" (?tenant=ghana for another region). Everything
+# shown comes from the caseload rows the navigator keeps current as conversations change.
+import time
+from datetime import datetime
+
+import streamlit as st
+
+from caseload import MINOR, SERIOUS, WORKLISTS, Caseload
+from outreach import CHW, LEVEL_NAMES, OutreachQueue
+from tenants import get_tenant, resolve_tenant
+
+SEVERITY_LABELS = {SERIOUS: "Needs prompt follow-up", MINOR: "Monitoring", 0: ""}
+
+st.set_page_config(page_title="CHW Dashboard", page_icon="💜", layout="wide")
+
+tenant = get_tenant(resolve_tenant(st.query_params.get("tenant")))
+
+@st.cache_resource
+def load_caseload():
+    """Open the shared caseload"""
+    return Caseload()
+
+caseload = load_caseload()
+
+@st.cache_resource
+def load_outreach_queue():
+    """Open the shared outreach queue"""
+    return OutreachQueue()
+
+outreach_queue = load_outreach_queue()
+
+def days_ago(timestamp, now):
+    return f"{(now - timestamp) / 86400:.0f} days ago"
+
+def patient_rows(patients, now):
+    """Table rows for a worklist"""
+    return [
+        {
+            "Patient": patient.name or patient.session[:8],
+            "Stage": patient.stage.replace("_", " "),
+            "Last reply": days_ago(patient.updated, now),
+            "Result": SEVERITY_LABELS.get(patient.severity, ""),
+            "Follow-up": datetime.fromtimestamp(patient.follow_up).strftime("%d %b %Y") if patient.follow_up else "",
+        }
+        for patient in patients
+    ]
+
+now = time.time()
+started = time.perf_counter()
+board = caseload.dashboard(tenant["id"], now=now)
+load_ms = (time.perf_counter() - started) * 1000
+
+st.title(f"Follow-up worklists for {tenant['chw_name']}")
+st.caption(f"{tenant['name']} · loaded in {load_ms:.0f} ms")
+
+# Calls and visits queued for the CHW, urgent results first
+tasks = outreach_queue.pending(tenant["id"], CHW, limit=20, now=now)
+if tasks:
+    st.subheader("Tasks")
+    for task in tasks:
+        done = st.checkbox(
+            f"{LEVEL_NAMES[task.level].capitalize()}: {task.stage.replace('_', ' ')} ({task.session[:8]}, queued {days_ago(task.waiting_since, now)})",
+            key=f"task-{task.item_id}",
+        )
+        if done:
+            outreach_queue.complete([task.item_id])
+
+columns = st.columns(len(WORKLISTS))
+for column, (name, title) in zip(columns, WORKLISTS.items()):
+    column.metric(title, board["counts"][name])
+
+for tab, (name, title) in zip(st.tabs(list(WORKLISTS.values())), WORKLISTS.items()):
+    with tab:
+        patients = board["worklists"][name]
+        if not patients:
+            st.write("Nobody on this list right now.")
+            continue
+        st.dataframe(patient_rows(patients, now), use_container_width=True, hide_index=True)
+        if board["counts"][name] > len(patients):
+            st.caption(f"Showing the {len(patients)} most pressing of {board['counts'][name]}")
@@ -0,0 +1,260 @@
+# Outbound message delivery
+#
+# The dispatcher drains the outreach queue into SMS/WhatsApp providers: items are
+# rendered into the opening message of their stage, grouped into provider-sized batches
+# and sent by a small thread pool. Each provider has a lane that caps batches in flight;
+# when the provider throttles, the lane halves its cap and pauses for the retry-after
+# time, and the dispatcher stops claiming work for it, so a campaign backs up in the
+# queue rather than flooding the provider. Failed sends go back to the queue with
+# exponential backoff; every item ends as sent (with the provider's id) or failed.
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from conversation import outbound_message
+from outreach import PATIENT
+
+DEFAULT_PROVIDER = "local"
+IDLE_POLL_SECONDS = 1.0
+
+
+class ProviderThrottled(Exception):
+    """Raised by a provider that is over its rate limit"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"throttled, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class ProviderError(Exception):
+    """Raised when a whole batch could not be handed to the provider"""
+
+
+class LocalProvider:
+    """Stand-in for an SMS gateway: a rate limit, a batch size limit and occasional failures"""
+
+    name = DEFAULT_PROVIDER
+    max_batch = 50
+    max_concurrency = 4
+
+    def __init__(self, rate_per_second=200, burst=400, failure_rate=0.01, latency_seconds=0.05, seed=None):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.failure_rate = failure_rate
+        self.latency_seconds = latency_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.delivered = {}  # provider message id -> (recipient, text)
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def send_batch(self, messages):
+        """Accept up to max_batch {"to", "text"} messages; returns (provider id or None, error) per message"""
+        if len(messages) > self.max_batch:
+            raise ProviderError(f"batch of {len(messages)} is over the limit of {self.max_batch}")
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate_per_second)
+            self.refilled = now
+            if self.tokens < len(messages):
+                self.throttled += 1
+                raise ProviderThrottled((len(messages) - self.tokens) / self.rate_per_second)
+            self.tokens -= len(messages)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency_seconds)
+            results = []
+            with self.lock:
+                for message in messages:
+                    if self.random.random() < self.failure_rate:
+                        results.append((None, "temporary network error"))
+                    else:
+                        provider_message_id = uuid.uuid4().hex
+                        self.delivered[provider_message_id] = (message["to"], message["text"])
+                        results.append((provider_message_id, None))
+            return results
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class ProviderLane:
+    """Batches in flight to one provider, with an adaptive cap and a pause while throttled"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.limit = provider.max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def free(self, now=None):
+        """Batches that may be started now"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return 0 if now < self.paused_until else max(self.limit - self.in_flight, 0)
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finished(self, throttled_for=None):
+        with self.lock:
+            self.in_flight -= 1
+            if throttled_for is not None:
+                # Back off hard, then creep back up one batch at a time
+                self.limit = max(1, self.limit // 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + throttled_for)
+            elif self.limit < self.provider.max_concurrency:
+                self.limit += 1
+
+
+class Dispatcher:
+    """Sends queued patient messages through their tenant's provider"""
+
+    def __init__(self, queue, providers, flow_registry, tenant_lookup):
+        self.queue = queue
+        self.providers = providers  # name -> provider
+        self.lanes = {name: ProviderLane(provider) for name, provider in providers.items()}
+        self.flow_registry = flow_registry
+        self.tenant_lookup = tenant_lookup
+        self.executor = ThreadPoolExecutor(max_workers=sum(p.max_concurrency for p in providers.values()))
+        self.idle = threading.Condition()
+        self.running = 0
+
+    def _lane_name(self, tenant):
+        return tenant.get("sms_provider", DEFAULT_PROVIDER)
+
+    def _render(self, item):
+        tenant = self.tenant_lookup(item.tenant)
+        flow = self.flow_registry.latest(tenant["flow"])
+        text, quick_replies = outbound_message(flow, tenant, item.stage, item.payload.get("name", ""),
+                                               item.payload, item.payload.get("locale"))
+        if quick_replies:
+            text += "\n\n" + " / ".join(quick_replies)
+        return {"to": item.payload.get("to", item.session), "text": text}
+
+    def _send(self, lane, items):
+        throttled_for = None
+        try:
+            messages, sendable = [], []
+            for item in items:
+                try:
+                    messages.append(self._render(item))
+                    sendable.append(item)
+                except (KeyError, ValueError) as e:
+                    # A message that can't be rendered won't render next time either
+                    self.queue.fail([item.item_id], f"render failed: {e}")
+            if not sendable:
+                return
+            try:
+                results = lane.provider.send_batch(messages)
+            except ProviderThrottled as e:
+                throttled_for = e.retry_after
+                self.queue.defer([item.item_id for item in sendable], time.time() + e.retry_after)
+                return
+            except (ProviderError, OSError) as e:
+                self.queue.retry([item.item_id for item in sendable], str(e))
+                return
+            self.queue.mark_sent([(item.item_id, provider_message_id)
+                                  for item, (provider_message_id, _) in zip(sendable, results) if provider_message_id])
+            failed = defaultdict(list)
+            for item, (provider_message_id, error) in zip(sendable, results):
+                if not provider_message_id:
+                    failed[error].append(item.item_id)
+            for error, item_ids in failed.items():
+                self.queue.retry(item_ids, error)
+        finally:
+            lane.finished(throttled_for)
+            with self.idle:
+                self.running -= 1
+                self.idle.notify_all()
+
+    def dispatch_once(self):
+        """Claim as much work as the lanes can take now and hand it to the senders; returns items claimed"""
+        capacity = sum(lane.free() * lane.provider.max_batch for lane in self.lanes.values())
+        if not capacity:
+            return 0
+        items = self.queue.claim(limit=capacity, channel=PATIENT)
+        by_lane = defaultdict(list)
+        for item in items:
+            by_lane[self._lane_name(self.tenant_lookup(item.tenant))].append(item)
+        for name, lane_items in by_lane.items():
+            lane = self.lanes.get(name)
+            if lane is None:
+                self.queue.retry([item.item_id for item in lane_items], f"no provider named '{name}'")
+                continue
+            batches = [lane_items[i:i + lane.provider.max_batch] for i in range(0, len(lane_items), lane.provider.max_batch)]
+            free = lane.free()
+            # Whatever the lane can't start now keeps its place in the queue
+            if len(batches) > free:
+                self.queue.release([item.item_id for batch in batches[free:] for item in batch])
+            for batch in batches[:free]:
+                lane.start()
+                with self.idle:
+                    self.running += 1
+                self.executor.submit(self._send, lane, batch)
+        return len(items)
+
+    def run(self, until_empty=False, stop=None):
+        """Keep dispatching; with until_empty, return once nothing is queued or in flight"""
+        self.queue.reclaim_stale()
+        while stop is None or not stop.is_set():
+            if self.dispatch_once():
+                continue
+            with self.idle:
+                # Wait for a batch to finish (capacity frees up) or for queued items to come due
+                if self.running:
+                    self.idle.wait(timeout=IDLE_POLL_SECONDS)
+                    continue
+            next_ready = self.queue.next_ready_at(PATIENT)
+            if next_ready is None:
+                if until_empty:
+                    return
+                time.sleep(IDLE_POLL_SECONDS)
+            else:
+                time.sleep(min(max(next_ready - time.time(), 0.01), IDLE_POLL_SECONDS))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    # A campaign against the local provider stand-in, on a scratch queue
+    import argparse
+    import os
+    import tempfile
+
+    from flows import FlowRegistry
+    from outreach import ROUTINE, OutreachQueue
+    from tenants import DEFAULT_TENANT, get_tenant
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=200, help="provider messages per second")
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    queue = OutreachQueue(os.path.join(tempfile.mkdtemp(), "outreach.sqlite3"), retry_base_seconds=0.2)
+    ids = queue.enqueue_many([(DEFAULT_TENANT, f"campaign-{i}", "intro", ROUTINE, PATIENT,
+                               {"name": f"Woman {i}", "to": f"+91-00000-{i:05d}"}, None)
+                              for i in range(args.messages)])
+    provider = LocalProvider(rate_per_second=args.rate, failure_rate=args.failure_rate, seed=1)
+    dispatcher = Dispatcher(queue, {provider.name: provider}, FlowRegistry(), get_tenant)
+    started = time.perf_counter()
+    dispatcher.run(until_empty=True)
+    elapsed = time.perf_counter() - started
+    dispatcher.close()
+    counts = queue.status_counts()
+    recipients = {recipient for recipient, _ in provider.delivered.values()}
+    print(f"{counts.get('sent', 0)} sent, {counts.get('failed', 0)} failed of {args.messages} in {elapsed:.1f}s "
+          f"({counts.get('sent', 0) / elapsed * 60:,.0f} messages/minute)")
+    print(f"Provider: {len(provider.delivered)} accepted for {len(recipients)} recipients, "
+          f"throttled {provider.throttled} times, at most {provider.peak_in_flight} batches in flight")
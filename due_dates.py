@@ -0,0 +1,178 @@
+# Upcoming screening due dates
+#
+# Every user gets a next-due date per screening type, worked out from their tenant's rule
+# pack (answers, results, bookings and age band) whenever their conversation changes.
+# Due dates sit in a SQLite B-tree keyed by (tenant, screening, due), so "everyone in
+# Pune due for cervical screening in the next 30 days" is one range scan over the
+# matching rows, however many users there are. Campaign planning and reminders read
+# from it.
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_DB = os.environ.get(
+    "NAVIGATOR_DUE_DATES_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "due_dates.sqlite3"),
+)
+DAY_SECONDS = 86400
+DUE_LIMIT = 1000
+
+DueDate = namedtuple("DueDate", ["session", "screening", "due", "reason"])
+
+
+class DueDateIndex:
+    """Next-due dates per user and screening, range-queryable by region"""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS due_dates (
+                session TEXT NOT NULL,
+                screening TEXT NOT NULL,
+                tenant TEXT NOT NULL,
+                due REAL NOT NULL,
+                reason TEXT NOT NULL,
+                PRIMARY KEY (session, screening)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS due_by_region ON due_dates (tenant, screening, due);
+        """)
+        self.lock = threading.Lock()
+
+    def update(self, tenant_id, session, due):
+        """Replace a user's due dates with {screening: (due time, reason)}"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self._update(tenant_id, session, due)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def update_many(self, users):
+        """update() for many (tenant id, session, due) in one transaction"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for tenant_id, session, due in users:
+                    self._update(tenant_id, session, due)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _update(self, tenant_id, session, due):
+        placeholders = ", ".join("?" * len(due))
+        self.db.execute(f"DELETE FROM due_dates WHERE session = ? AND screening NOT IN ({placeholders})",
+                        (session, *due))
+        # A date worked out for the same reason as before keeps its original time, so
+        # "due now" doesn't move forward with every turn; bookings always take the new time
+        self.db.executemany("""
+            INSERT INTO due_dates (session, screening, tenant, due, reason) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (session, screening) DO UPDATE SET
+                tenant = excluded.tenant, reason = excluded.reason,
+                due = CASE WHEN due_dates.reason = excluded.reason AND excluded.reason != 'booked'
+                           THEN due_dates.due ELSE excluded.due END
+        """, [(session, screening, tenant_id, due_at, reason) for screening, (due_at, reason) in due.items()])
+
+    def remove(self, session):
+        with self.lock:
+            self.db.execute("DELETE FROM due_dates WHERE session = ?", (session,))
+
+    def for_session(self, session):
+        """A user's due dates, soonest first"""
+        with self.lock:
+            rows = self.db.execute("SELECT session, screening, due, reason FROM due_dates WHERE session = ? ORDER BY due",
+                                   (session,)).fetchall()
+        return [DueDate(*row) for row in rows]
+
+    def due_between(self, tenant_id, screening, start, end, limit=DUE_LIMIT, after=None):
+        """Users due for a screening in [start, end), soonest first
+
+        Page through a large range by passing the last row returned as after
+        """
+        if after is None:
+            sql = ("SELECT session, screening, due, reason FROM due_dates INDEXED BY due_by_region "
+                   "WHERE tenant = ? AND screening = ? AND due >= ? AND due < ? ORDER BY due, session LIMIT ?")
+            params = (tenant_id, screening, start, end, limit)
+        else:
+            sql = ("SELECT session, screening, due, reason FROM due_dates INDEXED BY due_by_region "
+                   "WHERE tenant = ? AND screening = ? AND due >= ? AND due < ? AND (due > ? OR (due = ? AND session > ?)) "
+                   "ORDER BY due, session LIMIT ?")
+            params = (tenant_id, screening, start, end, after.due, after.due, after.session, limit)
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+        return [DueDate(*row) for row in rows]
+
+    def due_within(self, tenant_id, screening, days, limit=DUE_LIMIT, now=None):
+        """Users due for a screening in the next number of days, including anyone already overdue"""
+        now = time.time() if now is None else now
+        return self.due_between(tenant_id, screening, 0, now + days * DAY_SECONDS, limit)
+
+    def count_between(self, tenant_id, screening, start, end):
+        with self.lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM due_dates INDEXED BY due_by_region "
+                "WHERE tenant = ? AND screening = ? AND due >= ? AND due < ?",
+                (tenant_id, screening, start, end)).fetchone()[0]
+
+    def calendar(self, tenant_id, screening, start, days, bucket_days=7):
+        """Users coming due per bucket of days from start, for campaign planning"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT CAST((due - ?) / ? AS INTEGER) AS bucket, COUNT(*) FROM due_dates INDEXED BY due_by_region "
+                "WHERE tenant = ? AND screening = ? AND due >= ? AND due < ? GROUP BY bucket ORDER BY bucket",
+                (start, bucket_days * DAY_SECONDS, tenant_id, screening, start, start + days * DAY_SECONDS)).fetchall()
+        counts = dict(rows)
+        return [(start + bucket * bucket_days * DAY_SECONDS, counts.get(bucket, 0))
+                for bucket in range((days + bucket_days - 1) // bucket_days)]
+
+
+if __name__ == "__main__":
+    # Millions of synthetic users across the regions, then the campaign queries
+    import random
+    import sys
+    import tempfile
+
+    from screening import get_screening_rules
+    from tenants import available_tenants, get_tenant
+
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    index = DueDateIndex(os.path.join(tempfile.mkdtemp(), "due_dates.sqlite3"))
+    rng = random.Random(5)
+    tenant_ids = available_tenants()
+    answers = ["Yes", "No", "Not sure", "I don't know"]
+    now = time.time()
+    started = time.perf_counter()
+    batch = []
+    for i in range(users):
+        tenant = get_tenant(rng.choice(tenant_ids))
+        profile = {"age": rng.randint(18, 75), "annual_checkup": rng.choice(answers),
+                   "cervical_screening": rng.choice(answers), "breast_screening": rng.choice(answers)}
+        results = {"cervical": rng.choice(["normal", "normal", "abnormal_minor"])} if rng.random() < 0.3 else {}
+        # Spread when each user was last seen over the past few years
+        seen = now - rng.random() * 3 * 365 * DAY_SECONDS
+        due = get_screening_rules(tenant["guideline_rules"]).next_due(profile, results, {}, seen)
+        batch.append((tenant["id"], f"user-{i}", due))
+        if len(batch) == 50_000:
+            index.update_many(batch)
+            batch = []
+    index.update_many(batch)
+    print(f"Indexed {users:,} users in {time.perf_counter() - started:.0f}s")
+
+    for tenant_id, screening in [("pune", "cervical"), ("ghana", "breast")]:
+        started = time.perf_counter()
+        count = index.count_between(tenant_id, screening, now, now + 30 * DAY_SECONDS)
+        first_page = index.due_between(tenant_id, screening, now, now + 30 * DAY_SECONDS, limit=500)
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"{tenant_id} {screening}, due in the next 30 days: {count:,} users "
+              f"(count and first {len(first_page)} rows in {elapsed:.1f} ms)")
+    started = time.perf_counter()
+    weeks = index.calendar("pune", "cervical", now, 90)
+    print(f"pune cervical by week for 90 days ({(time.perf_counter() - started) * 1000:.1f} ms): "
+          f"{[count for _, count in weeks]}")
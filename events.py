@@ -0,0 +1,388 @@
+# Append-only conversation event log with incrementally maintained funnel aggregates
+#
+# Events are stored column by column (one fixed-width file per field) in a segment
+# directory per process, with strings interned into a small append-only dictionary.
+# Every event also updates in-memory aggregates, which are checkpointed next to the
+# log with the row count they cover, so funnel queries never rescan old events. The
+# checkpoint itself only holds counters; each session's latest stage and funnel flags
+# go to a separate columnar table that only the sessions changed since the last
+# checkpoint are appended to. Segments are reconciled per session when merged, so a
+# conversation whose events span processes is counted once. Readers keep each other
+# process's segment loaded and only fold in the rows and strings appended since their
+# last query, stopping short of a line or row that is still being written.
+import json
+import os
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter
+
+EVENTS_DIR = os.environ.get(
+    "NAVIGATOR_EVENTS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "events"),
+)
+CHECKPOINT_EVERY = 500
+
+# Event kinds
+STAGE = 1            # subject: new stage, detail: previous stage
+ANSWER = 2           # subject: stage answered, detail: canonical option or "free_text"
+RECOMMENDATION = 3   # subject: recommendation text
+SCHEDULED = 4        # subject: stage where the follow-up was booked
+
+# Column name -> array typecode
+COLUMNS = {
+    "timestamp": "d",
+    "session": "I",
+    "kind": "B",
+    "subject": "I",
+    "detail": "I",
+}
+
+# Per-session state table: one row per session each time it is checkpointed
+SESSION_COLUMNS = {
+    "session": "I",
+    "stage": "I",
+    "stage_time": "d",
+    "flags": "B",
+}
+NO_STAGE = 0xFFFFFFFF
+
+# Per-session progress flags for the results -> scheduling funnel
+RESULTS_NOTIFIED = 1
+FOLLOW_UP_SCHEDULED = 2
+
+
+class FunnelAggregates:
+    """Counters that are updated per event and merged across segments"""
+
+    def __init__(self):
+        self.stage_entries = Counter()   # times each stage was entered
+        self.current_stage = Counter()   # sessions whose latest stage is this one
+        self.recommendations = Counter()
+        self.session_stage = {}          # session -> (latest stage, time entered)
+        self.session_flags = {}
+        self.results_notified = 0
+        self.results_scheduled = 0
+        self.changed = set()             # sessions to write at the next checkpoint
+
+    def _set_flag(self, session, flag):
+        before = self.session_flags.get(session, 0)
+        after = before | flag
+        if after == before:
+            return
+        self.session_flags[session] = after
+        self.changed.add(session)
+        if after & RESULTS_NOTIFIED and not before & RESULTS_NOTIFIED:
+            self.results_notified += 1
+        if after == RESULTS_NOTIFIED | FOLLOW_UP_SCHEDULED:
+            self.results_scheduled += 1
+
+    def apply(self, session, kind, subject, detail, timestamp):
+        if kind == STAGE:
+            self.stage_entries[subject] += 1
+            previous = self.session_stage.get(session)
+            if previous is None or timestamp >= previous[1]:
+                if previous is not None:
+                    self.current_stage[previous[0]] -= 1
+                self.session_stage[session] = (subject, timestamp)
+                self.current_stage[subject] += 1
+                self.changed.add(session)
+            if subject.endswith("_results_notification"):
+                self._set_flag(session, RESULTS_NOTIFIED)
+        elif kind == RECOMMENDATION:
+            self.recommendations[subject] += 1
+        elif kind == SCHEDULED:
+            self._set_flag(session, FOLLOW_UP_SCHEDULED)
+
+    def recount(self):
+        """Rebuild the per-session counters from the per-session state"""
+        self.current_stage = Counter(stage for stage, _ in self.session_stage.values())
+        self.results_notified = sum(1 for flags in self.session_flags.values() if flags & RESULTS_NOTIFIED)
+        self.results_scheduled = sum(1 for flags in self.session_flags.values()
+                                     if flags == RESULTS_NOTIFIED | FOLLOW_UP_SCHEDULED)
+
+    def merge(self, other):
+        """Fold in another segment's aggregates: event counts add up, sessions are reconciled"""
+        self.stage_entries.update(other.stage_entries)
+        self.recommendations.update(other.recommendations)
+        # A session seen by both keeps its later stage and every flag either one set
+        for session, (stage, entered) in other.session_stage.items():
+            mine = self.session_stage.get(session)
+            if mine is None or entered > mine[1]:
+                self.session_stage[session] = (stage, entered)
+        for session, flags in other.session_flags.items():
+            self.session_flags[session] = self.session_flags.get(session, 0) | flags
+        self.recount()
+
+    def counters(self):
+        """The checkpointed part: event counts, without any per-session state"""
+        return {
+            "stage_entries": dict(self.stage_entries),
+            "recommendations": dict(self.recommendations),
+        }
+
+    @classmethod
+    def from_checkpoint(cls, counters, sessions):
+        """Aggregates from checkpointed counters and (session, stage, time, flags) rows, oldest first"""
+        aggregates = cls()
+        aggregates.stage_entries.update(counters.get("stage_entries", {}))
+        aggregates.recommendations.update(counters.get("recommendations", {}))
+        for session, stage, entered, flags in sessions:
+            if stage is not None:
+                aggregates.session_stage[session] = (stage, entered)
+            if flags:
+                aggregates.session_flags[session] = flags
+        aggregates.recount()
+        return aggregates
+
+    def funnel(self):
+        """Drop-off by stage, recommendation mix and results-to-scheduling conversion"""
+        notified, scheduled = self.results_notified, self.results_scheduled
+        return {
+            "sessions": len(self.session_stage),
+            "stage_entries": dict(self.stage_entries),
+            "drop_off": {stage: count for stage, count in self.current_stage.items() if count and stage != "end"},
+            "recommendations": dict(self.recommendations.most_common()),
+            "results_notified": notified,
+            "results_scheduled": scheduled,
+            "results_conversion": scheduled / notified if notified else 0.0,
+        }
+
+
+class Segment:
+    """One process's append-only columnar event files"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.strings_path = os.path.join(path, "strings.jsonl")
+        self.checkpoint_path = os.path.join(path, "aggregates.json")
+        self.strings = []
+        self.string_ids = {}
+        self.strings_read = 0    # bytes of the dictionary already remembered
+        self.aggregates = None   # reader's view: aggregates covering loaded_rows
+        self.loaded_rows = 0
+        self.lock = threading.Lock()
+        self._read_strings()
+
+    def _read_strings(self):
+        """Remember the dictionary entries appended since the last read
+
+        A writer may be halfway through a line; it is left for the next read
+        """
+        if not os.path.exists(self.strings_path):
+            return
+        with open(self.strings_path, "rb") as f:
+            f.seek(self.strings_read)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._remember(json.loads(line))
+        self.strings_read += end
+
+    def _remember(self, value):
+        self.string_ids[value] = len(self.strings)
+        self.strings.append(value)
+
+    def column_path(self, name):
+        return os.path.join(self.path, f"{name}.col")
+
+    def intern(self, value, new_strings):
+        """Return the id of a string, queueing it for the dictionary if it is new"""
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            self._remember(value)
+            new_strings.append(value)
+            string_id = self.string_ids[value]
+        return string_id
+
+    def append(self, rows, new_strings):
+        # The dictionary is written before the rows that reference it
+        if new_strings:
+            with open(self.strings_path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(value) + "\n" for value in new_strings)
+        for index, (name, typecode) in enumerate(COLUMNS.items()):
+            with open(self.column_path(name), "ab") as f:
+                array(typecode, (row[index] for row in rows)).tofile(f)
+
+    def row_count(self):
+        """Rows fully written to every column (a crash can leave a partial tail)"""
+        counts = []
+        for name, typecode in COLUMNS.items():
+            path = self.column_path(name)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            counts.append(size // array(typecode).itemsize)
+        return min(counts)
+
+    def read_columns(self, start=0, stop=None):
+        """Read a row range as {column: array}"""
+        stop = self.row_count() if stop is None else stop
+        columns = {}
+        for name, typecode in COLUMNS.items():
+            values = array(typecode)
+            with open(self.column_path(name), "rb") as f:
+                f.seek(start * values.itemsize)
+                values.fromfile(f, max(stop - start, 0))
+            columns[name] = values
+        return columns
+
+    def session_column_path(self, name):
+        return os.path.join(self.path, f"session_{name}.col")
+
+    def _read_sessions(self, count):
+        columns = {}
+        for name, typecode in SESSION_COLUMNS.items():
+            values = array(typecode)
+            path = self.session_column_path(name)
+            if count:
+                with open(path, "rb") as f:
+                    values.fromfile(f, count)
+            columns[name] = values
+        strings = self.strings
+        for session, stage, entered, flags in zip(columns["session"], columns["stage"], columns["stage_time"], columns["flags"]):
+            yield strings[session], None if stage == NO_STAGE else strings[stage], entered, flags
+
+    def load_aggregates(self):
+        """Aggregates of another process's segment, kept loaded between calls
+
+        The first call starts from the checkpoint; every call folds in the rows
+        written since the previous one. Treat the result as read-only.
+        """
+        with self.lock:
+            if self.aggregates is None:
+                covered, session_rows, counters = 0, 0, {}
+                if os.path.exists(self.checkpoint_path):
+                    with open(self.checkpoint_path, encoding="utf-8") as f:
+                        checkpoint = json.load(f)
+                    covered, session_rows, counters = checkpoint["rows"], checkpoint.get("session_rows", 0), checkpoint["counters"]
+                self.loaded_rows = covered
+            # Count rows before reading strings: the strings a row uses are written ahead of it
+            total = self.row_count()
+            self._read_strings()
+            if self.aggregates is None:
+                # Session rows past the checkpoint's count belong to one still being written
+                self.aggregates = FunnelAggregates.from_checkpoint(counters, self._read_sessions(session_rows))
+            if total > self.loaded_rows:
+                columns = self.read_columns(self.loaded_rows, total)
+                strings = self.strings
+                for timestamp, session, kind, subject, detail in zip(columns["timestamp"], columns["session"], columns["kind"],
+                                                                     columns["subject"], columns["detail"]):
+                    self.aggregates.apply(strings[session], kind, strings[subject], strings[detail], timestamp)
+                self.loaded_rows = total
+            # Nothing checkpoints a reader's view
+            self.aggregates.changed = set()
+            return self.aggregates, total
+
+    def save_aggregates(self, aggregates, rows, session_rows):
+        """Append the sessions changed since the last checkpoint, then write the counters; returns session rows"""
+        ids = self.string_ids
+        changed = []
+        for session in aggregates.changed:
+            stage, entered = aggregates.session_stage.get(session, (None, 0.0))
+            changed.append((ids[session], NO_STAGE if stage is None else ids[stage], entered,
+                            aggregates.session_flags.get(session, 0)))
+        for index, (name, typecode) in enumerate(SESSION_COLUMNS.items()):
+            with open(self.session_column_path(name), "ab") as f:
+                array(typecode, (row[index] for row in changed)).tofile(f)
+        aggregates.changed = set()
+        session_rows += len(changed)
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "session_rows": session_rows, "counters": aggregates.counters()}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        return session_rows
+
+
+class EventLog:
+    """Records conversation events for one process and keeps its aggregates current"""
+
+    def __init__(self, directory=EVENTS_DIR, checkpoint_every=CHECKPOINT_EVERY):
+        self.directory = directory
+        self.checkpoint_every = checkpoint_every
+        self.segment = Segment(os.path.join(directory, f"{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:6]}"))
+        self.aggregates = FunnelAggregates()
+        self.rows = 0
+        self.session_rows = 0
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+    def record(self, session, kind, subject, detail=""):
+        self.record_many(session, [(kind, subject, detail)])
+
+    def record_many(self, session, events):
+        """Append several (kind, subject, detail) events for one session"""
+        if not events:
+            return
+        with self.lock:
+            now = time.time()
+            new_strings = []
+            session_id = self.segment.intern(session, new_strings)
+            rows = []
+            for kind, subject, detail in events:
+                rows.append((now, session_id, kind,
+                             self.segment.intern(subject, new_strings),
+                             self.segment.intern(detail, new_strings)))
+                self.aggregates.apply(session, kind, subject, detail, now)
+            self.segment.append(rows, new_strings)
+            self.rows += len(rows)
+            self.unsaved += len(rows)
+            if self.unsaved >= self.checkpoint_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        self.session_rows = self.segment.save_aggregates(self.aggregates, self.rows, self.session_rows)
+        self.unsaved = 0
+
+    def funnel(self):
+        """Funnel report for every segment in the log directory, this one included"""
+        with self.lock:
+            combined = FunnelAggregates()
+            combined.merge(self.aggregates)
+            for other in _other_segments(self.directory, self.segment.path):
+                combined.merge(other.load_aggregates()[0])
+            return combined.funnel()
+
+
+class NullEventLog:
+    """Drop-in EventLog that keeps nothing, for offline replays"""
+
+    def record(self, session, kind, subject, detail=""):
+        pass
+
+    def record_many(self, session, events):
+        pass
+
+
+_segments = {}  # path -> Segment, reused across funnel queries
+_segments_lock = threading.Lock()
+
+
+def _other_segments(directory, exclude=None):
+    if not os.path.isdir(directory):
+        return []
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+    paths = [path for path in paths if path != exclude and os.path.isdir(path)]
+    with _segments_lock:
+        # Forget segments whose directories have been removed
+        for path in [path for path in _segments if os.path.dirname(path) == directory and not os.path.isdir(path)]:
+            del _segments[path]
+        segments = []
+        for path in paths:
+            segment = _segments.get(path)
+            if segment is None:
+                segment = _segments[path] = Segment(path)
+            segments.append(segment)
+        return segments
+
+
+def funnel_report(directory=EVENTS_DIR):
+    """Merge the checkpointed aggregates of every segment into one funnel report"""
+    combined = FunnelAggregates()
+    for segment in _other_segments(directory):
+        combined.merge(segment.load_aggregates()[0])
+    return combined.funnel()
+
+
+if __name__ == "__main__":
+    print(json.dumps(funnel_report(), indent=2))
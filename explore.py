@@ -0,0 +1,330 @@
+# Flow-path explorer
+#
+# Walks every distinct path through a tenant's conversation flow without Streamlit. At each
+# turn it tries the offered quick replies plus a few representative free-text answers, and
+# merges paths that reach the same routing state (stage, offered replies, assessment path,
+# the recommendations the answers so far lead to, results and bookings), so the sweep stays
+# finite. Expansion and the final replay of every complete path run across a process pool.
+# The report gives turn counts, per-path and per-turn latency, the worst-case path and any
+# dead ends (turns where the navigator said nothing).
+#
+#   python explore.py [--tenant pune] [--workers 8] [--max-turns 60] [--json report.json]
+import argparse
+import copy
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from clinics import ClinicDirectory
+from conversation import (
+    Context, SessionState, build_intent_classifier, init_session, recommendations_for,
+    respond, screening_rules_for, start_conversation
+)
+from events import NullEventLog
+from flows import FlowRegistry
+from guidelines import open_guidelines
+from scheduling import SlotEngine
+from tenants import DEFAULT_TENANT, get_tenant
+
+MAX_TURNS = 60
+CHUNK_SIZE = 32
+
+# Representative free-text answers, tried alongside each stage's quick replies
+GENERIC_FREE_TEXT = ["haan ji", "I don't know", "what do you mean?"]
+STAGE_FREE_TEXT = {
+    "waiting_age": ["I am 34 years old", "62"],
+    "waiting_pregnancies": ["two children"],
+    "waiting_complaints": ["bleeding after sex"],
+    "waiting_chronic_conditions": ["sugar and bp"],
+    "waiting_treatment_questions": ["I moved to a different location"],
+}
+
+CERVICAL_RESULTS = ["normal", "abnormal_minor", "abnormal_serious"]
+BREAST_RESULTS = ["normal", "abnormal"]
+
+_ctx = None
+
+
+def _init_worker(tenant_id, work_dir):
+    """Give each worker process its own context, with scratch bookings and no event log"""
+    global _ctx
+    tenant = get_tenant(tenant_id)
+    flow = FlowRegistry().latest(tenant["flow"])
+    clinics = ClinicDirectory(tenant["clinics"])
+    scratch = tempfile.mkdtemp(dir=work_dir)
+    slots = SlotEngine(clinics, os.path.join(scratch, "bookings.sqlite3"))
+    _ctx = Context(tenant, flow, build_intent_classifier(flow), clinics, slots, NullEventLog(),
+                   open_guidelines(tenant["guideline_rules"]))
+
+
+def result_combinations(flow, stage):
+    """Test results worth trying from an entry stage, based on the notifications it can reach"""
+    builders = set()
+    seen, pending = set(), [stage]
+    while pending:
+        current = pending.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        builders.add(flow.stages.get(current, {}).get("message_builder"))
+        pending.extend(flow.successors(current))
+    combinations = [{"cervical": None, "breast": None}]
+    if builders & {"cervical_results", "comprehensive_results"}:
+        combinations = [dict(results, cervical=result) for results in combinations for result in CERVICAL_RESULTS]
+    if builders & {"breast_results", "comprehensive_results"}:
+        combinations = [dict(results, breast=result) for results in combinations for result in BREAST_RESULTS]
+    return combinations
+
+
+def starting_points(flow):
+    """(label, entry stage, test results) for every way into the flow"""
+    starts = []
+    for stage in flow.entry_stages:
+        for results in result_combinations(flow, stage):
+            known = [f"{test}={result}" for test, result in results.items() if result]
+            label = f"{stage}[{','.join(known)}]" if known else stage
+            starts.append((label, stage, results))
+    return starts
+
+
+def routing_key(state):
+    """The parts of a session that decide where the conversation can go next"""
+    profile = state.user_profile
+    try:
+        pending_recommendations = tuple(recommendations_for(profile, screening_rules_for(_ctx.tenant)))
+    except (KeyError, TypeError, ValueError):
+        pending_recommendations = None
+    return (
+        state.conv_stage,
+        tuple(state.quick_replies),
+        tuple(state.assessment_path),
+        pending_recommendations,
+        tuple(state.recommendations),
+        bool(profile.get("presenting_complaints")),
+        bool(profile.get("chronic_conditions")),
+        profile.get("current_location"),
+        state.show_clinic_info,
+        tuple(sorted(state.test_results.items(), key=str)),
+        tuple(sorted(state.appointments)),
+    )
+
+
+def candidate_inputs(state):
+    """Quick replies on offer plus representative free text for this stage"""
+    replies = list(state.quick_replies)
+    if state.conv_stage in ("waiting_complaints", "waiting_chronic_conditions") and "Continue" not in replies:
+        replies.append("Continue")
+    for text in STAGE_FREE_TEXT.get(state.conv_stage, []) + GENERIC_FREE_TEXT:
+        if text not in replies:
+            replies.append(text)
+    return replies
+
+
+def _release(state, before):
+    """Cancel bookings a turn made, so exploring one branch never fills slots for the next"""
+    for service, booking in state.appointments.items():
+        if service not in before:
+            _ctx.slots.cancel(booking.booking_id)
+
+
+def _new_state(stage, results):
+    state = SessionState()
+    init_session(state, _ctx.tenant)
+    state.user_profile["name"] = "Asha"
+    state.conv_stage = stage
+    state.test_results = dict(results)
+    return state
+
+
+def _take_turn(state, reply):
+    """Run one turn, returning (seconds, whether the navigator replied)"""
+    replies_before = len([m for m in state.messages if m["role"] == "assistant"])
+    started = time.perf_counter()
+    respond(state, _ctx, reply)
+    elapsed = time.perf_counter() - started
+    replied = len([m for m in state.messages if m["role"] == "assistant"]) > replies_before
+    return elapsed, replied
+
+
+def _start(start):
+    label, stage, results = start
+    state = _new_state(stage, results)
+    start_conversation(state, _ctx)
+    return label, state, routing_key(state)
+
+
+def _expand(state):
+    """Try every candidate input from a state; one child per input"""
+    children = []
+    for reply in candidate_inputs(state):
+        child = copy.deepcopy(state)
+        booked = set(child.appointments)
+        elapsed, replied = _take_turn(child, reply)
+        _release(child, booked)
+        children.append((reply, elapsed, replied, child, routing_key(child)))
+    return children
+
+
+def _replay(path):
+    """Replay a complete path from scratch, timing every turn"""
+    label, stage, results, inputs = path
+    state = _new_state(stage, results)
+    started = time.perf_counter()
+    start_conversation(state, _ctx)
+    turns = [("start", stage, time.perf_counter() - started, True)]
+    for reply in inputs:
+        stage = state.conv_stage
+        elapsed, replied = _take_turn(state, reply)
+        turns.append((reply, stage, elapsed, replied))
+    _release(state, set())
+    return label, inputs, turns, state.conv_stage
+
+
+def longest_path(roots, edges):
+    """Most turns from any root, following each state once (loops don't count)"""
+    best = {}
+
+    def visit(key, on_path):
+        if key in best:
+            return best[key]
+        on_path.add(key)
+        result = (0, [])
+        for reply, child in edges.get(key, []):
+            if child in on_path:
+                continue
+            turns, replies = visit(child, on_path)
+            if turns + 1 > result[0]:
+                result = (turns + 1, [reply] + replies)
+        on_path.discard(key)
+        best[key] = result
+        return result
+
+    candidates = [(visit(key, set()), label, key) for label, key in roots]
+    (turns, replies), label, key = max(candidates, key=lambda item: item[0][0])
+    return label, turns, replies
+
+
+def explore(tenant_id=DEFAULT_TENANT, workers=None, max_turns=MAX_TURNS):
+    """Enumerate and replay every distinct path; returns the report as a dict"""
+    tenant = get_tenant(tenant_id)
+    flow = FlowRegistry().latest(tenant["flow"])
+    # Build the clinic index once here rather than racing to build it in every worker
+    ClinicDirectory(tenant["clinics"])
+    starts = {label: (stage, results) for label, stage, results in starting_points(flow)}
+    work_dir = tempfile.mkdtemp(prefix="explore-")
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tenant_id, work_dir)) as pool:
+            # Breadth-first, one level of turns at a time, so each state is kept at its shortest path
+            visited = set()
+            edges = {}
+            roots = []
+            frontier = []
+            for label, state, key in pool.map(_start, [(label, *start) for label, start in starts.items()]):
+                roots.append((label, key))
+                if key not in visited:
+                    visited.add(key)
+                    frontier.append((label, [], state, key))
+            complete, dead_ends = [], []
+            merged = 0
+            while frontier:
+                next_frontier = []
+                expanded = pool.map(_expand, [state for _, _, state, _ in frontier], chunksize=CHUNK_SIZE)
+                for (label, inputs, _, key), children in zip(frontier, expanded):
+                    for reply, elapsed, replied, child, child_key in children:
+                        path = inputs + [reply]
+                        if not replied:
+                            dead_ends.append({"start": label, "stage": child.conv_stage, "inputs": path})
+                            continue
+                        edges.setdefault(key, []).append((reply, child_key))
+                        if child_key in visited:
+                            merged += 1
+                        elif child.conv_stage == "end":
+                            visited.add(child_key)
+                            complete.append((label, path, "end"))
+                        elif len(path) >= max_turns:
+                            visited.add(child_key)
+                            complete.append((label, path, "max_turns"))
+                        else:
+                            visited.add(child_key)
+                            next_frontier.append((label, path, child, child_key))
+                frontier = next_frontier
+            explored_at = time.perf_counter()
+
+            # The worst case can run through states first reached by a shorter path
+            worst_label, worst_turns, worst_inputs = longest_path(roots, edges)
+            paths = [(label, *starts[label], inputs) for label, inputs, _ in complete]
+            paths.append((worst_label, *starts[worst_label], worst_inputs))
+            replays = list(pool.map(_replay, paths, chunksize=CHUNK_SIZE))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Summarise latency per path, per turn and per stage
+    turn_times = sorted(elapsed for _, _, turns, _ in replays for _, _, elapsed, _ in turns)
+    stage_times = {}
+    for _, _, turns, _ in replays:
+        for _, stage, elapsed, _ in turns:
+            stage_times[stage] = max(stage_times.get(stage, 0.0), elapsed)
+    per_path = [
+        {"start": label, "inputs": inputs, "turns": len(inputs), "final_stage": final,
+         "total_ms": round(sum(t[2] for t in turns) * 1000, 3),
+         "max_turn_ms": round(max(t[2] for t in turns) * 1000, 3)}
+        for label, inputs, turns, final in replays
+    ]
+    slowest = max(per_path, key=lambda path: path["total_ms"])
+
+    def percentile(fraction):
+        return round(turn_times[min(len(turn_times) - 1, int(fraction * len(turn_times)))] * 1000, 3)
+
+    return {
+        "tenant": tenant_id,
+        "flow": flow.key,
+        "starting_points": len(starts),
+        "states": len(visited),
+        "complete_paths": len(complete),
+        "merged_paths": merged,
+        "cut_at_max_turns": sum(1 for _, _, outcome in complete if outcome == "max_turns"),
+        "dead_ends": dead_ends,
+        "worst_case": {"start": worst_label, "turns": worst_turns, "inputs": worst_inputs},
+        "slowest_path": slowest,
+        "turn_latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99), "max": percentile(1.0)},
+        "slowest_stages_ms": {stage: round(elapsed * 1000, 3) for stage, elapsed in sorted(stage_times.items(), key=lambda item: -item[1])[:10]},
+        "explore_seconds": round(explored_at - started, 2),
+        "replay_seconds": round(time.perf_counter() - explored_at, 2),
+        "paths": per_path,
+    }
+
+
+def print_report(report):
+    print(f"{report['flow']} ({report['tenant']}): {report['starting_points']} starting points, "
+          f"{report['states']} distinct states, {report['complete_paths']} complete paths "
+          f"({report['merged_paths']} merged, {report['cut_at_max_turns']} cut at the turn limit)")
+    print(f"Explored in {report['explore_seconds']}s, replayed in {report['replay_seconds']}s")
+    worst = report["worst_case"]
+    print(f"Worst case: {worst['turns']} turns from {worst['start']}: {' > '.join(worst['inputs'])}")
+    slowest = report["slowest_path"]
+    print(f"Slowest path: {slowest['total_ms']} ms over {slowest['turns']} turns from {slowest['start']}")
+    latency = report["turn_latency_ms"]
+    print(f"Turn latency: p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+    print("Slowest stages: " + ", ".join(f"{stage} {ms} ms" for stage, ms in report["slowest_stages_ms"].items()))
+    print(f"Dead ends: {len(report['dead_ends'])}")
+    for dead_end in report["dead_ends"][:20]:
+        print(f"  {dead_end['start']} at {dead_end['stage']}: {' > '.join(dead_end['inputs'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enumerate and replay every path through a conversation flow")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--max-turns", type=int, default=MAX_TURNS)
+    parser.add_argument("--json", help="also write the full report, including every path, to this file")
+    args = parser.parse_args()
+    report = explore(args.tenant, args.workers, args.max_turns)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    raise SystemExit(1 if report["dead_ends"] else 0)
@@ -0,0 +1,253 @@
+# Versioned conversation flow definitions
+#
+# Flows live in flows/<name>/v<version>.json. Each file lists the scripted message stages
+# (message template, quick replies, next stage) and the answer handlers implemented in the
+# app, with the stages each handler can move to. A file is validated and compiled into a
+# read-only table before it is published, so a bad edit never reaches users. New versions
+# are picked up without a restart; sessions stay on the version they started with. Every
+# stage change the app makes at runtime is checked against the compiled table, so a handler
+# moving somewhere its flow doesn't declare fails loudly instead of drifting from the file.
+import json
+import os
+import re
+import threading
+import time
+
+from tenants import _freeze
+
+FLOWS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flows")
+REFRESH_INTERVAL_SECONDS = 5
+
+# Dynamic messages and quick replies the app knows how to build
+BUILDERS = {"cervical_results", "breast_results", "comprehensive_results"}
+PLACEHOLDERS = {"name", "chw_name", "recommendations"}
+
+_VERSION_FILE = re.compile(r"v(\d+)\.json")
+
+
+class FlowValidationError(Exception):
+    """Raised when a flow definition has broken or missing transitions"""
+
+    def __init__(self, source, problems):
+        super().__init__(f"{source}: " + "; ".join(problems))
+        self.problems = problems
+
+
+class FlowTransitionError(Exception):
+    """Raised when a conversation moves between stages its flow doesn't connect"""
+
+    def __init__(self, flow, stage, target):
+        super().__init__(f"{flow.key}: '{stage}' can't move to '{target}' (allowed: {', '.join(flow.successors(stage)) or 'none'})")
+        self.stage = stage
+        self.target = target
+
+
+class Flow:
+    """A validated flow version: read-only stage and handler tables"""
+
+    def __init__(self, name, version, stages, handlers, entry_stages):
+        self.name = name
+        self.version = version
+        self.stages = stages
+        self.handlers = handlers
+        self.entry_stages = entry_stages
+        self.key = f"{name}:v{version}"
+
+    def successors(self, stage):
+        """Stages a conversation can move to from this one"""
+        if stage in self.stages:
+            return [self.stages[stage]["next_stage"]]
+        handler = self.handlers.get(stage, {})
+        targets = list(handler.get("next", ()))
+        if handler.get("fallback"):
+            targets.append(handler["fallback"])
+        return targets
+
+    def check_transition(self, stage, target):
+        """Raise FlowTransitionError unless the flow lets stage move to target"""
+        if target != stage and target not in self.successors(stage):
+            raise FlowTransitionError(self, stage, target)
+
+    def fallback(self, stage):
+        """Where a stage goes when nothing in the app handled the turn"""
+        return self.handlers.get(stage, {}).get("fallback")
+
+
+def _template_problems(stage, template):
+    names = set(re.findall(r"{(\w*)}", template))
+    unknown = sorted(names - PLACEHOLDERS)
+    return [f"stage '{stage}' uses unknown placeholder(s) {', '.join(unknown)}"] if unknown else []
+
+
+def validate_flow(definition):
+    """List the problems in a flow definition (empty when it is valid)"""
+    problems = []
+    stages = definition.get("stages", {})
+    handlers = definition.get("handlers", {})
+    entry_stages = definition.get("entry_stages", [])
+    if not stages:
+        problems.append("no stages defined")
+    if not entry_stages:
+        problems.append("no entry stages defined")
+    for stage in set(stages) & set(handlers):
+        problems.append(f"stage '{stage}' is defined both as a message and a handler")
+    known = set(stages) | set(handlers)
+
+    # Message stages: something to say, valid replies and a transition that exists
+    for stage, info in stages.items():
+        if "message" in info:
+            problems.extend(_template_problems(stage, info["message"]))
+        elif info.get("message_builder") not in BUILDERS:
+            problems.append(f"stage '{stage}' has no message")
+        replies = info.get("quick_replies", [])
+        if "quick_replies_builder" in info and info["quick_replies_builder"] not in BUILDERS:
+            problems.append(f"stage '{stage}' uses unknown quick reply builder '{info['quick_replies_builder']}'")
+        if not isinstance(replies, list) or not all(isinstance(reply, str) for reply in replies):
+            problems.append(f"stage '{stage}' quick replies must be a list of strings")
+        if "next_stage" not in info:
+            problems.append(f"stage '{stage}' is a dead end: no next_stage")
+        elif info["next_stage"] not in known:
+            problems.append(f"stage '{stage}' moves to undefined stage '{info['next_stage']}'")
+
+    # Handlers: every declared move must exist, and only terminal stages may stop
+    for stage, info in handlers.items():
+        targets = list(info.get("next", []))
+        if info.get("fallback"):
+            targets.append(info["fallback"])
+        for target in targets:
+            if target not in known:
+                problems.append(f"handler '{stage}' moves to undefined stage '{target}'")
+        if not targets and not info.get("terminal"):
+            problems.append(f"handler '{stage}' is a dead end: no next stages, fallback or terminal flag")
+
+    # Every stage must be reachable from an entry stage
+    for stage in entry_stages:
+        if stage not in known:
+            problems.append(f"entry stage '{stage}' is not defined")
+    seen = set()
+    pending = [stage for stage in entry_stages if stage in known]
+    while pending:
+        stage = pending.pop()
+        if stage in seen:
+            continue
+        seen.add(stage)
+        if stage in stages:
+            pending.append(stages[stage].get("next_stage"))
+        else:
+            pending.extend(handlers[stage].get("next", []))
+            pending.append(handlers[stage].get("fallback"))
+        pending = [target for target in pending if target in known]
+    for stage in sorted(known - seen):
+        problems.append(f"stage '{stage}' is unreachable")
+    return problems
+
+
+def compile_flow(definition, source="<flow>"):
+    """Validate a parsed flow definition and freeze it into a Flow"""
+    problems = validate_flow(definition)
+    if problems:
+        raise FlowValidationError(source, problems)
+    return Flow(
+        definition["name"],
+        int(definition["version"]),
+        _freeze(definition["stages"]),
+        _freeze(definition["handlers"]),
+        tuple(definition["entry_stages"]),
+    )
+
+
+def load_flow_file(path):
+    """Read and compile one flow file; its name and version come from the path"""
+    with open(path, encoding="utf-8") as f:
+        definition = json.load(f)
+    name = os.path.basename(os.path.dirname(path))
+    version = int(_VERSION_FILE.fullmatch(os.path.basename(path)).group(1))
+    if definition.get("name", name) != name or int(definition.get("version", version)) != version:
+        raise FlowValidationError(path, ["name/version in the file don't match its path"])
+    definition["name"], definition["version"] = name, version
+    return compile_flow(definition, path)
+
+
+class FlowRegistry:
+    """All published flow versions, refreshed from disk without blocking readers"""
+
+    def __init__(self, directory=FLOWS_DIR, refresh_interval=REFRESH_INTERVAL_SECONDS):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.next_check = 0.0
+        self.versions = {}  # name -> {version: Flow}
+        self.errors = {}  # path -> problems of the rejected file
+        self.file_mtimes = {}
+        self._scan()
+
+    def _flow_files(self):
+        for name in sorted(os.listdir(self.directory)):
+            folder = os.path.join(self.directory, name)
+            if os.path.isdir(folder):
+                for filename in sorted(os.listdir(folder)):
+                    if _VERSION_FILE.fullmatch(filename):
+                        yield os.path.join(folder, filename)
+
+    def _scan(self):
+        versions = {name: dict(flows) for name, flows in self.versions.items()}
+        changed = False
+        for path in self._flow_files():
+            mtime = os.stat(path).st_mtime_ns
+            if self.file_mtimes.get(path) == mtime:
+                continue
+            self.file_mtimes[path] = mtime
+            try:
+                flow = load_flow_file(path)
+            except (OSError, ValueError, KeyError, FlowValidationError) as e:
+                self.errors[path] = getattr(e, "problems", [str(e)])
+                continue
+            # Published versions are immutable: sessions pinned to them must not change under them
+            if flow.version in versions.get(flow.name, {}):
+                self.errors[path] = [f"version {flow.version} is already published; save changes as a new version"]
+                continue
+            self.errors.pop(path, None)
+            versions.setdefault(flow.name, {})[flow.version] = flow
+            changed = True
+        if changed:
+            # One reference swap: readers see either the old table or the new one
+            self.versions = versions
+
+    def refresh(self):
+        """Publish new or fixed flow files; cheap enough to call every turn"""
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        # Only one thread compiles; the others keep using the current versions meanwhile
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.next_check = now + self.refresh_interval
+            self._scan()
+        finally:
+            self.lock.release()
+
+    def latest(self, name):
+        """The newest published version of a flow"""
+        flows = self.versions.get(name)
+        if not flows:
+            raise KeyError(f"No valid flow named '{name}'")
+        return flows[max(flows)]
+
+    def get(self, name, version=None):
+        """A specific flow version, or the latest if it isn't published here"""
+        flow = self.versions.get(name, {}).get(version)
+        return flow if flow is not None else self.latest(name)
+
+
+if __name__ == "__main__":
+    import sys
+    registry = FlowRegistry(sys.argv[1] if len(sys.argv) > 1 else FLOWS_DIR)
+    for name, flows in sorted(registry.versions.items()):
+        for version, flow in sorted(flows.items()):
+            print(f"{flow.key}: {len(flow.stages)} message stages, {len(flow.handlers)} handlers")
+    for path, problems in sorted(registry.errors.items()):
+        print(f"{path}: rejected")
+        for problem in problems:
+            print(f"  - {problem}")
+    sys.exit(1 if registry.errors else 0)
@@ -0,0 +1,199 @@
+# Local clinical guideline retrieval
+#
+# Guideline summaries live in guidelines/<rules id>/*.md, one "##" section per passage.
+# They are compiled into a BM25 inverted index file (data/guidelines_<rules id>.idx) that
+# is memory-mapped and shared by every session in the process; only the small term
+# dictionary is held on the heap. The index is rebuilt when a document changes.
+import array
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+GUIDELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guidelines")
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+INDEX_MAGIC = b"GLDX"
+INDEX_VERSION = 1
+# magic, version, passage count, term count, average passage length,
+# passage table offset, term table offset, term names offset
+HEADER = struct.Struct("<4sIIIdQQQ")
+PASSAGE_ENTRY = struct.Struct("<QII")  # record offset, record length, passage length in terms
+TERM_ENTRY = struct.Struct("<IIQ")     # name offset in term names blob, document frequency, postings offset
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+DEFAULT_RESULTS = 3
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "about", "after", "an", "and", "any", "are", "as", "at", "be", "before", "by", "can", "do",
+    "does", "for", "from", "has", "have", "how", "i", "if", "in", "is", "it", "its", "me", "my", "of",
+    "on", "or", "should", "so", "that", "the", "their", "them", "there", "they", "this", "to", "was",
+    "what", "when", "which", "who", "will", "with", "you", "your",
+}
+SUFFIXES = ("ations", "ation", "ions", "ion", "ings", "ing", "ies", "es", "ed", "s", "e")
+
+
+def _stem(word):
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + ("y" if suffix == "ies" else "")
+    return word
+
+
+def tokenize(text):
+    """Lower-cased, stemmed terms without stopwords"""
+    return [_stem(word) for word in _TOKEN_RE.findall(text.lower()) if word not in STOPWORDS]
+
+
+def iter_passages(source_dir):
+    """Split guideline documents into passages: one per "##" section"""
+    for filename in sorted(os.listdir(source_dir)):
+        if not filename.endswith(".md"):
+            continue
+        title, source, heading, lines = "", "", "", []
+        with open(os.path.join(source_dir, filename), encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("## "):
+                    if lines:
+                        yield {"title": title, "heading": heading, "text": " ".join(lines), "source": source, "file": filename}
+                    heading, lines = line[3:], []
+                elif line.startswith("# "):
+                    title = line[2:]
+                elif line.startswith("Source:"):
+                    source = line[len("Source:"):].strip()
+                elif line:
+                    lines.append(line)
+        if lines:
+            yield {"title": title, "heading": heading, "text": " ".join(lines), "source": source, "file": filename}
+
+
+def build_index(source_dir, index_path):
+    """Compile a directory of guideline documents into a memory-mappable BM25 index"""
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    postings = {}  # term -> [(passage id, term frequency)]
+    entries = []
+    with open(tmp_path, "wb") as out:
+        out.write(b"\0" * HEADER.size)
+        for passage_id, passage in enumerate(iter_passages(source_dir)):
+            terms = tokenize(f"{passage['title']} {passage['heading']} {passage['text']}")
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((passage_id, min(count, 65535)))
+            record = json.dumps(passage, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            entries.append((out.tell(), len(record), len(terms)))
+            out.write(record)
+
+        passage_table_offset = out.tell()
+        for entry in entries:
+            out.write(PASSAGE_ENTRY.pack(*entry))
+
+        # Postings: all passage ids for a term, then their term frequencies
+        term_rows = []
+        for term in sorted(postings):
+            offset = out.tell()
+            out.write(array.array("I", (passage_id for passage_id, _ in postings[term])).tobytes())
+            out.write(array.array("H", (count for _, count in postings[term])).tobytes())
+            term_rows.append((term, len(postings[term]), offset))
+
+        term_table_offset = out.tell()
+        names = b""
+        for term, document_frequency, offset in term_rows:
+            out.write(TERM_ENTRY.pack(len(names), document_frequency, offset))
+            names += term.encode("utf-8") + b"\0"
+        names_offset = out.tell()
+        out.write(names)
+
+        average_length = sum(length for _, _, length in entries) / len(entries) if entries else 0.0
+        out.seek(0)
+        out.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries), len(term_rows), average_length,
+                              passage_table_offset, term_table_offset, names_offset))
+    os.replace(tmp_path, index_path)
+
+
+class GuidelineIndex:
+    """Read-only BM25 search over a memory-mapped guideline index"""
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.passage_count, term_count, self.average_length, \
+            self.passage_table_offset, term_table_offset, names_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{index_path} is not a guideline index")
+        self.lengths = [
+            PASSAGE_ENTRY.unpack_from(self.mm, self.passage_table_offset + i * PASSAGE_ENTRY.size)[2]
+            for i in range(self.passage_count)
+        ]
+        self.terms = {}  # term -> (document frequency, postings offset)
+        for i in range(term_count):
+            name_offset, document_frequency, offset = TERM_ENTRY.unpack_from(self.mm, term_table_offset + i * TERM_ENTRY.size)
+            start = names_offset + name_offset
+            name = self.mm[start:self.mm.find(b"\0", start)].decode("utf-8")
+            self.terms[name] = (document_frequency, offset)
+
+    def passage(self, passage_id):
+        offset, length, _ = PASSAGE_ENTRY.unpack_from(self.mm, self.passage_table_offset + passage_id * PASSAGE_ENTRY.size)
+        return json.loads(self.mm[offset:offset + length])
+
+    def _postings(self, term):
+        document_frequency, offset = self.terms[term]
+        ids = array.array("I")
+        ids.frombytes(self.mm[offset:offset + 4 * document_frequency])
+        counts = array.array("H")
+        counts.frombytes(self.mm[offset + 4 * document_frequency:offset + 6 * document_frequency])
+        return document_frequency, ids, counts
+
+    def search(self, query, k=DEFAULT_RESULTS):
+        """Best-matching passages for a question, each with its BM25 score"""
+        scores = {}
+        for term in set(tokenize(query)):
+            if term not in self.terms:
+                continue
+            document_frequency, ids, counts = self._postings(term)
+            idf = math.log(1 + (self.passage_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            for passage_id, count in zip(ids, counts):
+                norm = K1 * (1 - B + B * self.lengths[passage_id] / self.average_length)
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * count * (K1 + 1) / (count + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [dict(self.passage(passage_id), score=round(score, 3)) for passage_id, score in best]
+
+
+def open_guidelines(rules_id, source_dir=None, index_path=None):
+    """Open the index for a guideline set, (re)building it if a document is newer; None if there are no documents"""
+    source_dir = source_dir or os.path.join(GUIDELINES_DIR, rules_id)
+    if not os.path.isdir(source_dir):
+        return None
+    index_path = index_path or os.path.join(DATA_DIR, f"guidelines_{rules_id}.idx")
+    newest = max([os.path.getmtime(source_dir)] + [
+        os.path.getmtime(os.path.join(source_dir, name)) for name in os.listdir(source_dir) if name.endswith(".md")
+    ])
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < newest:
+        build_index(source_dir, index_path)
+    try:
+        return GuidelineIndex(index_path)
+    except ValueError:
+        # Written by an older version of this module
+        build_index(source_dir, index_path)
+        return GuidelineIndex(index_path)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    index = open_guidelines(sys.argv[1] if len(sys.argv) > 1 else "india_fogsi")
+    question = " ".join(sys.argv[2:]) or "Can I do anything to prevent cervical cancer?"
+    started = time.perf_counter()
+    results = index.search(question)
+    print(f"{index.passage_count} passages, {len(index.terms)} terms; searched in {(time.perf_counter() - started) * 1000:.2f} ms")
+    for result in results:
+        print(f"{result['score']:6.2f}  {result['title']} / {result['heading']}: {result['text'][:100]}...")
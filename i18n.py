@@ -0,0 +1,123 @@
+# Message catalogs for the Women's Health Navigator
+#
+# Source catalogs live in locales/<locale>.json as {"English message": "translation"}.
+# They are compiled to the standard gettext .mo format (a binary hash table) the first
+# time a locale is used, then loaded once per process and shared by every session.
+import gettext
+import io
+import json
+import os
+import struct
+import threading
+
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LOCALE = "en"
+
+# Locales offered in the language picker (English is the source language)
+SUPPORTED_LOCALES = {
+    "en": "English",
+    "mr": "मराठी (Marathi)",
+    "hi": "हिन्दी (Hindi)",
+    "or": "ଓଡ଼ିଆ (Odia)",
+    "sw": "Kiswahili (Swahili)",
+    "tw": "Twi",
+    "ha": "Hausa",
+}
+
+# Loaded catalogs, shared across all sessions in this process
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def compile_catalog(messages):
+    """Compile a {msgid: msgstr} dict into gettext .mo bytes"""
+    # Untranslated entries are left out so lookups fall back to the English source
+    entries = sorted((k.encode("utf-8"), v.encode("utf-8")) for k, v in messages.items() if v)
+    # The empty msgid carries the catalog header; we only need the charset
+    entries.insert(0, (b"", b"Content-Type: text/plain; charset=UTF-8\n"))
+
+    keys_start = 7 * 4
+    values_start = keys_start + len(entries) * 8
+    data_start = values_start + len(entries) * 8
+
+    key_table = []
+    value_table = []
+    data = io.BytesIO()
+    for key, _ in entries:
+        key_table.append((len(key), data_start + data.tell()))
+        data.write(key + b"\0")
+    for _, value in entries:
+        value_table.append((len(value), data_start + data.tell()))
+        data.write(value + b"\0")
+
+    output = io.BytesIO()
+    # Magic, revision, count, key table offset, value table offset, hash size, hash offset
+    output.write(struct.pack("<7I", 0x950412DE, 0, len(entries), keys_start, values_start, 0, 0))
+    for length, offset in key_table + value_table:
+        output.write(struct.pack("<2I", length, offset))
+    output.write(data.getvalue())
+    return output.getvalue()
+
+
+def _catalog_paths(locale):
+    source = os.path.join(LOCALES_DIR, f"{locale}.json")
+    compiled = os.path.join(LOCALES_DIR, f"{locale}.mo")
+    return source, compiled
+
+
+def _load_catalog(locale):
+    """Load a locale's compiled catalog, recompiling it if the source is newer"""
+    source, compiled = _catalog_paths(locale)
+    if not os.path.exists(source):
+        return gettext.NullTranslations()
+
+    if not os.path.exists(compiled) or os.path.getmtime(compiled) < os.path.getmtime(source):
+        with open(source, encoding="utf-8") as f:
+            mo_bytes = compile_catalog(json.load(f))
+        try:
+            # Write to a temporary file first so other workers never read a partial catalog
+            tmp_path = f"{compiled}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(mo_bytes)
+            os.replace(tmp_path, compiled)
+        except OSError:
+            # Read-only deployments still work, we just compile in memory each start
+            return gettext.GNUTranslations(io.BytesIO(mo_bytes))
+
+    with open(compiled, "rb") as f:
+        return gettext.GNUTranslations(f)
+
+
+def get_catalog(locale):
+    """Return the shared catalog for a locale, loading it on first use"""
+    catalog = _catalogs.get(locale)
+    if catalog is not None:
+        return catalog
+
+    with _catalogs_lock:
+        if locale not in _catalogs:
+            if locale == DEFAULT_LOCALE or locale not in SUPPORTED_LOCALES:
+                _catalogs[locale] = gettext.NullTranslations()
+            else:
+                _catalogs[locale] = _load_catalog(locale)
+        return _catalogs[locale]
+
+
+def translate(locale, message, **kwargs):
+    """Translate an English message template and fill in its placeholders"""
+    text = get_catalog(locale or DEFAULT_LOCALE).gettext(message)
+    return text.format(**kwargs) if kwargs else text
+
+
+def compile_all():
+    """Compile every source catalog in the locales directory"""
+    with _catalogs_lock:
+        _catalogs.clear()
+    for locale in SUPPORTED_LOCALES:
+        if locale != DEFAULT_LOCALE:
+            get_catalog(locale)
+
+
+if __name__ == "__main__":
+    compile_all()
+    print(f"Compiled catalogs in {LOCALES_DIR}")
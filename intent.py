@@ -0,0 +1,137 @@
+# Local intent classifier for free-text answers
+#
+# A small TF-IDF model over character n-grams, trained per stage on the stage's
+# quick-reply options plus the matching vocabularies. It runs on CPU with no
+# network calls and only handles answers the keyword/fuzzy path could not place.
+import math
+import re
+from collections import Counter, defaultdict
+
+from matching import STAGE_VOCABULARIES, normalize, scan_answer
+
+# Options that the stage code handles itself and the model should never guess
+EXCLUDED_OPTIONS = {"Skip", "Continue"}
+MIN_CONFIDENCE = 0.35
+NGRAM_SIZES = (2, 3, 4)
+MAX_TEXT_LENGTH = 200
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def extract_features(text):
+    """Character n-gram counts of a normalized answer, including word boundaries"""
+    text = f" {normalize(text[:MAX_TEXT_LENGTH])} "
+    features = Counter()
+    for size in NGRAM_SIZES:
+        for i in range(len(text) - size + 1):
+            features[text[i:i + size]] += 1
+    return features
+
+
+class StageModel:
+    """Nearest-centroid TF-IDF classifier for one stage's options"""
+
+    def __init__(self, examples):
+        # examples: {option: [example texts]}
+        document_frequency = Counter()
+        documents = []
+        for option, texts in examples.items():
+            for text in texts:
+                features = extract_features(text)
+                documents.append((option, features))
+                document_frequency.update(features.keys())
+
+        total = len(documents)
+        self.idf = {gram: math.log((1 + total) / (1 + count)) + 1 for gram, count in document_frequency.items()}
+
+        centroids = defaultdict(Counter)
+        for option, features in documents:
+            for gram, weight in self._weigh(features).items():
+                centroids[option][gram] += weight
+        self.centroids = {option: self._unit(vector) for option, vector in centroids.items()}
+
+        # Inverted index from n-gram to (option, weight) so scoring only touches shared n-grams
+        self.postings = defaultdict(list)
+        for option, vector in self.centroids.items():
+            for gram, weight in vector.items():
+                self.postings[gram].append((option, weight))
+
+    def _weigh(self, features):
+        return self._unit({gram: (1 + math.log(count)) * self.idf[gram]
+                           for gram, count in features.items() if gram in self.idf})
+
+    @staticmethod
+    def _unit(vector):
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {gram: weight / norm for gram, weight in vector.items()} if norm else {}
+
+    def predict(self, text):
+        """Return (option, cosine similarity) for the closest option"""
+        scores = defaultdict(float)
+        for gram, weight in self._weigh(extract_features(text)).items():
+            for option, option_weight in self.postings.get(gram, ()):
+                scores[option] += weight * option_weight
+        if not scores:
+            return None, 0.0
+        option = max(scores, key=scores.get)
+        return option, scores[option]
+
+
+class IntentClassifier:
+    """Maps free-text answers to each stage's canonical quick-reply options"""
+
+    def __init__(self, stage_options, min_confidence=MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self.models = {}
+        for stage, options in stage_options.items():
+            examples = {option: [option] for option in options if option not in EXCLUDED_OPTIONS}
+            # The matching vocabularies double as labelled training examples
+            for term, option in STAGE_VOCABULARIES.get(stage, {}).items():
+                if option in examples:
+                    examples[option].append(term)
+            if examples:
+                self.models[stage] = StageModel(examples)
+
+    def predict(self, stage, text):
+        """Return (option, confidence) from the model, or (None, confidence) below the threshold"""
+        model = self.models.get(stage)
+        if model is None or not text.strip():
+            return None, 0.0
+        option, confidence = model.predict(text)
+        if confidence < self.min_confidence:
+            return None, confidence
+        return option, confidence
+
+    def predict_batch(self, items):
+        """Classify many (stage, text) pairs at once, e.g. an SMS gateway batch"""
+        # Identical answers to the same stage are common in bulk replies, so score each once
+        cache = {}
+        results = []
+        for stage, text in items:
+            key = (stage, _SPACE_RE.sub(" ", text.strip().lower()))
+            if key not in cache:
+                cache[key] = self.classify(stage, text)
+            results.append(cache[key])
+        return results
+
+    def classify(self, stage, text):
+        """Keyword/fuzzy match first, then the model for misses; returns (option, confidence)"""
+        options, negated = scan_answer(stage, text)
+        if options:
+            return options[0], 1.0
+        # The model can't read negation, so it would pick the very option the answer rules out
+        if negated:
+            return None, 0.0
+        return self.predict(stage, text)
+
+    def match(self, stage, text):
+        """Return the best canonical option for a free-text answer, or None"""
+        return self.classify(stage, text)[0]
+
+    def match_all(self, stage, text):
+        """Return every canonical option mentioned in a multi-select answer"""
+        options, negated = scan_answer(stage, text)
+        if options or negated:
+            return options
+        option = self.predict(stage, text)[0]
+        return [option] if option is not None and option != "Other" else []
@@ -0,0 +1,345 @@
+# Language model replies, streamed token by token
+#
+# A StreamedReply wraps a streaming chat completion: iterating it yields text as it
+# arrives (so the app can render it straight into the chat bubble) while it records
+# time to first token and total generation time. Closing it early, e.g. when the user
+# sends a new message mid-reply, stops the upstream request and keeps what was received.
+# Prompts stay the same size however long a journey gets: older turns are folded into a
+# running summary as they leave the recent window, next to a digest of the user's profile.
+# In the app, replies are generated on a shared background pool (start_reply) so the
+# script thread only renders what has arrived so far and is free between polls. The
+# stream is read on its own thread and the pool worker checks for cancellation between
+# chunks and on a short timeout, so a stalled stream can still be stopped.
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import openai
+
+DEFAULT_MODEL = os.environ.get("NAVIGATOR_LLM_MODEL", "gpt-3.5-turbo")
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_REPLY_TOKENS = 300
+# Shorter prompts and replies for sessions past their soft budget
+SOFT_REPLY_TOKENS = 150
+RECENT_MESSAGES = 8
+# Replies generated at once per process; each holds an upstream connection, not a CPU
+BACKGROUND_WORKERS = int(os.environ.get("NAVIGATOR_LLM_WORKERS", "32"))
+# How often a background reply checks for cancellation while no chunks arrive
+CANCEL_CHECK_SECONDS = 0.25
+
+SYSTEM_PROMPT = (
+    "You are the Women's Health Navigator, a friendly assistant helping women in low-resource "
+    "settings understand preventive screening and follow-up care. Answer in plain, short "
+    "sentences. You do not diagnose; for anything specific to the user's results, encourage "
+    "them to talk to their doctor or community health worker {chw_name}."
+)
+
+
+class StreamedReply:
+    """Iterates over a model reply as it is generated, timing it"""
+
+    def __init__(self, chunks, started):
+        self.chunks = chunks
+        self.started = started
+        self.parts = []
+        self.first_token_at = None
+        self.finished_at = None
+        self.cancelled = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.cancelled:
+                # Closed from another thread while this one waited for the chunk
+                self._close_chunks()
+                return
+            token = chunk["choices"][0].get("delta", {}).get("content")
+            if not token:
+                continue
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            self.parts.append(token)
+            yield token
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+
+    def _close_chunks(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            try:
+                close()
+            except ValueError:
+                # Another thread is blocked reading it; it stops at the next chunk
+                pass
+
+    def close(self):
+        """Stop generating; anything received so far is kept"""
+        if self.finished_at is None:
+            self.cancelled = True
+            self.finished_at = time.perf_counter()
+            self._close_chunks()
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def metrics(self):
+        """Time to first token and total time in milliseconds, with the token count"""
+        finished = self.finished_at or time.perf_counter()
+        return {
+            "ttft_ms": round((self.first_token_at - self.started) * 1000, 1) if self.first_token_at else None,
+            "total_ms": round((finished - self.started) * 1000, 1),
+            "tokens": len(self.parts),
+            "cancelled": self.cancelled,
+        }
+
+
+GUIDELINES_PROMPT = (
+    "Base your answer on these passages from the local clinical guidelines. If they don't "
+    "cover the question, say so and suggest asking a health worker.\n\n{passages}"
+)
+MEMORY_PROMPT = "What you know about this user:\n{digest}\n\nEarlier in the conversation:\n{summary}"
+
+# Prompt budget per call, in estimated tokens; the parts are trimmed in this order of priority:
+# system prompt and question, guideline passages, profile digest, recent turns, summary
+CONTEXT_TOKEN_BUDGET = 1500
+SOFT_CONTEXT_TOKEN_BUDGET = 900
+RECENT_TOKEN_BUDGET = 500
+SUMMARY_TOKEN_BUDGET = 250
+SUMMARY_LINE_CHARS = 120
+QUESTION_TOKEN_LIMIT = 200
+
+# Profile fields worth telling the model, with how to label them
+DIGEST_FIELDS = [
+    ("age", "age"), ("current_location", "location"), ("annual_checkup", "annual check-up"),
+    ("cervical_screening", "cervical screening"), ("breast_screening", "breast screening"),
+    ("pregnancies", "pregnancies"), ("presenting_complaints", "complaints"),
+    ("family_history_cancer", "family history of cancer"), ("chronic_conditions", "chronic conditions"),
+    ("tobacco_use", "tobacco"), ("alcohol_use", "alcohol"), ("physical_activity", "activity"),
+]
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def _plain(text):
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]+>", "", text)).strip()
+
+
+def new_memory():
+    """Running conversation summary: kept in session state and extended as turns age out"""
+    return {"lines": [], "summarized": 0, "omitted": 0, "folded_tokens": 0}
+
+
+def _summary_line(message):
+    text = _plain(message["content"])
+    if message["role"] == "assistant":
+        # The first sentence says what was asked or told
+        text = re.split(r"(?<=[.?!])\s", text, maxsplit=1)[0]
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS - 1] + "…"
+    return f"{'Navigator' if message['role'] == 'assistant' else 'User'}: {text}"
+
+
+def update_summary(memory, history, upto):
+    """Fold messages that left the recent window into the summary; only new ones are read"""
+    for message in history[memory["summarized"]:upto]:
+        memory["lines"].append(_summary_line(message))
+        memory["folded_tokens"] = memory.get("folded_tokens", 0) + estimate_tokens(_plain(message["content"]))
+    memory["summarized"] = max(memory["summarized"], upto)
+    # Oldest lines go first once the summary is over its budget
+    while memory["lines"] and sum(estimate_tokens(line) for line in memory["lines"]) > SUMMARY_TOKEN_BUDGET:
+        memory["lines"].pop(0)
+        memory["omitted"] += 1
+
+
+def summary_savings(memory):
+    """Prompt tokens per call saved by sending the summary instead of the turns it covers"""
+    return max(memory.get("folded_tokens", 0) - sum(estimate_tokens(line) for line in memory["lines"]), 0)
+
+
+def prompt_tokens(messages):
+    """Estimated size of a prompt"""
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+def profile_digest(profile, test_results=None):
+    """One line of the facts the user has shared, leaving out empty answers"""
+    facts = []
+    for key, label in DIGEST_FIELDS:
+        value = profile.get(key)
+        if value is None or value == "" or value == [] or (key in ("age", "pregnancies") and not value):
+            continue
+        if isinstance(value, list):
+            value = ", ".join(value)
+        elif isinstance(value, bool):
+            value = "yes" if value else "no"
+        facts.append(f"{label}: {value}")
+    for test, result in (test_results or {}).items():
+        if result:
+            facts.append(f"{test} result: {result.replace('_', ' ')}")
+    return "; ".join(facts) or "nothing yet"
+
+
+def _clip(text, tokens):
+    """Shorten text to about a number of tokens"""
+    return text if estimate_tokens(text) <= tokens else text[:max(tokens, 1) * 4 - 1] + "…"
+
+
+def chat_messages(memory, history, question, chw_name, profile=None, test_results=None, passages=None,
+                  budget=CONTEXT_TOKEN_BUDGET, limit=RECENT_MESSAGES):
+    """Prompt for a reply within the token budget: system prompt, guideline passages, profile
+    digest and running summary, as many recent turns verbatim as fit, then the question"""
+    # The question is usually the newest message already
+    if history and history[-1]["role"] == "user" and history[-1]["content"] == question:
+        history = history[:-1]
+    if memory["summarized"] > len(history):
+        # The conversation was reset
+        memory.update(new_memory())
+    system = SYSTEM_PROMPT.format(chw_name=chw_name)
+    question = _clip(question, QUESTION_TOKEN_LIMIT)
+    digest = profile_digest(profile or {}, test_results)
+    remaining = budget - estimate_tokens(system) - estimate_tokens(question) - estimate_tokens(digest) - estimate_tokens(MEMORY_PROMPT)
+
+    # Guideline passages, best first, leaving room for the recent turns and the summary
+    grounding = None
+    if passages:
+        room = remaining - RECENT_TOKEN_BUDGET - SUMMARY_TOKEN_BUDGET
+        quoted = []
+        for p in passages:
+            text = _clip(f"[{p['title']}: {p['heading']}] {p['text']}", room)
+            if room <= 0 or (quoted and estimate_tokens(text) > room):
+                break
+            quoted.append(text)
+            room -= estimate_tokens(text)
+        if quoted:
+            grounding = GUIDELINES_PROMPT.format(passages="\n\n".join(quoted))
+            remaining -= estimate_tokens(grounding)
+
+    # Recent turns, newest first, until the message limit or the recent budget is reached
+    recent = []
+    recent_budget = min(RECENT_TOKEN_BUDGET, remaining - SUMMARY_TOKEN_BUDGET)
+    start = len(history)
+    while start > memory["summarized"] and len(recent) < limit and recent_budget > 0:
+        content = _clip(_plain(history[start - 1]["content"]), recent_budget)
+        recent_budget -= estimate_tokens(content)
+        recent.insert(0, {"role": history[start - 1]["role"], "content": content})
+        start -= 1
+
+    # Everything older lives in the running summary
+    update_summary(memory, history, start)
+    lines = memory["lines"]
+    if memory["omitted"]:
+        lines = [f"({memory['omitted']} earlier lines omitted)"] + lines
+    context = MEMORY_PROMPT.format(digest=digest, summary="\n".join(lines) or "nothing yet")
+
+    messages = [{"role": "system", "content": system}]
+    if grounding:
+        messages.append({"role": "system", "content": grounding})
+    messages.append({"role": "system", "content": context})
+    messages.extend(recent)
+    messages.append({"role": "user", "content": question})
+    return messages
+
+
+def stream_reply(messages, api_key=None, model=DEFAULT_MODEL, max_tokens=MAX_REPLY_TOKENS):
+    """Start a streaming completion; raises openai.error.OpenAIError if the request fails"""
+    started = time.perf_counter()
+    chunks = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        stream=True,
+        api_key=api_key or None,
+        request_timeout=REQUEST_TIMEOUT_SECONDS,
+    )
+    return StreamedReply(chunks, started)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def background_executor():
+    """The process-wide pool that slow model calls run on"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="llm")
+    return _executor
+
+
+class PendingReply:
+    """A model reply being generated in the background; poll it from the UI thread"""
+
+    def __init__(self):
+        self.reply = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.requested = False  # whether the request was sent, so it may be billed
+        self.cancel_requested = False
+        self.future = None
+
+    def _run(self, messages, api_key, model, max_tokens):
+        if self.cancel_requested:
+            return  # cancelled while queued: nothing was sent
+        self.requested = True
+        try:
+            self.reply = stream_reply(messages, api_key=api_key, model=model, max_tokens=max_tokens)
+        except openai.error.OpenAIError as e:
+            self.error = e
+            return
+        reader = threading.Thread(target=self._read, name="llm-stream", daemon=True)
+        reader.start()
+        # Check for cancellation on a timeout too: a stalled stream may not send another chunk
+        while reader.is_alive() and not self.cancel_requested:
+            reader.join(CANCEL_CHECK_SECONDS)
+        self.reply.close()
+
+    def _read(self):
+        try:
+            for _ in self.reply:
+                pass
+        except openai.error.OpenAIError as e:
+            self.error = e
+
+    @property
+    def done(self):
+        return self.future.done()
+
+    @property
+    def text(self):
+        """What has been generated so far"""
+        return self.reply.text if self.reply is not None else ""
+
+    @property
+    def cancelled(self):
+        """Whether the reply was stopped before the model finished it"""
+        if self.reply is None:
+            return self.cancel_requested
+        return self.reply.cancelled or self.cancel_requested and self.reply.finished_at is None
+
+    def close(self):
+        """Ask the worker to stop; what was generated so far is kept"""
+        self.cancel_requested = True
+
+    def wait(self, timeout=None):
+        """Block until the worker finishes or the timeout passes"""
+        wait([self.future], timeout)
+
+    def metrics(self):
+        if self.reply is not None:
+            return {**self.reply.metrics(), "cancelled": self.cancelled}
+        return {"ttft_ms": None, "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                "tokens": 0, "cancelled": self.cancelled}
+
+
+def start_reply(messages, api_key=None, model=DEFAULT_MODEL, max_tokens=MAX_REPLY_TOKENS):
+    """Generate a reply on the background pool; returns a PendingReply straight away"""
+    pending = PendingReply()
+    pending.future = background_executor().submit(pending._run, messages, api_key, model, max_tokens)
+    return pending
@@ -0,0 +1,349 @@
+# Typo- and transliteration-tolerant matching for free-text answers
+#
+# Each waiting_* stage has a vocabulary of English words, romanized Hindi/Marathi
+# words and a few native-script words, all mapped to the stage's canonical options.
+# Vocabularies are indexed in BK-trees (one per term length in words) once per
+# process; lookups normalize the romanization, then search every 1-3 word phrase of
+# the message within a small edit distance among the terms of as many words. A phrase right after an English negation ("not married") or right
+# before a Hindi/Marathi one ("shaadi nahi") is not taken as an answer. The work per
+# message is capped in edit distance table cells, and words too long to be within a
+# few edits of any vocabulary word are never compared, so the worst case stays at a
+# few milliseconds and a given message always gets the same answer however busy the
+# machine is.
+import re
+import threading
+
+# Hard cap on matching work per message
+MAX_TOKENS = 24
+MAX_PHRASE_WORDS = 3
+# Edit distance table cells per message; short answers need a few hundred, long
+# messages get exact hits only once it runs out
+MAX_DISTANCE_CELLS = 3000
+# Words longer than the stage's longest vocabulary word by more than this can't match
+MAX_EXTRA_CHARS = 2
+
+YES_WORDS = {
+    "yes": "Yes", "yeah": "Yes", "yep": "Yes", "ok": "Yes",
+    "haan": "Yes", "han": "Yes", "haa": "Yes", "ji": "Yes", "ho": "Yes", "hoy": "Yes",
+    "हाँ": "Yes", "हां": "Yes", "होय": "Yes",
+}
+NO_WORDS = {
+    "no": "No", "nope": "No", "never": "No",
+    "nahi": "No", "nahin": "No", "nai": "No", "nako": "No", "nahee": "No",
+    "नहीं": "No", "नाही": "No",
+}
+DONT_KNOW_WORDS = {
+    "dont know": "I don't know", "not sure": "I don't know",
+    "pata nahi": "I don't know", "maloom nahi": "I don't know", "mahit nahi": "I don't know",
+}
+
+# Vocabularies per stage. Entries that appear earlier win ties, so negations are listed
+# before topic words in stages like tobacco ("tambaku nahi" means No).
+STAGE_VOCABULARIES = {
+    "waiting_marital_status": {
+        "single": "Single", "unmarried": "Single", "kunwari": "Single", "avivahit": "Single",
+        "married": "Married", "shaadi": "Married", "shadi": "Married", "vivahit": "Married",
+        "lagna": "Married", "lagn": "Married", "husband": "Married", "pati": "Married",
+        "widow": "Widowed", "widowed": "Widowed", "vidhwa": "Widowed", "vidhava": "Widowed",
+        "divorced": "Divorced", "divorce": "Divorced", "separated": "Divorced",
+        "talak": "Divorced", "talaq": "Divorced", "ghatasphot": "Divorced",
+    },
+    "waiting_education": {
+        "no formal education": "No formal education", "illiterate": "No formal education",
+        "anpadh": "No formal education", "school nahi": "No formal education",
+        "primary": "Primary", "elementary": "Primary", "prathmik": "Primary",
+        "secondary": "Secondary", "high school": "Secondary", "madhyamik": "Secondary",
+        "matric": "Secondary", "tenth": "Secondary", "10th": "Secondary", "12th": "Secondary",
+        "ssc": "Secondary", "hsc": "Secondary",
+        "higher": "Higher", "college": "Higher", "university": "Higher",
+        "graduate": "Higher", "degree": "Higher",
+    },
+    "waiting_menstrual_regularity": {
+        "irregular": "Irregular", "not regular": "Irregular", "aniyamit": "Irregular",
+        "regular": "Regular", "niyamit": "Regular", "time par": "Regular",
+        "menopause": "Menopause", "masik band": "Menopause", "period band": "Menopause",
+        "not applicable": "Not applicable",
+    },
+    "waiting_contraceptive": {
+        "none": "None", "nothing": "None", "kuch nahi": "None",
+        "pills": "Oral Pills", "oral pills": "Oral Pills", "goli": "Oral Pills", "mala d": "Oral Pills",
+        "iud": "IUD", "copper t": "IUD", "coil": "IUD",
+        "condoms": "Condoms", "nirodh": "Condoms",
+        "sterilization": "Sterilization", "operation": "Sterilization", "nasbandi": "Sterilization",
+        "other": "Other",
+    },
+    "waiting_complaints": {
+        "pelvic pain": "Pelvic pain", "pain": "Pelvic pain", "cramps": "Pelvic pain",
+        "dard": "Pelvic pain", "pet dard": "Pelvic pain", "vedana": "Pelvic pain",
+        "discharge": "Vaginal discharge", "safed pani": "Vaginal discharge", "white discharge": "Vaginal discharge",
+        "bleeding": "Irregular bleeding", "spotting": "Irregular bleeding", "khoon": "Irregular bleeding",
+        "painful sex": "Pain during intercourse", "intercourse": "Pain during intercourse",
+        "urinary": "Urinary issues", "urine": "Urinary issues", "peshab": "Urinary issues",
+        "jalan": "Urinary issues", "burning": "Urinary issues", "pee": "Urinary issues", "bladder": "Urinary issues",
+    },
+    "waiting_chronic_conditions": {
+        "hypertension": "Hypertension", "blood pressure": "Hypertension", "bp": "Hypertension",
+        "diabetes": "Diabetes", "sugar": "Diabetes", "madhumeh": "Diabetes",
+        "anemia": "Anemia", "anaemia": "Anemia", "khoon ki kami": "Anemia", "iron": "Anemia",
+        "thyroid": "Thyroid disorder",
+        "infection": "STI/RTI", "sti": "STI/RTI", "std": "STI/RTI",
+    },
+    "waiting_annual_checkup": {
+        **NO_WORDS, **{term: "Not sure" for term in DONT_KNOW_WORDS}, **YES_WORDS, "checkup": "Yes",
+    },
+    "waiting_cervical_screening": {**NO_WORDS, **DONT_KNOW_WORDS, **YES_WORDS, "pap": "Yes", "hpv": "Yes"},
+    "waiting_breast_screening": {**NO_WORDS, **DONT_KNOW_WORDS, **YES_WORDS, "mammogram": "Yes"},
+    "waiting_family_history": {**NO_WORDS, **DONT_KNOW_WORDS, **YES_WORDS, "cancer": "Yes"},
+    "waiting_tobacco": {
+        **NO_WORDS, **YES_WORDS,
+        "tobacco": "Yes", "tambaku": "Yes", "tambakhu": "Yes", "gutka": "Yes", "gutkha": "Yes",
+        "bidi": "Yes", "beedi": "Yes", "cigarette": "Yes", "smoke": "Yes", "mishri": "Yes", "khaini": "Yes",
+    },
+    "waiting_alcohol": {
+        **NO_WORDS, **YES_WORDS,
+        "alcohol": "Yes", "drink": "Yes", "daru": "Yes", "daaru": "Yes", "sharab": "Yes",
+        "beer": "Yes", "toddy": "Yes", "tadi": "Yes",
+    },
+    "waiting_physical_activity": {
+        "very active": "Very active", "bahut": "Very active",
+        "moderately active": "Moderately active", "moderate": "Moderately active", "thoda": "Moderately active",
+        "lightly active": "Lightly active", "walk": "Lightly active", "walking": "Lightly active", "chalna": "Lightly active",
+        "sedentary": "Sedentary", "baithe": "Sedentary", "aaram": "Sedentary",
+    },
+}
+
+_WORD_RE = re.compile(r"\w+")
+# Common spelling variants of romanized Hindi/Marathi, applied to vocabulary and input alike
+_TRANSLITERATION_RULES = [
+    # Long vowels before doubled letters collapse, or they would never be seen
+    (re.compile(r"ee"), "i"),         # nahee -> nahi
+    (re.compile(r"oo"), "u"),
+    (re.compile(r"(.)\1+"), r"\1"),   # shaadi -> shadi, married -> marid
+    (re.compile(r"ph"), "f"),
+    (re.compile(r"w"), "v"),
+    (re.compile(r"z"), "j"),
+    (re.compile(r"q"), "k"),
+    (re.compile(r"(?<=[aeiou])n$"), ""),  # nahin -> nahi
+]
+
+
+def normalize(text):
+    """Lowercase a phrase and fold common transliteration variants"""
+    words = []
+    for word in _WORD_RE.findall(text.lower().replace("'", "")):
+        for pattern, replacement in _TRANSLITERATION_RULES:
+            word = pattern.sub(replacement, word)
+        words.append(word)
+    return " ".join(words)
+
+
+# Negations that come before what they negate in English, and after it in Hindi/Marathi
+NEGATIONS_BEFORE = {normalize(word) for word in ("not", "no", "never", "dont", "didnt", "doesnt", "havent", "isnt", "without")}
+NEGATIONS_AFTER = {normalize(word) for word in ("nahi", "nahin", "nahee", "nai", "nako", "na")}
+
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def bounded_edit_distance(a, b, limit):
+    """(Levenshtein distance, or limit + 1 if it is larger; table cells computed)
+
+    Only a band of limit cells either side of the diagonal is filled in, and the table
+    stops as soon as a whole row is over the limit
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if len(a) - len(b) > limit:
+        return limit + 1, 0
+    over = limit + 1
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    cells = 0
+    for i, ca in enumerate(a, 1):
+        low, high = max(1, i - limit), min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        row_min = current[0]
+        for j in range(low, high + 1):
+            value = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] < value:
+                value = previous[j] + 1
+            if current[j - 1] < value:
+                value = current[j - 1] + 1
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        cells += high - low + 1
+        if row_min > limit:
+            return over, cells
+        previous = current
+    return min(previous[-1], over), cells
+
+
+def allowed_distance(term):
+    """How many edits we tolerate for a vocabulary term of this length"""
+    if len(term) <= 3:
+        return 0
+    if len(term) <= 5:
+        return 1
+    return 2
+
+
+class BKTree:
+    """Burkhard-Keller tree for nearest-term lookups under edit distance"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, term, payload):
+        if self.root is None:
+            self.root = (term, [payload], {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(term, node[0])
+            if distance == 0:
+                node[1].append(payload)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (term, [payload], {})
+                return
+            node = child
+
+    def search(self, term, radius, max_cells=None):
+        """Return ([(distance, term, payloads)] for terms within radius, edit distance cells used)
+
+        With max_cells the search stops before a comparison that would go over it, missing
+        the terms it didn't reach
+        """
+        results = []
+        cells = 0
+        if self.root is None:
+            return results, cells
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            # Past the largest edge plus the radius no child can qualify, so the distance is
+            # only needed up to there; a comparison costs at most its band of cells
+            limit = max(node[2], default=0) + radius
+            if max_cells is not None and cells + len(term) * (2 * limit + 1) > max_cells:
+                break
+            if abs(len(term) - len(node[0])) > limit:
+                distance = limit + 1
+            else:
+                distance, used = bounded_edit_distance(term, node[0], limit)
+                cells += used
+            if distance <= radius:
+                results.append((distance, node[0], node[1]))
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        return results, cells
+
+
+class StageMatcher:
+    """Fuzzy matcher over one stage's vocabulary"""
+
+    def __init__(self, vocabulary):
+        self.trees = {}  # words per term -> BK-tree of those terms
+        self.exact = {}
+        longest_word = 0
+        for rank, (term, value) in enumerate(vocabulary.items()):
+            normalized = normalize(term)
+            if not normalized:
+                continue
+            self.trees.setdefault(len(normalized.split()), BKTree()).add(normalized, (rank, value))
+            self.exact.setdefault(normalized, (rank, value))
+            longest_word = max(longest_word, *(len(word) for word in normalized.split()))
+        self.max_word_chars = longest_word + MAX_EXTRA_CHARS
+
+    def scan(self, text):
+        """Return ([(distance, -words, rank, position, value)] for every phrase that matches, negated values)"""
+        tokens = normalize(" ".join(_WORD_RE.findall(text.lower().replace("'", ""))[:MAX_TOKENS])).split()
+        cells_left = MAX_DISTANCE_CELLS
+        found = []
+        negated = []
+        for size in range(1, MAX_PHRASE_WORDS + 1):
+            for start in range(len(tokens) - size + 1):
+                words = tokens[start:start + size]
+                phrase = " ".join(words)
+                hit = self.exact.get(phrase)
+                if hit is not None:
+                    hits = [(0, hit)]
+                elif cells_left > 0 and size in self.trees and all(len(word) <= self.max_word_chars for word in words):
+                    # A phrase is only compared with terms of as many words
+                    results, cells = self.trees[size].search(phrase, 2, cells_left)
+                    cells_left -= cells
+                    hits = [(distance, payload) for distance, term, payloads in results
+                            if distance <= allowed_distance(term) for payload in payloads]
+                else:
+                    # Out of budget, or a word too long to be a typo of any term: exact hits only
+                    continue
+                if not hits:
+                    continue
+                # Vocabulary phrases that carry their own negation ("not sure") stand as they are
+                if not NEGATIONS_BEFORE.intersection(words) and not NEGATIONS_AFTER.intersection(words) and (
+                        start > 0 and tokens[start - 1] in NEGATIONS_BEFORE
+                        or start + size < len(tokens) and tokens[start + size] in NEGATIONS_AFTER):
+                    negated.extend(value for _, (rank, value) in hits)
+                    continue
+                found.extend((distance, -size, rank, start, value) for distance, (rank, value) in hits)
+        # Closest match first, preferring longer phrases, then vocabulary order
+        found.sort()
+        return found, negated
+
+    def matches(self, text):
+        """Return [(distance, -words, rank, position, value)] for every phrase that matches"""
+        return self.scan(text)[0]
+
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def get_matcher(stage):
+    """Return the shared matcher for a stage, building it on first use"""
+    matcher = _matchers.get(stage)
+    if matcher is None and stage in STAGE_VOCABULARIES:
+        with _matchers_lock:
+            matcher = _matchers.get(stage)
+            if matcher is None:
+                matcher = _matchers[stage] = StageMatcher(STAGE_VOCABULARIES[stage])
+    return matcher
+
+
+def scan_answer(stage, text):
+    """Return (options mentioned, best first; options only mentioned to negate them) in one scan"""
+    matcher = get_matcher(stage)
+    if matcher is None:
+        return [], []
+    found, negated = matcher.scan(text)
+    options = list(dict.fromkeys(match[-1] for match in found))
+    return options, [value for value in dict.fromkeys(negated) if value not in options]
+
+
+def fuzzy_match(stage, text):
+    """Return the single best canonical option for a free-text answer, or None"""
+    options = scan_answer(stage, text)[0]
+    return options[0] if options else None
+
+
+def negated_options(stage, text):
+    """Canonical options a free-text answer mentions only to negate ("not married")"""
+    return scan_answer(stage, text)[1]
+
+
+def fuzzy_match_all(stage, text):
+    """Return every canonical option mentioned in a free-text answer, best first"""
+    return scan_answer(stage, text)[0]
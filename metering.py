@@ -0,0 +1,200 @@
+# Language model usage metering and budgets
+#
+# Every model call is recorded with its prompt and completion tokens, latency and the
+# prompt tokens the running summary saved. Recording only appends to a queue, so the
+# reply path never waits on a lock or the disk; a background thread folds the queue into
+# per-session, per-stage and per-tenant totals every flush interval, writes this
+# process's snapshot to data/metrics/ and reads back the other processes' tenant totals
+# for the daily budgets. Sessions with no calls for an hour are dropped from the
+# per-session totals and only counted, so the snapshot stays the size of the live ones.
+# Sessions past their soft budget get shorter prompts and replies; past the hard budget
+# (or when the tenant's daily budget is spent) they get the scripted replies.
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import date
+
+METRICS_DIR = os.environ.get(
+    "NAVIGATOR_METRICS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "metrics"),
+)
+FLUSH_INTERVAL_SECONDS = 30
+SESSION_IDLE_SECONDS = 3600
+
+# US dollars per 1,000 prompt and completion tokens
+PRICES = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+}
+DEFAULT_PRICE = PRICES["gpt-3.5-turbo"]
+
+# Budgets, unless a tenant config sets its own under "llm_budget"
+DEFAULT_BUDGET = {
+    "session_soft_tokens": 12000,
+    "session_hard_tokens": 20000,
+    "tenant_daily_usd": 25.0,
+}
+
+# Budget states
+WITHIN_BUDGET = "ok"
+SOFT_LIMIT = "soft"
+HARD_LIMIT = "hard"
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "cost_usd", "latency_ms", "saved_tokens", "cancelled")
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    """Price of one call in US dollars"""
+    prompt_price, completion_price = PRICES.get(model, DEFAULT_PRICE)
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def new_usage():
+    """Zeroed usage totals"""
+    return dict.fromkeys(USAGE_FIELDS, 0)
+
+
+def add_usage(total, call):
+    """Add one call (or another total) into a usage total"""
+    for field in USAGE_FIELDS:
+        total[field] = total.get(field, 0) + call.get(field, 0)
+    return total
+
+
+def budget_status(usage, tenant, tenant_spent_today=0.0):
+    """Whether a session may still use the model, given its usage and its tenant's spend today"""
+    budget = dict(DEFAULT_BUDGET, **tenant.get("llm_budget", {}))
+    tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+    if tokens >= budget["session_hard_tokens"] or tenant_spent_today >= budget["tenant_daily_usd"]:
+        return HARD_LIMIT
+    if tokens >= budget["session_soft_tokens"]:
+        return SOFT_LIMIT
+    return WITHIN_BUDGET
+
+
+class UsageMeter:
+    """Collects model usage for one process and keeps its totals and snapshot current"""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL_SECONDS, session_idle=SESSION_IDLE_SECONDS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.session_idle = session_idle
+        self.path = os.path.join(directory, f"{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:6]}.json")
+        # deque.append is atomic, so recording needs no lock
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.totals = {"session": {}, "stage": {}, "tenant": {}, "tenant_day": {}, "finished_sessions": 0}
+        self.session_seen = {}  # session -> monotonic time of its latest call
+        self.other_tenant_days = {}  # tenant:day -> cost in other processes, as of the last flush
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, name="usage-meter-flush", daemon=True)
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                # Try again next interval; the totals are still in memory
+                continue
+
+    def close(self):
+        """Stop the background flushes and write the final snapshot"""
+        self.stopped.set()
+        self.flusher.join()
+        self.flush(force=True)
+
+    def record(self, tenant_id, session, stage, model, prompt_tokens, completion_tokens, latency_ms,
+               saved_tokens=0, cancelled=False):
+        """Queue one call's usage; returns it with its cost so the caller can keep a session total"""
+        call = {
+            "calls": 1,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": call_cost(model, prompt_tokens, completion_tokens),
+            "latency_ms": latency_ms or 0,
+            "saved_tokens": saved_tokens,
+            "cancelled": int(bool(cancelled)),
+        }
+        self.pending.append((tenant_id, session, stage, date.today().isoformat(), call))
+        return call
+
+    def _drain(self):
+        now = time.monotonic()
+        while True:
+            try:
+                tenant_id, session, stage, day, call = self.pending.popleft()
+            except IndexError:
+                return
+            self.session_seen[session] = now
+            for scope, key in (("session", session), ("stage", stage), ("tenant", tenant_id),
+                               ("tenant_day", f"{tenant_id}:{day}")):
+                add_usage(self.totals[scope].setdefault(key, new_usage()), call)
+
+    def flush(self, force=False):
+        """Fold queued calls into the totals and write the snapshot; one thread at a time, others skip"""
+        if not self.lock.acquire(blocking=force):
+            return
+        try:
+            self._drain()
+            self._evict_idle_sessions()
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"updated": time.time(), "totals": self.totals}, f)
+            os.replace(tmp_path, self.path)
+            # Spend by the other processes serving the same tenants
+            other = {}
+            for snapshot in _snapshots(self.directory, exclude=self.path):
+                for key, usage in snapshot["totals"].get("tenant_day", {}).items():
+                    other[key] = other.get(key, 0.0) + usage["cost_usd"]
+            self.other_tenant_days = other
+        finally:
+            self.lock.release()
+
+    def _evict_idle_sessions(self):
+        cutoff = time.monotonic() - self.session_idle
+        idle = [session for session, seen in self.session_seen.items() if seen < cutoff]
+        for session in idle:
+            del self.session_seen[session]
+            del self.totals["session"][session]
+        self.totals["finished_sessions"] += len(idle)
+
+    def tenant_spent_today(self, tenant_id):
+        """Tenant spend today across processes, as of the last flush"""
+        key = f"{tenant_id}:{date.today().isoformat()}"
+        own = self.totals["tenant_day"].get(key, {}).get("cost_usd", 0.0)
+        return own + self.other_tenant_days.get(key, 0.0)
+
+
+def _snapshots(directory, exclude=None):
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(".json") and path != exclude:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+
+def usage_report(directory=METRICS_DIR):
+    """Merge every process snapshot into per-tenant, per-stage and per-day totals"""
+    report = {"tenant": {}, "stage": {}, "tenant_day": {}, "sessions": 0}
+    for snapshot in _snapshots(directory):
+        totals = snapshot["totals"]
+        report["sessions"] += len(totals.get("session", {})) + totals.get("finished_sessions", 0)
+        for scope in ("tenant", "stage", "tenant_day"):
+            for key, usage in totals.get(scope, {}).items():
+                add_usage(report[scope].setdefault(key, new_usage()), usage)
+    return report
+
+
+if __name__ == "__main__":
+    print(json.dumps(usage_report(), indent=2))
@@ -0,0 +1,333 @@
+# Outbound notification and CHW task queue, by priority
+#
+# Items wait in SQLite (shared by every worker) in one of three levels: urgent results
+# (cervical CIN-2/3, abnormal mammograms), other follow-up and routine reminders.
+# Workers claim the most urgent ready items first. Waiting items age from when they
+# first became ready (retries and deferrals don't reset it): every step of
+# AGING_SECONDS moves them up a level, but never into the urgent level, and urgent
+# items always get at least URGENT_SHARE of a claimed batch, so a backlog of routine
+# reminders can neither starve nor delay urgent outreach.
+import json
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from caseload import MINOR, SERIOUS, result_severity
+
+DEFAULT_DB = os.environ.get(
+    "NAVIGATOR_OUTREACH_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "outreach.sqlite3"),
+)
+
+# Priority levels, most urgent first
+URGENT = 0
+FOLLOW_UP = 1
+ROUTINE = 2
+LEVELS = (URGENT, FOLLOW_UP, ROUTINE)
+LEVEL_NAMES = {URGENT: "urgent", FOLLOW_UP: "follow-up", ROUTINE: "routine"}
+
+# A waiting item moves up one level per step
+AGING_SECONDS = {FOLLOW_UP: 15 * 60, ROUTINE: 60 * 60}
+# Share of each claimed batch kept for urgent items while any are waiting
+URGENT_SHARE = 0.75
+CLAIM_BATCH = 100
+
+# Channels
+PATIENT = "patient"   # a message to the user, e.g. a *_results_notification stage
+CHW = "chw"           # a task for the region's community health worker
+
+# Item states
+QUEUED = "queued"
+CLAIMED = "claimed"
+DONE = "done"       # CHW task handled
+SENT = "sent"       # message accepted by the provider
+FAILED = "failed"   # message gave up after MAX_ATTEMPTS
+
+# Failed sends are retried with exponential backoff (and some jitter)
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# Claims older than this belong to a worker that stopped; they are queued again
+CLAIM_TIMEOUT_SECONDS = 300
+
+OutreachItem = namedtuple("OutreachItem", ["item_id", "tenant", "session", "channel", "stage", "level",
+                                           "ready_at", "payload", "waiting_since"])
+
+# Queues created before waiting_since have it only for newer items
+_ITEM_COLUMNS = "id, tenant, session, channel, stage, level, ready_at, payload, COALESCE(waiting_since, ready_at)"
+
+
+def _item(row):
+    return OutreachItem(*row[:7], json.loads(row[7]), row[8])
+
+
+def result_level(test_results):
+    """Queue level for a results notification"""
+    severity = result_severity(test_results)
+    if severity == SERIOUS:
+        return URGENT
+    if severity == MINOR:
+        return FOLLOW_UP
+    return ROUTINE
+
+
+def effective_level(level, waited):
+    """A waiting item's level after aging; aging never reaches the urgent level"""
+    if level == URGENT:
+        return URGENT
+    return max(level - int(waited // AGING_SECONDS[level]), FOLLOW_UP)
+
+
+def retry_delay(attempts, base=RETRY_BASE_SECONDS):
+    """Seconds to wait before the next attempt after a number of failed ones"""
+    delay = min(base * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def notification_stage(test_results):
+    """The flow stage that announces a set of results"""
+    if test_results.get("cervical") and test_results.get("breast"):
+        return "comprehensive_results_notification"
+    if test_results.get("breast"):
+        return "breast_results_notification"
+    return "cervical_results_notification"
+
+
+class OutreachQueue:
+    """Multi-level priority queue of outbound messages and CHW tasks"""
+
+    def __init__(self, db_path=DEFAULT_DB, retry_base_seconds=RETRY_BASE_SECONDS):
+        self.retry_base_seconds = retry_base_seconds
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS outreach (
+                id INTEGER PRIMARY KEY,
+                tenant TEXT NOT NULL,
+                session TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                level INTEGER NOT NULL,
+                ready_at REAL NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                claimed_at REAL,
+                done_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                provider_message_id TEXT,
+                error TEXT,
+                waiting_since REAL
+            );
+            CREATE INDEX IF NOT EXISTS outreach_ready ON outreach (status, level, ready_at);
+        """)
+        # Queues created before delivery tracking and aging by waiting time
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(outreach)")}
+        for column, definition in (("attempts", "INTEGER NOT NULL DEFAULT 0"), ("provider_message_id", "TEXT"),
+                                   ("error", "TEXT"), ("waiting_since", "REAL")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE outreach ADD COLUMN {column} {definition}")
+        self.lock = threading.Lock()
+
+    def enqueue(self, tenant_id, session, stage, level, channel=PATIENT, payload=None, ready_at=None):
+        """Queue one message or task; ready_at delays it (e.g. a reminder before an appointment)"""
+        return self.enqueue_many([(tenant_id, session, stage, level, channel, payload, ready_at)])[0]
+
+    def enqueue_many(self, items):
+        """Queue (tenant, session, stage, level, channel, payload, ready_at) items in one transaction"""
+        now = time.time()
+        ids = []
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for tenant_id, session, stage, level, channel, payload, ready_at in items:
+                    cursor = self.db.execute(
+                        "INSERT INTO outreach (tenant, session, channel, stage, level, ready_at, payload, status, "
+                        "waiting_since) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (tenant_id, session, channel or PATIENT, stage, level, ready_at or now,
+                         json.dumps(payload or {}), QUEUED, ready_at or now))
+                    ids.append(cursor.lastrowid)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def enqueue_results(self, tenant_id, session, test_results):
+        """Queue a results notification, plus a CHW call task when the results are serious"""
+        level = result_level(test_results)
+        items = [(tenant_id, session, notification_stage(test_results), level, PATIENT, dict(test_results), None)]
+        if level == URGENT:
+            items.append((tenant_id, session, "call_about_results", URGENT, CHW, dict(test_results), None))
+        return self.enqueue_many(items)
+
+    def _heads(self, level, channel, now, limit):
+        return self.db.execute(
+            f"SELECT {_ITEM_COLUMNS} FROM outreach INDEXED BY outreach_ready "
+            "WHERE status = ? AND level = ? AND ready_at <= ? AND channel = ? ORDER BY ready_at LIMIT ?",
+            (QUEUED, level, now, channel, limit)).fetchall()
+
+    def claim(self, limit=CLAIM_BATCH, channel=PATIENT, now=None):
+        """Take the next items to send, most urgent (after aging) first"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # Levels are FIFO, so the oldest few of each level are the only candidates
+                heads = {level: self._heads(level, channel, now, limit) for level in LEVELS}
+                urgent = heads[URGENT]
+                others = sorted(
+                    heads[FOLLOW_UP] + heads[ROUTINE],
+                    key=lambda row: (effective_level(row[5], now - row[8]), row[8]),
+                )
+                # Urgent items first, but lower levels keep a share of each batch while they wait
+                reserved = min(len(others), limit - math.ceil(limit * URGENT_SHARE)) if urgent else 0
+                chosen = urgent[:limit - reserved]
+                chosen += others[:limit - len(chosen)]
+                if chosen:
+                    self.db.executemany(
+                        "UPDATE outreach SET status = ?, claimed_at = ? WHERE id = ?",
+                        [(CLAIMED, now, row[0]) for row in chosen])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return [_item(row) for row in chosen]
+
+    def complete(self, item_ids, now=None):
+        """Mark claimed items as handled"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.executemany("UPDATE outreach SET status = ?, done_at = ? WHERE id = ?",
+                                [(DONE, now, item_id) for item_id in item_ids])
+
+    def release(self, item_ids):
+        """Put claimed items back, e.g. when a worker stops before handling them"""
+        with self.lock:
+            self.db.executemany("UPDATE outreach SET status = ?, claimed_at = NULL WHERE id = ? AND status = ?",
+                                [(QUEUED, item_id, CLAIMED) for item_id in item_ids])
+
+    def reclaim_stale(self, now=None):
+        """Queue again the items claimed by workers that stopped before finishing them"""
+        now = time.time() if now is None else now
+        with self.lock:
+            return self.db.execute("UPDATE outreach SET status = ?, claimed_at = NULL WHERE status = ? AND claimed_at < ?",
+                                   (QUEUED, CLAIMED, now - CLAIM_TIMEOUT_SECONDS)).rowcount
+
+    # Delivery
+
+    def mark_sent(self, accepted, now=None):
+        """Record (item id, provider message id) pairs the provider accepted"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.executemany(
+                "UPDATE outreach SET status = ?, done_at = ?, provider_message_id = ?, attempts = attempts + 1, "
+                "error = NULL WHERE id = ?",
+                [(SENT, now, provider_message_id, item_id) for item_id, provider_message_id in accepted])
+
+    def retry(self, item_ids, error, now=None):
+        """Count a failed attempt: back off and queue again, or give up after MAX_ATTEMPTS"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for item_id in item_ids:
+                    row = self.db.execute("SELECT attempts FROM outreach WHERE id = ?", (item_id,)).fetchone()
+                    if row is None:
+                        continue
+                    attempts = row[0] + 1
+                    if attempts >= MAX_ATTEMPTS:
+                        self.db.execute("UPDATE outreach SET status = ?, attempts = ?, error = ?, done_at = ? WHERE id = ?",
+                                        (FAILED, attempts, error, now, item_id))
+                    else:
+                        self.db.execute(
+                            "UPDATE outreach SET status = ?, attempts = ?, error = ?, claimed_at = NULL, ready_at = ? "
+                            "WHERE id = ?",
+                            (QUEUED, attempts, error, now + retry_delay(attempts, self.retry_base_seconds), item_id))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def fail(self, item_ids, error, now=None):
+        """Give up on items straight away, e.g. a message that can't be built"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.executemany("UPDATE outreach SET status = ?, error = ?, done_at = ? WHERE id = ?",
+                                [(FAILED, error, now, item_id) for item_id in item_ids])
+
+    def defer(self, item_ids, until):
+        """Queue items again for later without counting an attempt, e.g. while the provider throttles"""
+        with self.lock:
+            self.db.executemany("UPDATE outreach SET status = ?, claimed_at = NULL, ready_at = ? WHERE id = ?",
+                                [(QUEUED, until, item_id) for item_id in item_ids])
+
+    def status(self, item_id):
+        """Delivery status of one item"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, attempts, provider_message_id, error, done_at FROM outreach WHERE id = ?",
+                (item_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("status", "attempts", "provider_message_id", "error", "done_at"), row))
+
+    def status_counts(self, channel=PATIENT):
+        """Items per delivery status"""
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT status, COUNT(*) FROM outreach WHERE channel = ? GROUP BY status", (channel,)).fetchall())
+
+    def next_ready_at(self, channel=PATIENT):
+        """When the next queued item becomes ready, or None if nothing is queued"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT MIN(ready_at) FROM outreach WHERE status = ? AND channel = ?", (QUEUED, channel)).fetchone()[0]
+
+    def pending(self, tenant_id, channel=CHW, limit=CLAIM_BATCH, now=None):
+        """Queued items for one region without claiming them, most urgent (after aging) first"""
+        now = time.time() if now is None else now
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {_ITEM_COLUMNS} FROM outreach INDEXED BY outreach_ready "
+                "WHERE status = ? AND level IN (0, 1, 2) AND ready_at <= ? AND channel = ? AND tenant = ?",
+                (QUEUED, now, channel, tenant_id)).fetchall()
+        rows.sort(key=lambda row: (effective_level(row[5], now - row[8]), row[8]))
+        return [_item(row) for row in rows[:limit]]
+
+    def depth(self):
+        """Queued items per level"""
+        counts = dict.fromkeys(LEVEL_NAMES.values(), 0)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT level, COUNT(*) FROM outreach WHERE status = ? GROUP BY level", (QUEUED,)).fetchall()
+        for level, count in rows:
+            counts[LEVEL_NAMES[level]] = count
+        return counts
+
+
+if __name__ == "__main__":
+    # Urgent latency while draining a routine backlog, on a scratch queue
+    import tempfile
+    queue = OutreachQueue(os.path.join(tempfile.mkdtemp(), "outreach.sqlite3"))
+    queue.enqueue_many([("pune", f"routine-{i}", "intro", ROUTINE, PATIENT, None, None) for i in range(50000)])
+    waits = []
+    claimed = batches = 0
+    while True:
+        # A serious result arrives every ten batches
+        if batches % 10 == 0:
+            queue.enqueue_results("pune", f"urgent-{batches}", {"cervical": "abnormal_serious"})
+        batches += 1
+        batch = queue.claim()
+        if not batch:
+            break
+        claimed += len(batch)
+        now = time.time()
+        waits += [now - item.waiting_since for item in batch if item.level == URGENT]
+        queue.complete([item.item_id for item in batch])
+    print(f"Drained {claimed} items; {len(waits)} urgent, longest urgent wait {max(waits) * 1000:.0f} ms")
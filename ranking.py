@@ -0,0 +1,121 @@
+# Multi-service clinic ranking by out-of-pocket cost, travel distance and wait
+#
+# The directory is laid out column-wise (one array per field) so a ranking query is a
+# single pass of arithmetic over flat arrays. Distance and cost narrow the field
+# first; appointment waits are only looked up for the shortlist, since they need
+# the slot engine. A clinic offers what its services list says; a listed service
+# with no published price is costed at the dearest known price for it, so a clinic
+# never ranks cheaper for leaving its price out.
+import heapq
+import math
+from array import array
+
+# Score = cost + distance_km * weight + wait_days * weight, in currency units
+DEFAULT_WEIGHTS = {"cost": 1.0, "distance_km": 2.0, "wait_days": 5.0}
+# Share of the treatment price counted when treatment is only a possibility
+POSSIBLE_TREATMENT_WEIGHT = 0.2
+SHORTLIST_FACTOR = 4
+# Wait assumed for clinics with no opening in the booking horizon
+UNKNOWN_WAIT_DAYS = 90
+MISSING = float("inf")
+UNPRICED = float("nan")
+
+
+class ClinicRanker:
+    """Columnar view of a clinic directory for fast top-k ranking"""
+
+    def __init__(self, clinics):
+        self.clinics = []
+        self.latitude = array("d")
+        self.longitude = array("d")
+        self.costs = {}  # service -> array of prices (inf where the clinic doesn't offer it)
+        self.unpriced = {}  # service -> positions of clinics that offer it without a price
+        for clinic in clinics:
+            try:
+                latitude, longitude = float(clinic["latitude"]), float(clinic["longitude"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            position = len(self.clinics)
+            self.clinics.append(clinic)
+            self.latitude.append(latitude)
+            self.longitude.append(longitude)
+            prices = clinic.get("cost", {})
+            for service in set(clinic.get("services", [])):
+                column = self.costs.get(service)
+                if column is None:
+                    column = self.costs[service] = array("d", [MISSING] * position)
+                price = prices.get(service)
+                column.append(UNPRICED if price is None else float(price))
+            for column in self.costs.values():
+                if len(column) == position:
+                    column.append(MISSING)
+        for service, column in self.costs.items():
+            unpriced = [i for i, price in enumerate(column) if price != price]
+            if not unpriced:
+                continue
+            known = [price for price in column if price == price and price != MISSING]
+            assumed = max(known) if known else 0.0
+            for i in unpriced:
+                column[i] = assumed
+            self.unpriced[service] = frozenset(unpriced)
+
+    def rank(self, services, latitude, longitude, k=3, max_km=None, weights=None, wait_days=None):
+        """
+        Return the top-k clinics as dicts with score, cost, distance_km, wait_days and
+        unpriced (the services whose price was assumed).
+
+        services maps each service to how much of its price counts (1 for needed services,
+        less for ones that may be needed). wait_days(clinic) is optional and only called
+        for the shortlist.
+        """
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        if not self.clinics:
+            return []
+
+        # Equirectangular distance is accurate enough for ranking within a region
+        cos_lat = math.cos(math.radians(latitude))
+        km_per_degree = 111.195
+        distances = [km_per_degree * math.hypot(lat - latitude, (lon - longitude) * cos_lat)
+                     for lat, lon in zip(self.latitude, self.longitude)]
+
+        costs = [0.0] * len(self.clinics)
+        for service, share in services.items():
+            column = self.costs.get(service)
+            if column is None:
+                if share >= 1:
+                    return []
+                continue
+            if share >= 1:
+                costs = [total + price for total, price in zip(costs, column)]
+            else:
+                # Optional services never exclude a clinic, they only nudge the score
+                costs = [total + (price * share if price != MISSING else 0.0) for total, price in zip(costs, column)]
+
+        distance_weight = weights["distance_km"]
+        cost_weight = weights["cost"]
+        base_scores = [
+            cost * cost_weight + distance * distance_weight
+            if cost != MISSING and (max_km is None or distance <= max_km) else MISSING
+            for cost, distance in zip(costs, distances)
+        ]
+
+        shortlist_size = k * SHORTLIST_FACTOR if wait_days else k
+        shortlist = heapq.nsmallest(shortlist_size, (i for i, score in enumerate(base_scores) if score != MISSING),
+                                    key=base_scores.__getitem__)
+        ranked = []
+        for i in shortlist:
+            wait = wait_days(self.clinics[i]) if wait_days else None
+            if wait_days:
+                score = base_scores[i] + (UNKNOWN_WAIT_DAYS if wait is None else wait) * weights["wait_days"]
+            else:
+                score = base_scores[i]
+            ranked.append({
+                "clinic": self.clinics[i],
+                "score": round(score, 2),
+                "cost": round(costs[i], 2),
+                "distance_km": round(distances[i], 1),
+                "wait_days": wait,
+                "unpriced": [service for service in services if i in self.unpriced.get(service, ())],
+            })
+        ranked.sort(key=lambda entry: entry["score"])
+        return ranked[:k]
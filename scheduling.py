@@ -0,0 +1,228 @@
+# Appointment slot engine
+#
+# Bookings live in SQLite, which serializes writers across threads and worker processes
+# (BEGIN IMMEDIATE) and enforces one booking per seat with a unique constraint, so a
+# slot can never be double-booked. Searches run against per clinic/service/day
+# occupancy bitmaps cached in memory; the cache is dropped whenever another
+# connection commits (PRAGMA data_version), so it never serves stale availability.
+import math
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+DEFAULT_DB = os.environ.get(
+    "NAVIGATOR_BOOKINGS_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "bookings.sqlite3"),
+)
+
+DAY_START_MINUTES = 9 * 60
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 16               # 9:00 - 17:00
+DEFAULT_SEATS_PER_SLOT = 2
+WORKING_DAYS = {0, 1, 2, 3, 4, 5}  # Monday - Saturday
+BOOKING_HORIZON_DAYS = 120
+MIN_LEAD_TIME = timedelta(hours=24)
+DEFAULT_RADIUS_KM = 25
+
+Slot = namedtuple("Slot", ["clinic_id", "clinic_name", "city", "service", "start", "distance_km"])
+Booking = namedtuple("Booking", ["booking_id", "slot"])
+
+
+class SlotUnavailable(Exception):
+    """Raised when a slot filled up before the booking could be made"""
+
+
+def clinic_id(clinic):
+    return clinic.get("id") or f"{clinic.get('city', '')}:{clinic['name']}"
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def slot_start(day, slot):
+    return datetime.combine(day, datetime.min.time()) + timedelta(minutes=DAY_START_MINUTES + slot * SLOT_MINUTES)
+
+
+class SlotEngine:
+    """Capacity calendars, booking and earliest-slot search for every clinic"""
+
+    def __init__(self, clinic_directory, db_path=DEFAULT_DB):
+        self.clinic_directory = clinic_directory
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS bookings (
+                id INTEGER PRIMARY KEY,
+                clinic TEXT NOT NULL,
+                service TEXT NOT NULL,
+                day TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                seat INTEGER NOT NULL,
+                session TEXT NOT NULL,
+                created TEXT NOT NULL,
+                UNIQUE (clinic, service, day, slot, seat)
+            );
+            CREATE INDEX IF NOT EXISTS bookings_by_session ON bookings (session);
+        """)
+        self.lock = threading.RLock()
+        self.occupancy = {}   # (clinic, service, day) -> bytearray of seats taken per slot
+        self.full = {}        # (clinic, service, day) -> bitmap of slots with no seats left
+        self.data_version = None
+
+    # Occupancy cache
+
+    def _check_cache(self):
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self.occupancy.clear()
+            self.full.clear()
+            self.data_version = version
+
+    def _seats(self, clinic):
+        try:
+            return int(clinic.get("slot_capacity") or DEFAULT_SEATS_PER_SLOT)
+        except ValueError:
+            return DEFAULT_SEATS_PER_SLOT
+
+    def _full_bitmap(self, clinic, service, day):
+        key = (clinic_id(clinic), service, day.isoformat())
+        bitmap = self.full.get(key)
+        if bitmap is None:
+            taken = bytearray(SLOTS_PER_DAY)
+            rows = self.db.execute(
+                "SELECT slot, COUNT(*) FROM bookings WHERE clinic = ? AND service = ? AND day = ? GROUP BY slot", key)
+            for slot, count in rows:
+                if 0 <= slot < SLOTS_PER_DAY:
+                    taken[slot] = count
+            seats = self._seats(clinic)
+            bitmap = 0
+            for slot, count in enumerate(taken):
+                if count >= seats:
+                    bitmap |= 1 << slot
+            self.occupancy[key] = taken
+            self.full[key] = bitmap
+        return bitmap
+
+    def _first_free_slot(self, clinic, service, day, not_before):
+        """Earliest slot on a day with a free seat, or None"""
+        if day.weekday() not in WORKING_DAYS:
+            return None
+        free = ~self._full_bitmap(clinic, service, day) & ((1 << SLOTS_PER_DAY) - 1)
+        if day == not_before.date():
+            minutes = not_before.hour * 60 + not_before.minute - DAY_START_MINUTES
+            first_allowed = max(0, -(-minutes // SLOT_MINUTES))
+            free &= ~((1 << first_allowed) - 1)
+        if not free:
+            return None
+        return (free & -free).bit_length() - 1
+
+    # Queries
+
+    def candidate_clinics(self, service, latitude, longitude, max_km):
+        """Clinics offering a service within max_km, nearest first"""
+        candidates = []
+        # The grid narrows the search to nearby cells; distance decides the rest
+        for clinic_latitude, clinic_longitude, clinic in self.clinic_directory.grid().near(service, latitude, longitude, max_km):
+            distance = distance_km(latitude, longitude, clinic_latitude, clinic_longitude)
+            if distance <= max_km:
+                candidates.append((distance, clinic))
+        candidates.sort(key=lambda candidate: candidate[0])
+        return candidates
+
+    def earliest_slot(self, service, latitude, longitude, max_km=DEFAULT_RADIUS_KM, after=None, clinics=None):
+        """Earliest free slot for a service at any clinic within max_km"""
+        not_before = (after or datetime.now()) + MIN_LEAD_TIME
+        candidates = clinics if clinics is not None else self.candidate_clinics(service, latitude, longitude, max_km)
+        if not candidates:
+            return None
+        with self.lock:
+            self._check_cache()
+            # Walk forward a day at a time so we stop at the first day with any opening
+            for offset in range(BOOKING_HORIZON_DAYS):
+                day = not_before.date() + timedelta(days=offset)
+                best = None
+                for distance, clinic in candidates:
+                    slot = self._first_free_slot(clinic, service, day, not_before)
+                    if slot is not None and (best is None or (slot, distance) < (best[0], best[1])):
+                        best = (slot, distance, clinic)
+                if best is not None:
+                    slot, distance, clinic = best
+                    return Slot(clinic_id(clinic), clinic["name"], clinic.get("city", ""), service,
+                                slot_start(day, slot), round(distance, 1))
+        return None
+
+    def earliest_slot_in_city(self, service, city, max_km=DEFAULT_RADIUS_KM, after=None):
+        """Earliest slot near the centre of a city's listed clinics"""
+        centre = self.clinic_directory.city_centre(city)
+        if centre is None:
+            return None
+        return self.earliest_slot(service, *centre, max_km, after)
+
+    # Booking
+
+    def book(self, session, slot):
+        """Atomically take a seat in a slot; raises SlotUnavailable if it is full"""
+        clinic = next((c for c in self.clinic_directory.clinics_for(slot.city) if clinic_id(c) == slot.clinic_id), None)
+        if clinic is None:
+            raise SlotUnavailable(f"Unknown clinic {slot.clinic_id}")
+        day = slot.start.date()
+        minutes = slot.start.hour * 60 + slot.start.minute - DAY_START_MINUTES
+        slot_number = minutes // SLOT_MINUTES
+        seats = self._seats(clinic)
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so the seat count cannot change under us
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                taken = {seat for (seat,) in self.db.execute(
+                    "SELECT seat FROM bookings WHERE clinic = ? AND service = ? AND day = ? AND slot = ?",
+                    (slot.clinic_id, slot.service, day.isoformat(), slot_number))}
+                seat = next((s for s in range(seats) if s not in taken), None)
+                if seat is None:
+                    raise SlotUnavailable(f"{slot.clinic_name} is full at {slot.start}")
+                cursor = self.db.execute(
+                    "INSERT INTO bookings (clinic, service, day, slot, seat, session, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (slot.clinic_id, slot.service, day.isoformat(), slot_number, seat, session, datetime.now().isoformat()))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            # Our own commits do not change data_version, so update the cache directly
+            key = (slot.clinic_id, slot.service, day.isoformat())
+            self.occupancy.pop(key, None)
+            self.full.pop(key, None)
+            return Booking(cursor.lastrowid, slot)
+
+    def book_earliest(self, session, service, city, max_km=DEFAULT_RADIUS_KM, after=None, attempts=5):
+        """Find and book the earliest slot near a city, retrying if someone else takes it first"""
+        for _ in range(attempts):
+            slot = self.earliest_slot_in_city(service, city, max_km, after)
+            if slot is None:
+                return None
+            try:
+                return self.book(session, slot)
+            except SlotUnavailable:
+                continue
+        return None
+
+    def cancel(self, booking_id):
+        """Release a booking; returns True if it existed"""
+        with self.lock:
+            row = self.db.execute("SELECT clinic, service, day FROM bookings WHERE id = ?", (booking_id,)).fetchone()
+            if row is None:
+                return False
+            self.db.execute("DELETE FROM bookings WHERE id = ?", (booking_id,))
+            self.occupancy.pop(tuple(row), None)
+            self.full.pop(tuple(row), None)
+            return True
+
+    def bookings_for(self, session):
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, clinic, service, day, slot FROM bookings WHERE session = ? ORDER BY day, slot", (session,)).fetchall()
@@ -0,0 +1,209 @@
+# Screening guideline rule packs
+#
+# Who is due for which screening, how often, and how the recommendations are worded
+# differ by country, so they are data: guidelines/<rules id>/screening.json beside the
+# guideline documents. A pack gives each screening's profile field, the answers that
+# mean it is due, its age band and intervals; wording for screenings that are due
+# together; and risk modifiers that add a recommendation. Packs are compiled once per
+# process into a decision table indexed by which screenings are due, so evaluating a
+# profile is a few comparisons and one lookup. The same intervals give each user's next
+# due date for every screening (see due_dates.py).
+import json
+import os
+import threading
+
+DAY_SECONDS = 86400
+YEAR_SECONDS = 365.25 * DAY_SECONDS
+
+# Why a screening is due when it is, kept with each due date
+DUE_NOW = "due"                  # never screened or unsure, and in the age band
+BOOKED = "booked"                # an appointment is booked for it
+NORMAL_RESULT = "normal_result"  # the interval after a normal result
+FOLLOW_UP = "follow_up"          # a monitoring visit after a minor finding
+ABNORMAL_RESULT = "abnormal_result"
+SCREENED_BEFORE = "screened_before"
+AGE = "age"                      # too young now; due at the start of the age band
+
+GUIDELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guidelines")
+RULES_FILE = "screening.json"
+# Regions without a pack of their own yet are screened under these rules
+DEFAULT_RULES = "india_fogsi"
+
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+class ScreeningRulesError(Exception):
+    """Raised when a screening rule pack is missing or malformed"""
+
+
+def profile_age(user_profile):
+    """Age in years from a profile: an int or the lower end of a range like "30-39" """
+    age = user_profile["age"]
+    return int(age) if isinstance(age, int) else int(age.split("-")[0])
+
+
+def _compile_modifier(rule):
+    """A test for one risk modifier: profile -> bool"""
+    fields = tuple(rule["fields"])
+    if "equals" in rule:
+        value = rule["equals"]
+        return lambda profile: any(profile.get(field) == value for field in fields)
+    if "includes_any" in rule:
+        values = tuple(rule["includes_any"])
+        return lambda profile: any(field in profile and any(value in profile[field] for value in values) for field in fields)
+    raise ScreeningRulesError(f"Risk modifier for {', '.join(fields)} needs 'equals' or 'includes_any'")
+
+
+class ScreeningRules:
+    """A compiled rule pack"""
+
+    def __init__(self, rules_id, pack):
+        self.rules_id = rules_id
+        self.name = pack.get("name", rules_id)
+        try:
+            screenings = pack["screenings"]
+            self.screenings = tuple(screenings)
+            # One row per screening: (field, due answers, min age, max age), in pack order
+            self.tests = tuple(
+                (rule["field"], frozenset(rule["due_answers"]), rule.get("min_age"), rule.get("max_age"))
+                for rule in screenings.values()
+            )
+            self.intervals = {name: rule.get("interval", "") for name, rule in screenings.items()}
+            self.follow_ups = {name: (rule.get("follow_up", ""), rule.get("follow_up_days", 0)) for name, rule in screenings.items()}
+            self.advice = {name: rule.get("advice", "") for name, rule in screenings.items()}
+            # Everything next_due needs per screening: the eligibility row plus its clinic service and intervals
+            self.schedule = tuple(
+                (name, rule.get("service", name), rule.get("interval_days"), rule.get("follow_up_days"),
+                 frozenset(rule.get("follow_up_results", ()))) + test
+                for (name, rule), test in zip(screenings.items(), self.tests)
+            )
+            # Decision table: bit i of the index is set when screening i is due
+            combinations = {frozenset(combo["due"]): tuple(combo["recommendations"])
+                            for combo in pack.get("combinations", ())}
+            self.table = []
+            for mask in range(1 << len(self.screenings)):
+                due = [name for i, name in enumerate(self.screenings) if mask & (1 << i)]
+                combined = combinations.get(frozenset(due))
+                self.table.append(combined if combined is not None
+                                  else tuple(screenings[name]["recommendation"] for name in due))
+            self.modifiers = tuple((_compile_modifier(rule), rule["recommendation"])
+                                   for rule in pack.get("risk_modifiers", ()))
+        except KeyError as e:
+            raise ScreeningRulesError(f"Screening rules '{rules_id}' are missing {e}") from None
+        self.uses_age = any(min_age is not None or max_age is not None for _, _, min_age, max_age in self.tests)
+
+    def due(self, user_profile):
+        """Bit mask of the screenings the profile is due for"""
+        age = profile_age(user_profile) if self.uses_age else None
+        mask = 0
+        for i, (field, due_answers, min_age, max_age) in enumerate(self.tests):
+            if user_profile.get(field) not in due_answers:
+                continue
+            if min_age is not None and age < min_age or max_age is not None and age > max_age:
+                continue
+            mask |= 1 << i
+        return mask
+
+    def recommendations(self, user_profile):
+        """Recommendations for a profile: the due screenings' wording, then any risk modifiers"""
+        recommendations = list(self.table[self.due(user_profile)])
+        for test, recommendation in self.modifiers:
+            if test(user_profile):
+                recommendations.append(recommendation)
+        return recommendations
+
+    def next_due(self, user_profile, test_results, booked, now):
+        """{screening: (due time, reason)} for the screenings a user's answers, results and bookings date
+
+        booked maps clinic services to appointment start times; screenings nothing is known
+        about yet, or that the user has aged out of, are left out
+        """
+        try:
+            # New profiles start at age 0 until the user answers
+            age = profile_age(user_profile) or None
+        except (KeyError, TypeError, ValueError):
+            age = None
+        due = {}
+        for name, service, interval_days, follow_up_days, follow_up_results, field, due_answers, min_age, max_age in self.schedule:
+            result = test_results.get(name)
+            if service in booked:
+                due[name] = (booked[service], BOOKED)
+            elif result == "normal" and interval_days:
+                due[name] = (now + interval_days * DAY_SECONDS, NORMAL_RESULT)
+            elif result in follow_up_results and follow_up_days:
+                due[name] = (now + follow_up_days * DAY_SECONDS, FOLLOW_UP)
+            elif result:
+                due[name] = (now, ABNORMAL_RESULT)
+            elif age is None and (min_age is not None or max_age is not None):
+                continue
+            elif max_age is not None and age > max_age:
+                continue
+            elif min_age is not None and age < min_age:
+                due[name] = (now + (min_age - age) * YEAR_SECONDS, AGE)
+            elif user_profile.get(field) in due_answers:
+                due[name] = (now, DUE_NOW)
+            elif user_profile.get(field) and interval_days:
+                due[name] = (now + interval_days * DAY_SECONDS, SCREENED_BEFORE)
+        return due
+
+    def interval(self, screening):
+        """Time until the next screening after a normal result, e.g. "3-5 years" """
+        return self.intervals.get(screening, "")
+
+    def follow_up(self, screening):
+        """Time until a monitoring visit after a minor finding"""
+        return self.follow_ups.get(screening, ("", 0))[0]
+
+    def follow_up_days(self, screening):
+        """Days from a minor finding to the earliest monitoring visit"""
+        return self.follow_ups.get(screening, ("", 0))[1]
+
+
+def load_rules(path, rules_id):
+    try:
+        with open(path, encoding="utf-8") as f:
+            pack = json.load(f)
+    except FileNotFoundError:
+        raise ScreeningRulesError(f"No screening rules for '{rules_id}'") from None
+    return ScreeningRules(rules_id, pack)
+
+
+def get_screening_rules(rules_id=None):
+    """The shared, compiled rule pack for a guideline rules id, loading it on first use"""
+    rules_id = rules_id or DEFAULT_RULES
+    rules = _packs.get(rules_id)
+    if rules is not None:
+        return rules
+    with _packs_lock:
+        if rules_id not in _packs:
+            path = os.path.join(GUIDELINES_DIR, rules_id, RULES_FILE)
+            if not os.path.exists(path):
+                path = os.path.join(GUIDELINES_DIR, DEFAULT_RULES, RULES_FILE)
+            _packs[rules_id] = load_rules(path, rules_id)
+        return _packs[rules_id]
+
+
+if __name__ == "__main__":
+    # Evaluation cost over a spread of profiles
+    import itertools
+    import sys
+    import time
+    rules = get_screening_rules(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_RULES)
+    answers = ["Yes", "No", "Not sure", "I don't know"]
+    profiles = [
+        {"age": age, "annual_checkup": annual, "cervical_screening": cervical, "breast_screening": breast,
+         "family_history_cancer": family, "chronic_conditions": conditions, "tobacco_use": "No",
+         "alcohol_use": "No", "physical_activity": activity}
+        for age, annual, cervical, breast, family, conditions, activity in itertools.product(
+            [25, "30-39", 45, "60-69"], answers, answers, answers, ["Yes", "No"],
+            [[], ["Diabetes"]], ["Sedentary", "Active"])
+    ]
+    started = time.perf_counter()
+    for _ in range(10):
+        for profile in profiles:
+            rules.recommendations(profile)
+    elapsed = time.perf_counter() - started
+    print(f"{rules.name}: {len(rules.table)}-row table, {len(rules.modifiers)} risk modifiers; "
+          f"{elapsed / (len(profiles) * 10) * 1e6:.2f} µs per profile")
+    print(rules.recommendations(profiles[-1]))
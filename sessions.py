@@ -0,0 +1,246 @@
+# Memory-bounded conversation sessions
+#
+# Conversations on messaging channels can sit idle for weeks while results come back,
+# so only the most recently active ones stay in memory. The manager keeps resident
+# sessions in LRU order under a count and a byte cap; the least recently used are
+# written to SQLite as compressed JSON and read back on the user's next message.
+# Until that write commits an evicted session stays findable, so a message arriving
+# mid-eviction picks the conversation back up instead of starting a new one.
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from conversation import SessionState, init_session
+from scheduling import Booking, Slot
+
+DEFAULT_DB = os.environ.get(
+    "NAVIGATOR_SESSIONS_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sessions.sqlite3"),
+)
+MAX_RESIDENT_SESSIONS = 10000
+MAX_RESIDENT_BYTES = 256 * 2**20
+COMPRESSION_LEVEL = 1
+# Rough fixed cost of a session's profile and bookkeeping, and of each message, in bytes
+SESSION_OVERHEAD_BYTES = 2048
+MESSAGE_OVERHEAD_BYTES = 64
+
+
+def _encode_booking(booking):
+    slot = booking.slot
+    return [booking.booking_id, slot.clinic_id, slot.clinic_name, slot.city, slot.service,
+            slot.start.isoformat(), slot.distance_km]
+
+
+def _decode_booking(fields):
+    booking_id, clinic_id, clinic_name, city, service, start, distance = fields
+    return Booking(booking_id, Slot(clinic_id, clinic_name, city, service, datetime.fromisoformat(start), distance))
+
+
+def dump_session(state):
+    """Compact serialized form of a session"""
+    data = dict(state)
+    # Bookings are the only values that aren't plain JSON
+    data["appointments"] = {service: _encode_booking(booking) for service, booking in state.get("appointments", {}).items()}
+    text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return zlib.compress(text.encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def estimate_size(state):
+    """Approximate memory held by a session, without serializing it"""
+    return SESSION_OVERHEAD_BYTES + sum(MESSAGE_OVERHEAD_BYTES + len(message.get("content", ""))
+                                        for message in state.get("messages", ()))
+
+
+def load_session(blob):
+    """Session state back from its serialized form"""
+    state = SessionState(json.loads(zlib.decompress(blob)))
+    state.appointments = {service: _decode_booking(fields) for service, fields in state.get("appointments", {}).items()}
+    return state
+
+
+class SessionStore:
+    """Evicted sessions, shared by all workers"""
+
+    def __init__(self, db_path=DEFAULT_DB):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                key TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self.lock = threading.Lock()
+
+    def save_many(self, sessions):
+        """Write (key, blob) pairs in one transaction"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO sessions (key, data, updated) VALUES (?, ?, ?)",
+                                    [(key, blob, now) for key, blob in sessions])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def load(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM sessions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+
+class SessionManager:
+    """Resident sessions in LRU order, evicting the idle ones to a SessionStore"""
+
+    def __init__(self, store, max_sessions=MAX_RESIDENT_SESSIONS, max_bytes=MAX_RESIDENT_BYTES):
+        self.store = store
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.resident = OrderedDict()  # key -> (state, estimated size at the end of its last turn)
+        self.resident_bytes = 0
+        self.evicting = {}  # key -> state, evicted but not yet written to the store
+        self.lock = threading.Lock()
+        self.rehydrated = 0
+        self.evicted = 0
+
+    def get(self, key, tenant):
+        """The session for a user key: resident, rehydrated from the store, or new"""
+        with self.lock:
+            entry = self.resident.get(key)
+            if entry is not None:
+                self.resident.move_to_end(key)
+                return entry[0]
+            # Evicted but still being written: take it back as it is
+            state = self.evicting.get(key)
+            if state is not None:
+                size = estimate_size(state)
+                self.resident[key] = (state, size)
+                self.resident_bytes += size
+                return state
+        blob = self.store.load(key)
+        if blob is not None:
+            state = load_session(blob)
+            self.rehydrated += 1
+        else:
+            state = SessionState(tenant_id=tenant["id"])
+        init_session(state, tenant)
+        size = estimate_size(state)
+        with self.lock:
+            # Another thread may have loaded it meanwhile; keep the first copy
+            entry = self.resident.setdefault(key, (state, size))
+            self.resident_bytes += 0 if entry[0] is not state else entry[1]
+            self.resident.move_to_end(key)
+        return entry[0]
+
+    def done(self, key):
+        """Call after a turn: update the session's size and evict others if over the caps"""
+        with self.lock:
+            entry = self.resident.get(key)
+        size = estimate_size(entry[0]) if entry is not None else 0
+        evicted = []
+        with self.lock:
+            current = self.resident.get(key)
+            if current is not None and entry is not None and current[0] is entry[0]:
+                self.resident_bytes += size - current[1]
+                self.resident[key] = (current[0], size)
+            # Oldest first; a session whose previous eviction is still being written waits
+            # its turn, so two writes of the same key never race
+            victims = iter(list(self.resident))
+            while len(self.resident) > self.max_sessions or self.resident_bytes > self.max_bytes:
+                old_key = next(victims, None)
+                if old_key is None:
+                    break
+                if old_key in self.evicting:
+                    continue
+                old_state, old_size = self.resident.pop(old_key)
+                self.resident_bytes -= old_size
+                self.evicting[old_key] = old_state
+                evicted.append((old_key, old_state))
+            self.evicted += len(evicted)
+        if not evicted:
+            return
+        saved = False
+        try:
+            self.store.save_many([(old_key, dump_session(old_state)) for old_key, old_state in evicted])
+            saved = True
+        finally:
+            with self.lock:
+                for old_key, old_state in evicted:
+                    if self.evicting.get(old_key) is old_state:
+                        del self.evicting[old_key]
+                        # Not written: keep it resident rather than lose it
+                        if not saved and old_key not in self.resident:
+                            size = estimate_size(old_state)
+                            self.resident[old_key] = (old_state, size)
+                            self.resident.move_to_end(old_key, last=False)
+                            self.resident_bytes += size
+
+    def flush(self):
+        """Write every resident session to the store, e.g. before the process exits"""
+        with self.lock:
+            sessions = [(key, state) for key, (state, _) in self.resident.items()]
+        self.store.save_many([(key, dump_session(state)) for key, state in sessions])
+
+    def forget(self, key):
+        """Drop a session everywhere (e.g. the user asked to be removed)"""
+        with self.lock:
+            entry = self.resident.pop(key, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+            self.evicting.pop(key, None)
+        self.store.delete(key)
+
+
+if __name__ == "__main__":
+    # Many users on a small cache: resident memory stays capped and rehydration stays quick
+    import random
+    import tempfile
+
+    from clinics import ClinicDirectory
+    from conversation import Context, build_intent_classifier, respond, start_conversation
+    from events import NullEventLog
+    from flows import FlowRegistry
+    from scheduling import SlotEngine
+    from tenants import DEFAULT_TENANT, get_tenant
+
+    scratch = tempfile.mkdtemp()
+    tenant = get_tenant(DEFAULT_TENANT)
+    flow = FlowRegistry().latest(tenant["flow"])
+    clinics = ClinicDirectory(tenant["clinics"])
+    ctx = Context(tenant, flow, build_intent_classifier(flow), clinics,
+                  SlotEngine(clinics, os.path.join(scratch, "bookings.sqlite3")), NullEventLog())
+    manager = SessionManager(SessionStore(os.path.join(scratch, "sessions.sqlite3")), max_sessions=500)
+    answers = ["Yes", "35", "Married", "Secondary school", "Yes", "Regular", "2", "None"]
+    rng = random.Random(3)
+    rehydrate_times = []
+    for turn in range(20000):
+        key = f"user-{rng.randrange(5000)}"
+        rehydrated = manager.rehydrated
+        started = time.perf_counter()
+        state = manager.get(key, tenant)
+        if manager.rehydrated > rehydrated:
+            rehydrate_times.append(time.perf_counter() - started)
+        if not state.messages:
+            start_conversation(state, ctx)
+        else:
+            respond(state, ctx, answers[len(state.messages) // 2 % len(answers)])
+        manager.done(key)
+    rehydrate_times.sort()
+    print(f"{len(manager.resident)} resident (~{manager.resident_bytes / 1024:.0f} KiB), "
+          f"{manager.evicted} evictions, {manager.rehydrated} rehydrations")
+    print(f"Rehydration p50 {rehydrate_times[len(rehydrate_times) // 2] * 1000:.2f} ms, "
+          f"p99 {rehydrate_times[int(len(rehydrate_times) * 0.99)] * 1000:.2f} ms")
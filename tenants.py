@@ -0,0 +1,75 @@
+# Regional tenant configuration
+#
+# Each region (tenant) is described by tenants/<tenant_id>.json: community health worker
+# name, currency, clinic directory, guideline rules, default locale and flow variant.
+# Configs are loaded on first use, frozen, and shared by every session in the process;
+# a session only stores its tenant id.
+import json
+import os
+import re
+import threading
+from types import MappingProxyType
+
+TENANTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tenants")
+DEFAULT_TENANT = os.environ.get("NAVIGATOR_TENANT", "pune")
+
+REQUIRED_FIELDS = ["name", "chw_name", "currency_symbol", "default_locale", "clinics",
+                   "default_city", "guideline_rules", "flow"]
+
+_tenants = {}
+_tenants_lock = threading.Lock()
+
+
+class TenantConfigError(Exception):
+    """Raised when a tenant config file is missing or incomplete"""
+
+
+def _freeze(value):
+    """Make a parsed JSON value read-only so sessions can share it safely"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _load_tenant(tenant_id):
+    path = os.path.join(TENANTS_DIR, f"{tenant_id}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        raise TenantConfigError(f"No tenant config for '{tenant_id}'") from None
+    missing = [field for field in REQUIRED_FIELDS if field not in config]
+    if missing:
+        raise TenantConfigError(f"Tenant '{tenant_id}' is missing: {', '.join(missing)}")
+    config["id"] = tenant_id
+    # Clinic directories are given relative to the repository
+    if not os.path.isabs(config["clinics"]):
+        config["clinics"] = os.path.join(os.path.dirname(TENANTS_DIR), config["clinics"])
+    return _freeze(config)
+
+
+def get_tenant(tenant_id):
+    """Return the shared, read-only config for a tenant, loading it on first use"""
+    tenant = _tenants.get(tenant_id)
+    if tenant is not None:
+        return tenant
+    with _tenants_lock:
+        if tenant_id not in _tenants:
+            _tenants[tenant_id] = _load_tenant(tenant_id)
+        return _tenants[tenant_id]
+
+
+def available_tenants():
+    """Tenant ids that have a config file"""
+    return sorted(name[:-5] for name in os.listdir(TENANTS_DIR) if name.endswith(".json"))
+
+
+def resolve_tenant(requested=None):
+    """Pick the tenant id for a new session, falling back to the default tenant"""
+    if requested:
+        requested = requested.strip().lower()
+        if re.fullmatch(r"[a-z0-9_-]+", requested) and os.path.exists(os.path.join(TENANTS_DIR, f"{requested}.json")):
+            return requested
+    return DEFAULT_TENANT
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcripts
+from conversation import SessionState, init_session, respond, start_conversation
+from transcripts import TEXT_PLACEHOLDER, TranscriptRecorder
+
+
+class TranscriptRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        transcripts._init_worker(self.directory)
+        self.ctx = transcripts._context("pune", "assessment", 1)
+        self.recorder = TranscriptRecorder(self.directory)
+        self.state = SessionState()
+        init_session(self.state, self.ctx.tenant)
+        self.state.user_profile["name"] = "Priya"
+
+    def run_turn(self, reply):
+        message_count = len(self.state.messages)
+        offered = list(self.state.quick_replies)
+        if reply is None:
+            self.recorder.start(self.state, self.ctx)
+            start_conversation(self.state, self.ctx)
+        else:
+            respond(self.state, self.ctx, reply)
+        self.recorder.turn(self.state, reply, message_count, 0.0, offered)
+
+    def records(self):
+        with open(self.recorder.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_typed_input_is_replaced(self):
+        self.run_turn(None)
+        self.run_turn("Yes")
+        self.run_turn("41-50")
+        self.run_turn("married to Ravi Deshmukh")
+        turns = [record for record in self.records() if record["type"] == "turn"]
+        self.assertEqual([turn["input"] for turn in turns], [None, "Yes", "41-50", TEXT_PLACEHOLDER])
+        written = json.dumps(self.records())
+        self.assertNotIn("Ravi", written)
+        self.assertNotIn("Priya", written)
+
+    def test_typed_text_echoed_later_is_replaced(self):
+        self.run_turn(None)
+        self.state.quick_replies = []
+        self.state.messages.append({"role": "assistant", "content": "placeholder"})
+        message_count = len(self.state.messages)
+        self.recorder.turn(self.state, "live at 14 MG Road Kothrud", message_count, 0.0, [])
+        self.state.messages.append({"role": "assistant", "content": "Clinics near live at 14 MG Road Kothrud"})
+        self.recorder.turn(self.state, "Yes", message_count, 0.0, ["Yes"])
+        turns = [record for record in self.records() if record["type"] == "turn"]
+        self.assertEqual(turns[-2]["input"], TEXT_PLACEHOLDER)
+        self.assertEqual(turns[-1]["output"], [f"Clinics near {TEXT_PLACEHOLDER}"])
+
+
+if __name__ == "__main__":
+    unittest.main()
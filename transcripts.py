@@ -0,0 +1,340 @@
+# Conversation transcripts: recording and regression replay
+#
+# When recording is switched on (NAVIGATOR_RECORD_TRANSCRIPTS=1), every conversation is
+# appended as it happens to a per-process JSON-lines file under data/transcripts. Each line
+# is one record: a "start" record with the starting session (no name) and one "turn"
+# record per user input with the assistant messages, next stage and quick replies it
+# produced. An input is only written as-is when it was one of the quick replies offered;
+# anything typed is written as a placeholder, the same rule the event log follows. Names,
+# phone numbers, email addresses and everything the user typed are also replaced with
+# placeholders wherever a reply echoes them.
+#
+# Replay feeds recorded inputs through the stage logic in conversation.py across a process
+# pool. It reports turns whose output differs from the recording and, given a baseline
+# from an earlier replay, turns and transcripts that got slower.
+#
+#   python transcripts.py [dir] [--workers 8] [--save-baseline base.json] [--baseline base.json]
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from clinics import ClinicDirectory
+from conversation import (
+    Context, SessionState, build_intent_classifier, init_session, respond, start_conversation
+)
+from events import NullEventLog
+from flows import FlowRegistry
+from guidelines import open_guidelines
+from scheduling import SlotEngine
+from tenants import get_tenant
+
+TRANSCRIPTS_DIR = os.environ.get(
+    "NAVIGATOR_TRANSCRIPTS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "transcripts"),
+)
+RECORDING_ENABLED = os.environ.get("NAVIGATOR_RECORD_TRANSCRIPTS") == "1"
+FORMAT_VERSION = 1
+
+NAME_PLACEHOLDER = "<name>"
+TEXT_PLACEHOLDER = "<text>"
+# Profile answers that carry the user's own words after a fixed prefix
+FREE_TEXT_PREFIXES = ("Other: ", "Yes - details: ")
+# Shorter free text is too likely to match unrelated words in a reply
+MIN_FREE_TEXT_CHARS = 3
+REPLAY_NAME = "Asha"
+CHUNK_SIZE = 64
+
+# Timing changes smaller than this are noise, whatever the ratio
+MIN_SLOWDOWN_MS = 1.0
+SLOWDOWN_RATIO = 1.5
+
+# Session fields a transcript starts from (the profile is stored without the name)
+START_FIELDS = ["conv_stage", "test_results", "assessment_path", "recommendations"]
+
+_PHONE_RE = re.compile(r"\+?\d[\d\s-]{6,}\d")
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+# Parts of a reply that change from run to run: appointment times and days until an opening
+_VOLATILE = [
+    (re.compile(r"[A-Z][a-z]+ \d{1,2}, \d{4}, \d{1,2}:\d{2} [AP]M"), "<date>"),
+    (re.compile(r"in \d+ day\(s\)"), "in <n> day(s)"),
+]
+
+
+def _profile_texts(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        yield from (item for item in value if isinstance(item, str))
+
+
+def free_texts(profile):
+    """What the user typed into free-text profile answers, longest first"""
+    texts = set()
+    for value in profile.values():
+        for text in _profile_texts(value):
+            for prefix in FREE_TEXT_PREFIXES:
+                if text.startswith(prefix) and len(text) - len(prefix) >= MIN_FREE_TEXT_CHARS \
+                        and text[len(prefix):] != TEXT_PLACEHOLDER:
+                    texts.add(text[len(prefix):])
+    return sorted(texts, key=len, reverse=True)
+
+
+def scrub_profile(profile):
+    """A profile without the name and with free-text answers replaced by a placeholder"""
+    def scrub(text):
+        for prefix in FREE_TEXT_PREFIXES:
+            if text.startswith(prefix):
+                return prefix + TEXT_PLACEHOLDER
+        return text
+
+    scrubbed = {}
+    for key, value in profile.items():
+        if key == "name":
+            continue
+        if isinstance(value, str):
+            value = scrub(value)
+        elif isinstance(value, list):
+            value = [scrub(item) if isinstance(item, str) else item for item in value]
+        scrubbed[key] = value
+    return scrubbed
+
+
+def deidentify(text, name="", texts=()):
+    """Replace the user's name, free-text answers, phone numbers and email addresses with placeholders"""
+    for free_text in texts:
+        text = text.replace(free_text, TEXT_PLACEHOLDER)
+    if name:
+        text = re.sub(rf"\b{re.escape(name)}\b", NAME_PLACEHOLDER, text, flags=re.IGNORECASE)
+    text = _EMAIL_RE.sub("<email>", text)
+    return _PHONE_RE.sub("<number>", text)
+
+
+def normalize(text):
+    """Mask run-to-run differences so replies can be compared across replays"""
+    for pattern, replacement in _VOLATILE:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class TranscriptRecorder:
+    """Appends de-identified transcripts to this process's file, one record per line"""
+
+    def __init__(self, directory=TRANSCRIPTS_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{time.strftime('%Y%m%d')}-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+        self.lock = threading.Lock()
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def start(self, state, ctx):
+        """Begin a transcript for a conversation about to send its opening message"""
+        state.transcript_id = uuid.uuid4().hex
+        state.transcript_turns = 0
+        state.transcript_texts = []
+        profile = scrub_profile(state.user_profile)
+        self._write({
+            "id": state.transcript_id,
+            "type": "start",
+            "format": FORMAT_VERSION,
+            "tenant": ctx.tenant["id"],
+            "flow": ctx.flow.name,
+            "flow_version": ctx.flow.version,
+            "has_name": bool(state.user_profile.get("name")),
+            "profile": profile,
+            "session": {field: state[field] for field in START_FIELDS},
+        })
+
+    def turn(self, state, reply, message_count, elapsed, offered=()):
+        """Record one input and what the conversation did with it; offered is the quick replies the user saw"""
+        if "transcript_id" not in state:
+            return
+        typed = reply is not None and reply not in offered
+        if typed and len(reply.strip()) >= MIN_FREE_TEXT_CHARS:
+            state.transcript_texts = state.get("transcript_texts", []) + [reply.strip()]
+        name = state.user_profile.get("name", "")
+        texts = sorted(set(free_texts(state.user_profile)) | set(state.get("transcript_texts", [])), key=len, reverse=True)
+        outputs = [deidentify(m["content"], name, texts) for m in state.messages[message_count:] if m["role"] == "assistant"]
+        self._write({
+            "id": state.transcript_id,
+            "type": "turn",
+            "seq": state.transcript_turns,
+            "input": TEXT_PLACEHOLDER if typed else reply,
+            "output": outputs,
+            "stage": state.conv_stage,
+            "quick_replies": list(state.quick_replies),
+            "ms": round(elapsed * 1000, 3),
+        })
+        state.transcript_turns += 1
+
+
+def load_transcripts(directory=TRANSCRIPTS_DIR):
+    """Read every recorded transcript, with its turns in order"""
+    transcripts = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".jsonl"):
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a torn last line from a crashed process
+                if record["type"] == "start":
+                    transcripts[record["id"]] = dict(record, turns=[])
+                elif record["id"] in transcripts:
+                    transcripts[record["id"]]["turns"].append(record)
+    for transcript in transcripts.values():
+        transcript["turns"].sort(key=lambda turn: turn["seq"])
+    return [transcript for transcript in transcripts.values() if transcript["turns"]]
+
+
+_contexts = {}
+_work_dir = None
+
+
+def _init_worker(work_dir):
+    global _work_dir
+    _work_dir = work_dir
+
+
+def _context(tenant_id, flow_name, flow_version):
+    """Per-process context for a tenant and flow version, with scratch bookings and no event log"""
+    key = (tenant_id, flow_name, flow_version)
+    if key not in _contexts:
+        tenant = get_tenant(tenant_id)
+        flow = FlowRegistry().get(flow_name, flow_version)
+        clinics = ClinicDirectory(tenant["clinics"])
+        scratch = tempfile.mkdtemp(dir=_work_dir)
+        slots = SlotEngine(clinics, os.path.join(scratch, "bookings.sqlite3"))
+        _contexts[key] = Context(tenant, flow, build_intent_classifier(flow), clinics, slots, NullEventLog(),
+                                 open_guidelines(tenant["guideline_rules"]))
+    return _contexts[key]
+
+
+def _outcome(state, message_count):
+    """What a turn produced, in the form stored in transcripts"""
+    outputs = [deidentify(m["content"], REPLAY_NAME) for m in state.messages[message_count:] if m["role"] == "assistant"]
+    return [normalize(text) for text in outputs], state.conv_stage, list(state.quick_replies)
+
+
+def replay_transcript(transcript):
+    """Replay one transcript; returns its id, per-turn timings and the first differing turn"""
+    ctx = _context(transcript["tenant"], transcript["flow"], transcript["flow_version"])
+    state = SessionState()
+    init_session(state, ctx.tenant)
+    state.user_profile = dict(transcript["profile"], name=REPLAY_NAME if transcript["has_name"] else "")
+    for field, value in transcript["session"].items():
+        state[field] = value
+    timings, diff = [], None
+    for turn in transcript["turns"]:
+        message_count = len(state.messages)
+        started = time.perf_counter()
+        if turn["input"] is None:
+            start_conversation(state, ctx)
+        else:
+            respond(state, ctx, turn["input"])
+        timings.append(time.perf_counter() - started)
+        actual = _outcome(state, message_count)
+        expected = ([normalize(text) for text in turn["output"]], turn["stage"], turn["quick_replies"])
+        if diff is None and actual != expected:
+            diff = {"seq": turn["seq"], "input": turn["input"],
+                    "expected": dict(zip(("output", "stage", "quick_replies"), expected)),
+                    "actual": dict(zip(("output", "stage", "quick_replies"), actual))}
+    for booking in state.appointments.values():
+        ctx.slots.cancel(booking.booking_id)
+    return transcript["id"], timings, diff
+
+
+def replay(transcripts, workers=None):
+    """Replay transcripts across a process pool; returns {id: (timings, diff)}"""
+    work_dir = tempfile.mkdtemp(prefix="replay-")
+    try:
+        # Build clinic indexes once here rather than racing to build them in every worker
+        for tenant_id in {transcript["tenant"] for transcript in transcripts}:
+            ClinicDirectory(get_tenant(tenant_id)["clinics"])
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(work_dir,)) as pool:
+            return {tid: (timings, diff) for tid, timings, diff in pool.map(replay_transcript, transcripts, chunksize=CHUNK_SIZE)}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def timing_baseline(results):
+    """Per-transcript turn timings in milliseconds, to compare later replays against"""
+    return {tid: [round(t * 1000, 4) for t in timings] for tid, (timings, _) in results.items()}
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def compare_timings(results, baseline):
+    """Turn latency percentiles now and in the baseline, plus the transcripts that slowed down"""
+    current = timing_baseline(results)
+    shared = [tid for tid in current if tid in baseline]
+    now = [ms for tid in shared for ms in current[tid]]
+    before = [ms for tid in shared for ms in baseline[tid]]
+    slower = []
+    for tid in shared:
+        total_now, total_before = sum(current[tid]), sum(baseline[tid])
+        if total_now - total_before > MIN_SLOWDOWN_MS and total_now > total_before * SLOWDOWN_RATIO:
+            slower.append({"id": tid, "baseline_ms": round(total_before, 3), "ms": round(total_now, 3)})
+    slower.sort(key=lambda item: item["baseline_ms"] - item["ms"])
+    return {
+        "compared": len(shared),
+        "p50_ms": (round(_percentile(before, 0.5), 4), round(_percentile(now, 0.5), 4)),
+        "p95_ms": (round(_percentile(before, 0.95), 4), round(_percentile(now, 0.95), 4)),
+        "max_ms": (round(max(before, default=0.0), 4), round(max(now, default=0.0), 4)),
+        "slower": slower,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replay recorded transcripts and report behaviour and timing changes")
+    parser.add_argument("directory", nargs="?", default=TRANSCRIPTS_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--baseline", help="timings from an earlier run to compare against")
+    parser.add_argument("--save-baseline", help="write this run's timings here")
+    args = parser.parse_args()
+
+    transcripts = load_transcripts(args.directory)
+    started = time.perf_counter()
+    results = replay(transcripts, args.workers)
+    elapsed = time.perf_counter() - started
+    turns = sum(len(transcript["turns"]) for transcript in transcripts)
+    print(f"Replayed {len(transcripts)} transcripts ({turns} turns) in {elapsed:.2f}s "
+          f"({len(transcripts) / max(elapsed, 1e-9):,.0f} transcripts/s)")
+
+    diffs = [(tid, diff) for tid, (_, diff) in results.items() if diff]
+    print(f"Behaviour changes: {len(diffs)}")
+    for tid, diff in diffs[:20]:
+        print(f"  {tid} turn {diff['seq']} ({diff['input']!r}):")
+        for field in ("stage", "quick_replies", "output"):
+            if diff["expected"][field] != diff["actual"][field]:
+                print(f"    {field}: expected {diff['expected'][field]!r}")
+                print(f"    {' ' * len(field)}  got      {diff['actual'][field]!r}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            comparison = compare_timings(results, json.load(f))
+        print(f"Timing vs baseline over {comparison['compared']} transcripts (before -> now): "
+              f"p50 {comparison['p50_ms'][0]} -> {comparison['p50_ms'][1]} ms, "
+              f"p95 {comparison['p95_ms'][0]} -> {comparison['p95_ms'][1]} ms, "
+              f"max {comparison['max_ms'][0]} -> {comparison['max_ms'][1]} ms")
+        print(f"Slower transcripts: {len(comparison['slower'])}")
+        for item in comparison["slower"][:20]:
+            print(f"  {item['id']}: {item['baseline_ms']} -> {item['ms']} ms")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(timing_baseline(results), f)
+    raise SystemExit(1 if diffs else 0)